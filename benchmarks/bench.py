@@ -0,0 +1,159 @@
+"""Benchmark rems-copy end to end against local mock REMS servers.
+
+Every stage is run for every size against a fresh source server with a synthetic inventory and an empty destination
+server. The stages that the benchmarked stage depends on are copied first, without measuring them. The mock servers run
+in their own processes, so the peak memory is that of rems-copy alone. Run it with:
+
+    python benchmarks/bench.py --sizes 100 1000 10000 --latency 0.005 --concurrency 8 --output results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_rems import serve  # noqa: E402
+from rems_copy.main import STAGES, main, prerequisites  # noqa: E402
+
+ALL_STAGES = list(STAGES) + ["all"]
+
+
+class MockProcess:
+    """Mock REMS server running in its own process."""
+
+    def __init__(self, size, latency):
+        """Start server with a generated inventory of size catalogue items, or an empty one."""
+        parent, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve, args=(size, latency, child), daemon=True)
+        self.process.start()
+        self.url = parent.recv()
+
+    def requests(self):
+        """Get number of requests per endpoint since the last reset."""
+        with urllib.request.urlopen(self.url + "_mock/requests") as response:
+            return json.loads(response.read())
+
+    def reset(self):
+        """Forget counted requests."""
+        urllib.request.urlopen(urllib.request.Request(self.url + "_mock/reset", data=b"", method="POST")).close()
+
+    def stop(self):
+        """Stop server."""
+        self.process.terminate()
+        self.process.join()
+
+
+def run_tool(arguments):
+    """Run rems-copy with arguments without showing its output."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            main(arguments)
+        except SystemExit as e:
+            if e.code:
+                sys.exit(f"ABORT: rems-copy {' '.join(arguments)} failed: {e.code}")
+
+
+def benchmark(stage, size, latency, options, memory=True):
+    """Copy stage of a generated inventory of size catalogue items and return wall time, requests and peak memory."""
+    source = MockProcess(size, latency)
+    destination = MockProcess(0, latency)
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as config:
+        json.dump(
+            {
+                "source": {"url": source.url, "key": "key", "username": "bench", "organisation": "default"},
+                "destination": {"url": destination.url, "key": "key", "username": "bench", "organisation": "default"},
+            },
+            config,
+        )
+    try:
+        for prerequisite in prerequisites(stage):
+            run_tool([prerequisite, "source", "destination", "-c", config.name] + options)
+        source.reset()
+        destination.reset()
+
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        run_tool([stage, "source", "destination", "-c", config.name] + options)
+        wall = time.perf_counter() - start
+        peak = None
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        requests = {"source": source.requests(), "destination": destination.requests()}
+        return {
+            "stage": stage,
+            "size": size,
+            "wall": round(wall, 3),
+            "requests": requests,
+            "total_requests": sum(sum(counts.values()) for counts in requests.values()),
+            "peak_memory": peak,
+        }
+    finally:
+        source.stop()
+        destination.stop()
+        os.remove(config.name)
+
+
+def print_result(result, baseline=None):
+    """Print one result, compared to the same stage and size in baseline."""
+    peak = f"{result['peak_memory'] / 1e6:.1f}MB" if result["peak_memory"] is not None else "-"
+    line = f"{result['stage']:<12} {result['size']:>7} {result['wall']:>9.3f}s {result['total_requests']:>9} {peak:>10}"
+    if baseline is not None:
+        line += f"   wall {_change(result['wall'], baseline['wall'])}, requests {_change(result['total_requests'], baseline['total_requests'])}"
+        if result["peak_memory"] is not None and baseline.get("peak_memory"):
+            line += f", memory {_change(result['peak_memory'], baseline['peak_memory'])}"
+    print(line)
+
+
+def _change(value, old):
+    return f"{(value - old) / old:+.0%}" if old else "n/a"
+
+
+def parse_arguments():
+    """Parse command line arguments and options."""
+    parser = argparse.ArgumentParser(description="Benchmark rems-copy against local mock REMS servers")
+    parser.add_argument("--stages", nargs="+", choices=ALL_STAGES, default=ALL_STAGES, help="stages to benchmark, default=all of them one by one")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 1000], help="numbers of catalogue items in the source, default=100 1000")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response, default=0")
+    parser.add_argument("--concurrency", type=int, default=1, help="passed to rems-copy, default=1")
+    parser.add_argument("--adaptive", action="store_true", help="passed to rems-copy")
+    parser.add_argument("--no-memory", action="store_true", help="don't measure peak memory, tracing memory slows down the run")
+    parser.add_argument("--output", help="path to JSON file to write the results to")
+    parser.add_argument("--baseline", help="path to JSON file written earlier with --output, to compare the results to")
+    return parser.parse_args()
+
+
+def run():
+    """Run benchmarks."""
+    a = parse_arguments()
+    options = ["--concurrency", str(a.concurrency)] + (["--adaptive"] if a.adaptive else [])
+    baseline = {}
+    if a.baseline:
+        with open(a.baseline, "r") as f:
+            baseline = {(result["stage"], result["size"]): result for result in json.loads(f.read())["results"]}
+
+    print(f"{'stage':<12} {'size':>7} {'wall':>10} {'requests':>9} {'memory':>10}")
+    results = []
+    for size in a.sizes:
+        for stage in a.stages:
+            result = benchmark(stage, size, a.latency, options, memory=not a.no_memory)
+            print_result(result, baseline.get((stage, size)))
+            results.append(result)
+
+    if a.output:
+        with open(a.output, "w") as f:
+            f.write(json.dumps({"latency": a.latency, "options": options, "results": results}, indent=1))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,429 @@
+"""Stand-in REMS HTTP server for benchmarks.
+
+Serves the REMS API endpoints that rems-copy calls from a synthetic in-memory inventory, counts requests per endpoint,
+and can inject latency and failures. Run it on its own with:
+
+    python benchmarks/mock_rems.py --size 1000 --latency 0.01 --port 8000
+"""
+import argparse
+import email
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+ORGANIZATION = {"organization/id": "default", "organization/short-name": {"en": "Default"}, "organization/name": {"en": "Default"}}
+
+
+class Inventory:
+    """In-memory REMS data of one mock environment."""
+
+    def __init__(self):
+        """Create empty inventory."""
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.licenses = {}
+        self.attachments = {}
+        self.forms = {}
+        self.resources = {}
+        self.workflows = {}
+        self.catalogue_items = {}
+        self.categories = {}
+
+    def new_id(self):
+        """Allocate a new identifier."""
+        identifier = self.next_id
+        self.next_id += 1
+        return identifier
+
+    def add_license(self, title, licensetype="text", attachment=None):
+        """Add license."""
+        identifier = self.new_id()
+        localization = {"title": title, "textcontent": f"text of {title}"}
+        if licensetype == "attachment":
+            attachment_id = self.new_id()
+            self.attachments[attachment_id] = ("license.pdf", "application/pdf", attachment or b"%PDF" + b"x" * 1024)
+            localization["attachment-id"] = attachment_id
+            localization["textcontent"] = "license.pdf"
+        self.licenses[identifier] = {
+            "id": identifier,
+            "licensetype": licensetype,
+            "organization": dict(ORGANIZATION),
+            "localizations": {"en": localization},
+            "enabled": True,
+            "archived": False,
+        }
+        return identifier
+
+    def add_form(self, name, fields=3):
+        """Add form."""
+        identifier = self.new_id()
+        self.forms[identifier] = {
+            "form/id": identifier,
+            "form/internal-name": name,
+            "form/title": name,
+            "form/external-title": {"en": name},
+            "form/fields": [{"field/id": f"fld{i}", "field/type": "text", "field/title": {"en": f"field {i}"}, "field/optional": False} for i in range(fields)],
+            "form/errors": None,
+            "organization": dict(ORGANIZATION),
+            "enabled": True,
+            "archived": False,
+        }
+        return identifier
+
+    def add_resource(self, resid, license_ids):
+        """Add resource."""
+        identifier = self.new_id()
+        self.resources[identifier] = {
+            "id": identifier,
+            "resid": resid,
+            "organization": dict(ORGANIZATION),
+            "licenses": [self.licenses[i] for i in license_ids],
+            "enabled": True,
+            "archived": False,
+        }
+        return identifier
+
+    def add_workflow(self, title, form_ids, workflow_type="workflow/default"):
+        """Add workflow."""
+        identifier = self.new_id()
+        self.workflows[identifier] = {
+            "id": identifier,
+            "title": title,
+            "organization": dict(ORGANIZATION),
+            "workflow": {
+                "type": workflow_type,
+                "forms": [{"form/id": i, "form/internal-name": self.forms[i]["form/internal-name"]} for i in form_ids],
+                "handlers": [],
+            },
+            "enabled": True,
+            "archived": False,
+        }
+        return identifier
+
+    def add_catalogue_item(self, title, form_id, resource_id, workflow_id, category_ids=()):
+        """Add catalogue item."""
+        identifier = self.new_id()
+        self.catalogue_items[identifier] = {
+            "id": identifier,
+            "resid": self.resources[resource_id]["resid"] if resource_id else None,
+            "resource-id": resource_id,
+            "formid": form_id,
+            "wfid": workflow_id,
+            "organization": dict(ORGANIZATION),
+            "localizations": {"en": {"id": identifier, "langcode": "en", "title": title, "infourl": None}},
+            "categories": [self.category_ref(i) for i in category_ids],
+            "enabled": True,
+            "archived": False,
+            "expired": False,
+        }
+        return identifier
+
+    def add_category(self, title, children=()):
+        """Add category."""
+        identifier = self.new_id()
+        self.categories[identifier] = {
+            "category/id": identifier,
+            "category/title": {"en": title},
+            "category/description": {"en": f"description of {title}"},
+            "category/children": [{"category/id": i} for i in children],
+        }
+        return identifier
+
+    def category_ref(self, identifier):
+        """Get category reference as embedded in catalogue items."""
+        category = self.categories[identifier]
+        return {"category/id": identifier, "category/title": category["category/title"]}
+
+
+def organization(body):
+    """Get organization of a created item as REMS returns it, with the names of the organization."""
+    return dict(ORGANIZATION, **body["organization"])
+
+
+def generate_inventory(size, attachments=0):
+    """Generate synthetic inventory with size catalogue items and proportional dependencies."""
+    inventory = Inventory()
+    licenses = [inventory.add_license(f"license {i}") for i in range(max(1, size // 10))]
+    licenses += [inventory.add_license(f"attachment license {i}", "attachment") for i in range(attachments)]
+    forms = [inventory.add_form(f"form {i}") for i in range(max(1, size // 5))]
+    workflows = [inventory.add_workflow(f"workflow {i}", [forms[i % len(forms)]]) for i in range(max(1, size // 20))]
+    categories = [inventory.add_category(f"category {i}") for i in range(max(1, size // 50))]
+    parent = inventory.add_category("parent category", categories[:3])
+    categories.append(parent)
+    for i in range(size):
+        resource = inventory.add_resource(f"urn:resource:{i}", [licenses[i % len(licenses)]])
+        item_categories = [categories[i % len(categories)]] if i % 2 == 0 else []
+        inventory.add_catalogue_item(f"catalogue item {i}", forms[i % len(forms)], resource, workflows[i % len(workflows)], item_categories)
+    return inventory
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serve the REMS API endpoints used by rems-copy."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        """Silence request logging."""
+
+    def _send(self, status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunked(self, status, body, chunk_size=65536):
+        """Send body with chunked transfer encoding and without Content-Length, like REMS sends listings."""
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start : start + chunk_size]
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            data = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                data += self.rfile.read(size)
+                self.rfile.readline()
+            return data
+        return self.rfile.read(length)
+
+    def _route(self, method):
+        if self.path.startswith("/_mock/"):
+            return self._control(method, urlparse(self.path).path)
+        with self.server._count_lock:
+            self.server.in_flight += 1
+            overloaded = self.server.capacity and self.server.in_flight > self.server.capacity
+        try:
+            if overloaded:
+                self.server.count(method, "overloaded")
+                if method in ("POST", "PUT"):
+                    self._body()
+                self.send_response(429)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            return self._route_request(method)
+        finally:
+            with self.server._count_lock:
+                self.server.in_flight -= 1
+
+    def _control(self, method, path):
+        """Serve endpoints that control the mock server, they are not counted."""
+        if method == "GET" and path == "/_mock/requests":
+            with self.server._count_lock:
+                return self._send(200, dict(self.server.requests))
+        if method == "POST" and path == "/_mock/reset":
+            self._body()
+            with self.server._count_lock:
+                self.server.requests.clear()
+            return self._send(200, {"success": True})
+        return self._send(404, {"error": "not found"})
+
+    def _route_request(self, method):
+        path = urlparse(self.path).path
+        endpoint = re.sub(r"/\d+", "/{id}", path)
+        self.server.count(method, endpoint)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.headers.get("x-rems-api-key") != self.server.api_key:
+            return self._send(401, {"error": "unauthorized"})
+        raw = self._body() if method in ("POST", "PUT") else b""
+        if self.server.flaky and random.random() < self.server.flaky:
+            # transient gateway failure before the request reaches the application
+            status = random.choice([429, 503] if method == "POST" else [429, 502, 503])
+            self.server.count(method, f"{status}")
+            self.send_response(status)
+            self.send_header("Retry-After", "0.01" if status == 429 else "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        inventory = self.server.inventory
+        with inventory.lock:
+            return self._dispatch(method, path, raw, inventory)
+
+    def _dispatch(self, method, path, raw, inv):
+        listings = {
+            "/api/licenses": inv.licenses,
+            "/api/forms": inv.forms,
+            "/api/resources": inv.resources,
+            "/api/workflows": inv.workflows,
+            "/api/catalogue-items": inv.catalogue_items,
+        }
+        if method == "GET":
+            if path == "/api/config":
+                return self._send(200, {"languages": ["en", "fi"]})
+            if path in listings:
+                return self._send_chunked(200, list(listings[path].values()))
+            if path == "/api/categories":
+                return self._send_chunked(200, list(inv.categories.values()))
+            m = re.fullmatch(r"/api/licenses/attachments/(\d+)", path)
+            if m:
+                filename, content_type, data = inv.attachments[int(m.group(1))]
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Disposition", f'attachment;filename="{filename}"')
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            details = dict(listings, **{"/api/categories": inv.categories})
+            m = re.fullmatch(r"(/api/[a-z-]+)/(\d+)", path)
+            if m and m.group(1) in details and int(m.group(2)) in details[m.group(1)]:
+                return self._send(200, details[m.group(1)][int(m.group(2))])
+            return self._send(404, {"error": "not found"})
+        if method == "POST" and path == "/api/licenses/add_attachment":
+            message = email.message_from_bytes(b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + raw)
+            part = next(p for p in message.get_payload() if p.get_param("name", header="content-disposition") == "file")
+            attachment_id = inv.new_id()
+            inv.attachments[attachment_id] = (part.get_filename(), part.get_content_type(), part.get_payload(decode=True))
+            return self._send(200, {"success": True, "id": attachment_id})
+        body = json.loads(raw or b"{}")
+        if method == "POST" and path == "/api/licenses/create":
+            identifier = inv.new_id()
+            inv.licenses[identifier] = dict(body, id=identifier, organization=organization(body), enabled=True, archived=False)
+            return self._send(200, {"success": True, "id": identifier})
+        if method == "POST" and path == "/api/forms/create":
+            identifier = inv.new_id()
+            inv.forms[identifier] = dict(body, organization=organization(body), **{"form/id": identifier, "form/title": body["form/internal-name"], "form/errors": None, "enabled": True, "archived": False})
+            return self._send(200, {"success": True, "id": identifier})
+        if method == "PUT" and path == "/api/forms/edit":
+            form = inv.forms[body["form/id"]]
+            # the stored organization keeps its names, the request only has its id
+            form.update({k: v for k, v in body.items() if k != "organization"})
+            return self._send(200, {"success": True})
+        if method == "POST" and path == "/api/resources/create":
+            identifier = inv.new_id()
+            licenses = [inv.licenses[i] for i in body["licenses"]]
+            inv.resources[identifier] = dict(body, id=identifier, organization=organization(body), licenses=licenses, enabled=True, archived=False)
+            return self._send(200, {"success": True, "id": identifier})
+        if method == "POST" and path == "/api/workflows/create":
+            identifier = inv.new_id()
+            forms = [{"form/id": f["form/id"], "form/internal-name": inv.forms[f["form/id"]]["form/internal-name"]} for f in body["forms"]]
+            inv.workflows[identifier] = {
+                "id": identifier,
+                "title": body["title"],
+                "organization": organization(body),
+                "workflow": {"type": body["type"], "forms": forms, "handlers": body.get("handlers", [])},
+                "enabled": True,
+                "archived": False,
+            }
+            return self._send(200, {"success": True, "id": identifier})
+        if method == "PUT" and path == "/api/workflows/edit":
+            inv.workflows[body["id"]].update(title=body.get("title", inv.workflows[body["id"]]["title"]))
+            return self._send(200, {"success": True})
+        if method == "POST" and path == "/api/catalogue-items/create":
+            identifier = inv.new_id()
+            localizations = {lang: dict(loc, id=identifier, langcode=lang) for lang, loc in body["localizations"].items()}
+            inv.catalogue_items[identifier] = {
+                "id": identifier,
+                "resid": inv.resources[body["resid"]]["resid"] if body["resid"] else None,
+                "resource-id": body["resid"],
+                "formid": body["form"],
+                "wfid": body["wfid"],
+                "organization": organization(body),
+                "localizations": localizations,
+                "categories": [inv.category_ref(c["category/id"]) for c in body.get("categories", [])],
+                "enabled": True,
+                "archived": False,
+                "expired": False,
+            }
+            return self._send(200, {"success": True, "id": identifier})
+        if method == "PUT" and path == "/api/catalogue-items/edit":
+            item = inv.catalogue_items[body["id"]]
+            item["localizations"] = {lang: dict(loc, id=body["id"], langcode=lang) for lang, loc in body["localizations"].items()}
+            if "categories" in body:
+                item["categories"] = [inv.category_ref(c["category/id"]) for c in body["categories"]]
+            return self._send(200, {"success": True})
+        if method == "POST" and path == "/api/categories":
+            identifier = inv.new_id()
+            inv.categories[identifier] = dict(body, **{"category/id": identifier})
+            return self._send(200, {"success": True, "category/id": identifier})
+        if method == "PUT" and path == "/api/categories":
+            inv.categories[body["category/id"]].update(body)
+            return self._send(200, {"success": True})
+        return self._send(404, {"error": "not found"})
+
+    def do_GET(self):
+        """Handle GET."""
+        self._route("GET")
+
+    def do_POST(self):
+        """Handle POST."""
+        self._route("POST")
+
+    def do_PUT(self):
+        """Handle PUT."""
+        self._route("PUT")
+
+
+class MockREMS(ThreadingHTTPServer):
+    """Mock REMS server with request counting and injected latency."""
+
+    daemon_threads = True
+
+    def __init__(self, inventory, latency=0.0, api_key="key", port=0, flaky=0.0, capacity=0):
+        """Bind to localhost, flaky is the fraction of requests that fail with a transient error, capacity the number of requests served at the same time."""
+        super().__init__(("127.0.0.1", port), Handler)
+        self.flaky = flaky
+        self.capacity = capacity
+        self.in_flight = 0
+        self.inventory = inventory
+        self.latency = latency
+        self.api_key = api_key
+        self.requests = Counter()
+        self._count_lock = threading.Lock()
+
+    @property
+    def url(self):
+        """Get base url of the server."""
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def count(self, method, endpoint):
+        """Count request to endpoint."""
+        with self._count_lock:
+            self.requests[f"{method} {endpoint}"] += 1
+
+    def start(self):
+        """Serve in a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def serve(size, latency, connection, attachments=0):
+    """Serve a generated inventory of size catalogue items until the process is terminated, sending the url through connection."""
+    inventory = generate_inventory(size, attachments) if size else Inventory()
+    server = MockREMS(inventory, latency=latency)
+    connection.send(server.url)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a synthetic REMS inventory")
+    parser.add_argument("--size", type=int, default=100, help="number of catalogue items, 0 for an empty environment, default=100")
+    parser.add_argument("--attachments", type=int, default=0, help="number of attachment licenses, default=0")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response, default=0")
+    parser.add_argument("--flaky", type=float, default=0.0, help="fraction of requests that fail with a transient error, default=0")
+    parser.add_argument("--capacity", type=int, default=0, help="number of requests served at the same time before responding with 429, default=no limit")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on, default=8000")
+    a = parser.parse_args()
+    server = MockREMS(generate_inventory(a.size, a.attachments) if a.size else Inventory(), latency=a.latency, port=a.port, flaky=a.flaky, capacity=a.capacity)
+    print(f"serving {a.size} catalogue items at {server.url} with api key {server.api_key}")
+    server.serve_forever()
@@ -0,0 +1,226 @@
+"""Bundle operations."""
+import base64
+import gzip
+import json
+import sys
+import threading
+from contextlib import ExitStack
+from itertools import groupby
+from tempfile import SpooledTemporaryFile, TemporaryFile
+
+from ..catalogue import copy_catalogue_item_items, get_catalogue_item, iter_catalogue_items
+from ..categories import iter_categories, plan_catalogue_item_categories, plan_category_items, run_categories
+from ..engine import iter_items
+from ..forms import copy_form_items, get_form, iter_forms, strip_form
+from ..index import KINDS, match_key, to_record
+from ..inventory import stream_listing
+from ..licenses import ATTACHMENT_SPOOL_SIZE, attachment_ids, copy_license_items, download_attachment, get_license, iter_licenses, post_attachment, strip_license
+from ..planner import Plan
+from ..resources import copy_resource_items, get_resource, iter_resources
+from ..workflows import copy_workflow_items, get_workflow, iter_workflows
+
+BUNDLE_VERSION = 2
+# bundles of version 1 don't hold attachments, their attachment licenses aren't imported
+READ_VERSIONS = (1, 2)
+# attachments are written in records of chunks of this many bytes, base64 encoded, so that a record is small to read
+ATTACHMENT_CHUNK_SIZE = 192 * 1024
+
+# Kinds in the order they are written to a bundle, with the functions to stream their listing and get details, and whether
+# an item needs its details to be downloaded. Dependencies are written before the items depending on them.
+EXPORTS = [
+    ("licenses", iter_licenses, get_license, lambda item: True),
+    ("forms", iter_forms, get_form, lambda item: True),
+    ("resources", iter_resources, get_resource, lambda item: False),
+    ("workflows", iter_workflows, get_workflow, lambda item: False),
+    ("catalogue-items", iter_catalogue_items, get_catalogue_item, lambda item: "categories" not in item),
+    ("categories", iter_categories, None, lambda item: False),
+]
+
+
+def export_bundle(config, env, path):
+    """Export items of env with their details to a gzip compressed JSON lines bundle at path.
+
+    The first line of the bundle is a header, and every other line holds one item as {"kind": kind, "item": item}.
+    The attachments of attachment licenses come first, in records of base64 encoded chunks of their contents, so that
+    they are available when the licenses are imported. Disabled or archived forms, resources and workflows that catalogue items refer to
+    are written with "dependency": true, they are not copied on import but are used to resolve the catalogue items.
+    Listings are streamed to the bundle item by item, so the catalogue items and licenses are downloaded twice, first
+    to find the dependencies and attachments.
+    """
+    referenced = {"forms": set(), "resources": set(), "workflows": set()}
+    for ci in stream_listing(config, env, "catalogue-items", iter_catalogue_items):
+        for kind, field in (("forms", "formid"), ("resources", "resource-id"), ("workflows", "wfid")):
+            if ci[field] is not None:
+                referenced[kind].add(ci[field])
+    attachments = sorted({attachment_id for license in stream_listing(config, env, "licenses", iter_licenses) for attachment_id in attachment_ids(license)})
+
+    with gzip.open(path, "wt", encoding="utf-8") as bundle:
+        _write(bundle, {"kind": "bundle", "version": BUNDLE_VERSION, "source": env})
+
+        def export_attachment(attachment_id):
+            # attachments are spooled to temporary files, only the attachments in flight are held in memory when they are small
+            file = SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)
+            filename, content_type, _ = download_attachment(config, env, attachment_id, file)
+            file.seek(0)
+            return attachment_id, filename, content_type, file
+
+        for attachment_id, filename, content_type, file in iter_items(config, "attachments", attachments, export_attachment, str, action="exporting"):
+            with file:
+                _write_attachment(bundle, attachment_id, filename, content_type, file)
+        if attachments:
+            print(f"\nexported {len(attachments)} attachments from {env} to {path}")
+        for kind, iter_listing, get_item, needs_details in EXPORTS:
+            id_field = KINDS[kind][1]
+            listed = set()
+
+            def listing():
+                for item in stream_listing(config, env, kind, iter_listing):
+                    listed.add(item[id_field])
+                    yield item
+
+            def export_item(item):
+                if needs_details(item):
+                    return {"kind": kind, "item": get_item(config, env, item[id_field])}
+                return {"kind": kind, "item": item}
+
+            def export_dependency(identifier):
+                return {"kind": kind, "item": get_item(config, env, identifier), "dependency": True}
+
+            for record in iter_items(config, kind, listing(), export_item, lambda item: item[id_field], action="exporting"):
+                _write(bundle, record)
+            dependencies = sorted(referenced.get(kind, set()) - listed)
+            for record in iter_items(config, f"{kind} dependencies", dependencies, export_dependency, str, action="exporting"):
+                _write(bundle, record)
+            print(f"\nexported {len(listed)} {kind} from {env} to {path}")
+
+
+def import_bundle(config, path, env, check):
+    """Copy the items of the bundle at path to env, using the same logic as copying from another environment, and return the names by outcome of each kind.
+
+    Items are streamed from the bundle and projected to compact records, see records.Record. Only the match keys of
+    forms, resources and workflows, which are needed to resolve catalogue items, and the categories are kept in
+    memory. The details of licenses and forms, which are created from them, are spooled to a temporary file while
+    they are planned and read back when they are created, see _Details. Attachments are decoded to temporary files, which
+    stay in memory only while the attachments are small. Attachment licenses of bundles that don't hold attachments
+    are reported as not supported.
+    """
+    source_keys = {"forms": {}, "resources": {}, "workflows": {}}
+    categories = []
+    reports = {}
+    # attachments are available if the bundle is of a version that holds them
+    attachments = {} if next(_read(path, header_only=True))["version"] >= 2 else None
+
+    def copy_attachment(attachment_id):
+        if attachment_id not in attachments:
+            sys.exit(f"ABORT: import_bundle({path}) doesn't have attachment id={attachment_id}")
+        filename, content_type, file = attachments[attachment_id]
+        size = file.seek(0, 2)
+        file.seek(0)
+        return post_attachment(config, env, filename, content_type, file, size)
+
+    with ExitStack() as files:
+        for kind, records in groupby(_read(path), key=lambda r: r["kind"]):
+            details = _Details(files)
+            if kind == "attachments":
+                for r in records:
+                    _read_attachment(r["item"], attachments, files)
+                continue
+            items = _items(config, kind, records, source_keys, details)
+            if kind == "licenses":
+                reports["licenses"] = copy_license_items(config, items, env, check, lambda sl: strip_license(details.get(sl.id)), copy_attachment if attachments is not None else None)
+            elif kind == "forms":
+                reports["forms"] = copy_form_items(config, items, env, check, lambda sf: strip_form(details.get(sf.id)))
+            elif kind == "resources":
+                reports["resources"] = copy_resource_items(config, items, env, check)
+            elif kind == "workflows":
+                reports["workflows"] = copy_workflow_items(config, items, env, check)
+            elif kind == "catalogue-items":
+                reports["catalogue"] = copy_catalogue_item_items(config, items, env, check, lambda kind, identifier: source_keys[kind].get(identifier))
+            elif kind == "categories":
+                categories = list(items)
+            else:
+                sys.exit(f"ABORT: import_bundle({path}) found unknown item kind={kind}")
+
+    # categories are assigned to catalogue items after the catalogue items have been created, so the catalogue items are read again
+    plan = Plan()
+    plan_category_items(config, categories, env, plan)
+    catalogue_items = (to_record(config, "catalogue-items", r["item"]) for r in _read(path) if r["kind"] == "catalogue-items")
+    plan_catalogue_item_categories(config, path, catalogue_items, categories, env, plan)
+    reports["categories"] = run_categories(config, path, env, plan, check)
+    return reports
+
+
+def _items(config, kind, records, source_keys, details):
+    """Yield the compact records of the items to copy from bundle records, remembering the match keys of catalogue item dependencies and adding the details of licenses and forms to details by id."""
+    listing = config.get("manifest") is not None
+    for r in records:
+        item = r["item"]
+        if kind in source_keys:
+            source_keys[kind][item[KINDS[kind][1]]] = match_key(config, kind, item)
+        if r.get("dependency"):
+            continue
+        if kind in ("licenses", "forms"):
+            details.add(item[KINDS[kind][1]], item)
+        yield to_record(config, kind, item, listing)
+
+
+class _Details:
+    """Details of bundle items by id, spooled to a temporary file that is closed with files, so only their offsets are kept in memory."""
+
+    def __init__(self, files):
+        """Create empty details, the temporary file is created when the first details are added."""
+        self._files = files
+        self._file = None
+        self._offsets = {}
+        self._lock = threading.Lock()
+
+    def add(self, identifier, item):
+        """Add details of the item with identifier."""
+        with self._lock:
+            if self._file is None:
+                self._file = self._files.enter_context(TemporaryFile())
+            self._offsets[identifier] = self._file.seek(0, 2)
+            self._file.write(json.dumps(item, separators=(",", ":")).encode("utf-8") + b"\n")
+
+    def get(self, identifier):
+        """Read details of the item with identifier back from the temporary file."""
+        with self._lock:
+            self._file.seek(self._offsets[identifier])
+            return json.loads(self._file.readline())
+
+
+def _read(path, header_only=False):
+    """Stream item records from the bundle at path, or only read its header."""
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as bundle:
+            header = json.loads(bundle.readline() or "{}")
+            if header.get("kind") != "bundle" or header.get("version") not in READ_VERSIONS:
+                sys.exit(f"ABORT: {path} is not a version {BUNDLE_VERSION} rems-copy bundle")
+            if header_only:
+                yield header
+                return
+            for line in bundle:
+                yield json.loads(line)
+    except (OSError, ValueError) as e:
+        sys.exit(f"ERROR: import_bundle({path}), {e}")
+
+
+def _write(bundle, record):
+    bundle.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+def _write_attachment(bundle, attachment_id, filename, content_type, file):
+    """Write attachment records of the contents of file, one record for every chunk of the contents, at least one."""
+    chunk = file.read(ATTACHMENT_CHUNK_SIZE)
+    while True:
+        _write(bundle, {"kind": "attachments", "item": {"id": attachment_id, "filename": filename, "content-type": content_type, "data": base64.b64encode(chunk).decode("ascii")}})
+        chunk = file.read(ATTACHMENT_CHUNK_SIZE)
+        if not chunk:
+            break
+
+
+def _read_attachment(item, attachments, files):
+    """Decode an attachment record and append its chunk to the temporary file of the attachment in attachments, created on its first chunk and closed with files."""
+    if item["id"] not in attachments:
+        attachments[item["id"]] = (item["filename"], item["content-type"], files.enter_context(SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)))
+    attachments[item["id"]][2].write(base64.b64decode(item["data"]))
@@ -1,84 +1,169 @@
 """Catalogue operations."""
 import sys
 
-import requests
-
-from ..forms import get_form, get_forms
-from ..workflows import get_workflow, get_workflows
-from ..resources import get_resource, get_resources
+from ..client import LISTING_PARAMS, call, call_async, get_listing_async, iter_listing, response_json
+from ..engine import run_items
+from ..forms import get_form, iter_forms
+from ..index import add_created, add_updated, get_index, get_key_index, get_records, match_key
+from ..inventory import get_detail
+from ..journal import journaled
+from ..manifest import plan_sync, record_created, run_sync, sync_report
+from ..planner import Plan, step
+from ..workflows import get_workflow, iter_workflows
+from ..resources import get_resource, iter_resources
 
 
 def copy_catalogue(config, source, destination, check):
     """Copy catalogues from source to destination if name doesn't already exist in destination."""
-    source_catalogue_items = get_catalogue_items(config, source)
-    destination_catalogue_items = get_catalogue_items(config, destination)
-    destination_catalogue_item_names = [dci["localizations"][config["language"]]["title"] for dci in destination_catalogue_items]
-    destination_forms = get_forms(config, destination)
-    destination_resources = get_resources(config, destination)
-    destination_workflows = get_workflows(config, destination)
-
-    skipped = []
-    created = []
-
-    for i, sci in enumerate(source_catalogue_items):
-        sys.stdout.write(f"\rcopying catalogue items {i+1}/{len(source_catalogue_items)}")
-        sys.stdout.flush()
-        if sci["localizations"][config["language"]]["title"] not in destination_catalogue_item_names:
-            if not check:
-                destination_form_id = None
-                if sci["formid"] is not None:
-                    source_form = get_form(config, source, sci["formid"])
-                    for form in destination_forms:
-                        if form["form/internal-name"] == source_form["form/internal-name"]:
-                            destination_form_id = form["form/id"]
-                            break
-                if sci["formid"] is not None and destination_form_id is None:
-                    print(f"could not find source_form={sci['formid']} from {destination}, skipping this item")
-                    break
-
-                destination_resource_id = None
-                if sci["resource-id"] is not None:
-                    source_resource = get_resource(config, source, sci["resource-id"])
-                    for resource in destination_resources:
-                        if resource["resid"] == source_resource["resid"]:
-                            destination_resource_id = resource["id"]
-                            break
-                if sci["resource-id"] is not None and destination_resource_id is None:
-                    print(f"could not find source_resource={sci['resource-id']} from {destination}, skipping this item")
-                    break
-
-                destination_workflow_id = None
-                if sci["wfid"] is not None:
-                    source_workflow = get_workflow(config, source, sci["wfid"])
-                    for workflow in destination_workflows:
-                        if workflow["title"] == source_workflow["title"]:
-                            destination_workflow_id = workflow["id"]
-                            break
-                if sci["wfid"] is not None and destination_workflow_id is None:
-                    print(f"could not find source_workflow={sci['wfid']} from {destination}, skipping this item")
-                    break
-
-                catalogue_data = create_catalogue_item_data(
-                    form_id=destination_form_id,
-                    resource_id=destination_resource_id,
-                    workflow_id=destination_workflow_id,
-                    organisation=config[destination]["organisation"],
-                    titles=sci["localizations"],
-                )
-                post_catalogue_item(config, catalogue_data, destination)
-            created.append(sci["localizations"][config["language"]]["title"])
-        else:
-            skipped.append(sci["localizations"][config["language"]]["title"])
+    plan = Plan()
+    plan_catalogue(config, source, destination, plan)
+    return run_catalogue(config, source, destination, plan, check)
+
+
+def plan_catalogue(config, source, destination, plan):
+    """Plan copying catalogues from source to destination if name doesn't already exist in destination."""
+    source_catalogue_items = get_records(config, source, "catalogue-items", iter_catalogue_items)
+    # source dependencies are resolved from the match keys of listings, detail calls are only needed for items missing from them
+    source_dependencies = {
+        "forms": (get_key_index(config, source, "forms", iter_forms), get_form),
+        "resources": (get_key_index(config, source, "resources", iter_resources), get_resource),
+        "workflows": (get_key_index(config, source, "workflows", iter_workflows), get_workflow),
+    }
+
+    def source_key(kind, identifier):
+        source_keys, get_item = source_dependencies[kind]
+        if identifier not in source_keys:
+            return match_key(config, kind, get_detail(config, source, kind, identifier, get_item))
+        return source_keys[identifier]
+
+    plan_catalogue_item_items(config, source_catalogue_items, destination, plan, source_key)
+
+
+def run_catalogue(config, source, destination, plan, check):
+    """Copy catalogues from source to destination as planned and return the names by outcome."""
+    return run_catalogue_item_steps(config, plan.steps(destination, "catalogue"), destination, check)
+
+
+def copy_catalogue_item_items(config, source_catalogue_items, destination, check, source_key):
+    """Copy source_catalogue_items to destination if name doesn't already exist in destination and return the names by outcome.
+
+    source_key(kind, identifier) returns the match key of the source form, resource or workflow of a catalogue item, or None
+    if it is unknown. source_catalogue_items are records, see records.CatalogueItemRecord, and can be streamed.
+    """
+    plan = Plan()
+    plan_catalogue_item_items(config, source_catalogue_items, destination, plan, source_key)
+    return run_catalogue_item_steps(config, plan.steps(destination, "catalogue"), destination, check)
+
+
+def plan_catalogue_item_items(config, source_catalogue_items, destination, plan, source_key):
+    """Decide what happens to each of source_catalogue_items at destination, add the steps to plan and return them.
+
+    The steps of created catalogue items carry the match keys of their form, resource and workflow. Catalogue items
+    whose dependencies are unknown, or neither exist at destination nor are created by the plan, are missing. When
+    syncing, the localizations of catalogue items that have changed at source since the last sync are updated to
+    destination too.
+    """
+    destination_catalogue_items = get_index(config, destination, "catalogue-items", iter_catalogue_items)
+    destination_dependencies = {
+        "forms": get_index(config, destination, "forms", iter_forms),
+        "resources": get_index(config, destination, "resources", iter_resources),
+        "workflows": get_index(config, destination, "workflows", iter_workflows),
+    }
+    syncing = config.get("manifest") is not None
+
+    def plan_catalogue_item(sci):
+        title = sci.key
+        if title in destination_catalogue_items:
+            if not syncing:
+                return step("skipped", title, sci)
+            sync = plan_sync(config, destination, "catalogue-items", title, sci, catalogue_item_content, True)
+            if sync["outcome"] == "changed":
+                plan.call(destination, "PUT", "/api/catalogue-items/edit")
+            return step(sync["outcome"], title, sci, sync=sync)
+        if plan.creates(destination, "catalogue-items", title):
+            return step("skipped", title, sci)
+
+        references = {"forms": None, "resources": None, "workflows": None}
+        if sci.formid is not None:
+            references["forms"] = source_key("forms", sci.formid)
+        if sci.resid is not None:
+            # catalogue items carry the resid of their resource
+            references["resources"] = sci.resid
+        elif sci.resource_id is not None:
+            references["resources"] = source_key("resources", sci.resource_id)
+        if sci.wfid is not None:
+            references["workflows"] = source_key("workflows", sci.wfid)
+        unresolved = []
+        for kind, identifier in (("forms", sci.formid), ("resources", sci.resource_id), ("workflows", sci.wfid)):
+            key = references[kind]
+            if identifier is not None and (key is None or (key not in destination_dependencies[kind] and not plan.creates(destination, kind, key))):
+                unresolved.append(f"{kind[:-1]}={key if key is not None else identifier}")
+        if unresolved:
+            return step("missing", title, sci, unresolved=unresolved)
+        plan.create(destination, "catalogue-items", title)
+        plan.call(destination, "POST", "/api/catalogue-items/create")
+        return step("created", title, sci, references=references)
+
+    steps = run_items(config, "catalogue items", source_catalogue_items, plan_catalogue_item, lambda sci: sci.key, action="planning")
+    plan.add(destination, "catalogue", steps)
+    return steps
+
+
+def run_catalogue_item_steps(config, steps, destination, check):
+    """Carry out the catalogue item steps of a plan at destination and return the names by outcome."""
+    destination_catalogue_items = get_index(config, destination, "catalogue-items", iter_catalogue_items)
+    destination_dependencies = {
+        "forms": get_index(config, destination, "forms", iter_forms),
+        "resources": get_index(config, destination, "resources", iter_resources),
+        "workflows": get_index(config, destination, "workflows", iter_workflows),
+    }
+    syncing = config.get("manifest") is not None
+
+    def copy_catalogue_item(s):
+        sci = s["item"]
+        if "sync" in s:
+
+            def update(data):
+                put_catalogue_item(config, destination, dict(data, id=destination_catalogue_items.id(s["name"])))
+
+            return run_sync(config, destination, "catalogue-items", s["name"], s["sync"], update, check), s["name"]
+        if s["outcome"] == "created" and not check:
+            # dependencies created by earlier stages are found from the match indexes by their match keys
+            ids = {kind: destination_dependencies[kind].id(key) if key is not None else None for kind, key in s["references"].items()}
+            # a dependency is missing if creating it failed in a run that keeps going
+            missing = [key for kind, key in s["references"].items() if key is not None and ids[kind] is None]
+            if missing:
+                sys.exit(f"ABORT: catalogue item {s['name']} depends on {missing} missing from {destination}")
+            catalogue_data = create_catalogue_item_data(
+                form_id=ids["forms"],
+                resource_id=ids["resources"],
+                workflow_id=ids["workflows"],
+                organisation=config[destination]["organisation"],
+                titles=sci.localizations,
+            )
+            post_catalogue_item(config, catalogue_data, destination)
+            record_created(config, destination, "catalogue-items", s["name"], sci, catalogue_item_content(sci))
+        return s["outcome"], s["name"]
+
+    results = run_items(config, "catalogue items", steps, journaled(config, destination, "catalogue", copy_catalogue_item), lambda s: s["name"])
+    skipped = [title for outcome, title in results if outcome == "skipped"]
+    created = [title for outcome, title in results if outcome == "created"]
+    missing = [title for outcome, title in results if outcome == "missing"]
 
     print(f"\nskipped catalogue items that already exist at {destination}: {skipped}")
     print(f"created new catalogue items at {destination}: {created}")
+    if missing:
+        print(f"skipped catalogue items with dependencies missing from {destination}: {missing}")
+    report = {"skipped": skipped, "created": created, "missing": missing}
+    if syncing:
+        report.update(sync_report("catalogue items", destination, results))
+    return report
 
 
 def create_catalogue_item_data(form_id=0, resource_id=0, workflow_id=0, organisation="", titles={}):
     """Create catalogue payload."""
-    for _, title in titles.items():
-        del title["id"]
-        del title["langcode"]
+    # copy titles without disallowed keys, titles belong to the source listing
+    titles = {lang: {k: v for k, v in title.items() if k not in ("id", "langcode")} for lang, title in titles.items()}
 
     payload = {
         "form": form_id,
@@ -94,90 +179,92 @@ def create_catalogue_item_data(form_id=0, resource_id=0, workflow_id=0, organisa
     return payload
 
 
+def catalogue_item_content(catalogue_item):
+    """Get the part of source catalogue item record that is compared when syncing, REMS can only edit the localizations."""
+    return {"localizations": catalogue_item.localizations}
+
+
 def post_catalogue_item(c, catalogue, env):
-    """Post catalogue to environment."""
+    """Post catalogue to environment and return the id of the created catalogue item."""
+    return call(c, env, _post_catalogue_item(c, catalogue, env))
+
+
+async def post_catalogue_item_async(c, catalogue, env):
+    """Post catalogue to environment and return the id of the created catalogue item, without blocking the event loop."""
+    return await call_async(c, env, _post_catalogue_item(c, catalogue, env))
+
+
+def _post_catalogue_item(c, catalogue, env):
     catalogue["organization"]["organization/id"] = c[env]["organisation"]
-    headers = {
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
     try:
-        response = requests.post(c[env]["url"].rstrip("/") + "/api/catalogue-items/create", headers=headers, json=catalogue)
+        response = yield "POST", "/api/catalogue-items/create", {"json": catalogue}
     except Exception as e:
         sys.exit(f"ERROR: post_catalogue_item(), {e}")
 
-    if response.status_code == 200:
-        pass
+    if response.status_code == 200 and response_json(response).get("success"):
+        catalogue_item_id = response_json(response)["id"]
+        add_created(c, env, "catalogue-items", dict(catalogue, id=catalogue_item_id, categories=catalogue.get("categories", [])))
+        return catalogue_item_id
     else:
         sys.exit(f"ABORT: post_catalogue_item() responded with {str(response.status_code)}, {response.text}")
 
 
 def put_catalogue_item(c, env, catalogue):
     """Put (update) catalogue to environment."""
-    headers = {
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
+    return call(c, env, _put_catalogue_item(c, env, catalogue))
+
+
+async def put_catalogue_item_async(c, env, catalogue):
+    """Put (update) catalogue to environment, without blocking the event loop."""
+    return await call_async(c, env, _put_catalogue_item(c, env, catalogue))
+
+
+def _put_catalogue_item(c, env, catalogue):
     try:
-        response = requests.put(c[env]["url"].rstrip("/") + "/api/catalogue-items/edit", headers=headers, json=catalogue)
+        response = yield "PUT", "/api/catalogue-items/edit", {"json": catalogue}
     except Exception as e:
         sys.exit(f"ERROR: post_catalogue_item(), {e}")
 
     if response.status_code == 200:
-        pass
+        add_updated(c, env, "catalogue-items", catalogue)
     else:
         sys.exit(f"ABORT: post_catalogue_item() responded with {str(response.status_code)}, {response.text}")
 
 
 def get_catalogue_items(c, env):
     """Get available catalogue items."""
+    return list(iter_catalogue_items(c, env))
+
+
+async def get_catalogue_items_async(c, env):
+    """Get available catalogue items, without blocking the event loop."""
     print(f"downloading catalogue items from {env}")
-    params = {
-        "disabled": "false",
-        "archived": "false",
-    }
-    headers = {
-        "accept": "application/json",
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
-    try:
-        response = requests.get(c[env]["url"].rstrip("/") + "/api/catalogue-items", headers=headers, params=params)
-    except Exception as e:
-        sys.exit(f"ERROR: get_catalogue_items({env}), {e}")
+    return await get_listing_async(c, env, "get_catalogue_items", "/api/catalogue-items", LISTING_PARAMS)
 
-    if response.status_code == 200:
-        return response.json()
-    else:
-        sys.exit(f"ABORT: get_catalogue_items({env}) responded with {str(response.status_code)}")
+
+def iter_catalogue_items(c, env):
+    """Stream available catalogue items, parsing them one at a time."""
+    print(f"downloading catalogue items from {env}")
+    yield from iter_listing(c, env, "get_catalogue_items", "/api/catalogue-items", LISTING_PARAMS)
 
 
 def get_catalogue_item(c, env, catalogue_id):
     """Get specific catalogue items."""
-    headers = {
-        "accept": "application/json",
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
+    return call(c, env, _get_catalogue_item(c, env, catalogue_id))
+
+
+async def get_catalogue_item_async(c, env, catalogue_id):
+    """Get specific catalogue items, without blocking the event loop."""
+    return await call_async(c, env, _get_catalogue_item(c, env, catalogue_id))
+
+
+def _get_catalogue_item(c, env, catalogue_id):
     try:
-        response = requests.get(c[env]["url"].rstrip("/") + f"/api/catalogue-items/{catalogue_id}", headers=headers)
+        response = yield "GET", f"/api/catalogue-items/{catalogue_id}", {}
     except Exception as e:
         sys.exit(f"ERROR: get_catalogue_item({env}), {e}")
 
     if response.status_code == 200:
-        return response.json()
+        return response_json(response)
     else:
         sys.exit(f"ABORT: get_catalogue_item({env}) responded with {str(response.status_code)}")
-
-
-def create_catalogue_item_id_translator(c, source_catalogue_items, destination_catalogue_items):
-    """Create a translation book for converting source catalogue item id to destination catalogue item id."""
-    translator = {}
-
-    for sci in source_catalogue_items:
-        for dci in destination_catalogue_items:
-            if sci["localizations"][c["language"]]["title"] == dci["localizations"][c["language"]]["title"]:
-                translator[sci["id"]] = dci["id"]
-                break
-
-    return translator
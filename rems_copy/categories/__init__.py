@@ -1,169 +1,314 @@
 """Category operations."""
 import sys
+from operator import attrgetter
 
-import requests
-
-from ..catalogue import get_catalogue_items, get_catalogue_item, create_catalogue_item_id_translator, put_catalogue_item
+from ..client import call, call_async, get_listing_async, iter_listing, response_json
+from ..catalogue import get_catalogue_item, iter_catalogue_items, put_catalogue_item
+from ..engine import run_items
+from ..index import add_created, add_updated, get_index, get_records
+from ..journal import journaled
+from ..manifest import plan_sync, record_created, run_sync, sync_report
+from ..planner import Plan, step
+from ..profiler import profiled
 
 
 def copy_categories(config, source, destination, check):
     """Copy categories from source to destination if name doesn't already exist in destination and update categories to catalogue items."""
-    source_categories = get_categories(config, source)
-    destination_categories = get_categories(config, destination)
-    destination_category_names = [dc["category/title"][config["language"]] for dc in destination_categories]
+    plan = Plan()
+    plan_categories(config, source, destination, plan)
+    return run_categories(config, source, destination, plan, check)
+
+
+def plan_categories(config, source, destination, plan):
+    """Plan copying categories from source to destination if name doesn't already exist in destination and updating categories to catalogue items."""
+    source_categories = list(get_records(config, source, "categories", iter_categories))
+    plan_category_items(config, source_categories, destination, plan)
+    source_catalogue_items = get_records(config, source, "catalogue-items", iter_catalogue_items)
+    plan_catalogue_item_categories(config, source, source_catalogue_items, source_categories, destination, plan)
+
+
+def plan_category_items(config, source_categories, destination, plan):
+    """Decide which of the list of source_categories are created at destination and which have children to update, and add the steps to plan.
+
+    source_categories are records, see records.CategoryRecord. When syncing, the titles and descriptions of categories that have changed at source since the last sync are
+    updated to destination too.
+    """
+    destination_categories = get_index(config, destination, "categories", iter_categories)
+    source_keys = {sc.id: sc.key for sc in source_categories}
+    destination_keys = {category_id: key for key, category_id in destination_categories.ids.items()}
+    syncing = config.get("manifest") is not None
+
+    def plan_category(sc):
+        title = sc.key
+        if title in destination_categories:
+            if not syncing:
+                return step("skipped", title, sc)
+            sync = plan_sync(config, destination, "categories", title, sc, category_content, True)
+            if sync["outcome"] == "changed":
+                plan.call(destination, "PUT", "/api/categories")
+            return step(sync["outcome"], title, sc, sync=sync)
+        if plan.creates(destination, "categories", title):
+            return step("skipped", title, sc)
+        plan.create(destination, "categories", title)
+        plan.call(destination, "POST", "/api/categories")
+        return step("created", title, sc)
+
+    def plan_children(sc):
+        title = sc.key
+        if not sc.children:
+            return step("skipped", title, sc)
+        children = [source_keys.get(child) for child in sc.children]
+        unresolved = unresolved_categories(destination_categories, destination, plan, sc.children, children)
+        if unresolved:
+            return step("missing", title, sc, unresolved=unresolved)
+        dc = destination_categories.get(title)
+        if dc is not None and {destination_keys.get(child) for child in dc.children or ()} == set(children):
+            return step("unchanged", title, sc)
+        plan.call(destination, "PUT", "/api/categories")
+        return step("updated", title, sc, children=children)
+
+    name = attrgetter("key")
+    plan.add(destination, "categories", run_items(config, "categories", source_categories, plan_category, name, action="planning"))
+    plan.add(destination, "category children", run_items(config, "category children", source_categories, plan_children, name, action="planning"))
+
+
+def plan_catalogue_item_categories(config, source, source_catalogue_items, source_categories, destination, plan):
+    """Decide which of source_catalogue_items need their categories updated at destination, and add the steps to plan.
+
+    source_catalogue_items and source_categories are records and source_catalogue_items can be streamed. Catalogue items whose categories already match are unchanged, and items
+    that don't exist at destination and aren't created by the plan, or have such categories, are missing.
+    """
+    destination_catalogue_items = get_index(config, destination, "catalogue-items", iter_catalogue_items)
+    destination_categories = get_index(config, destination, "categories", iter_categories)
+    source_keys = {sc.id: sc.key for sc in source_categories}
+    destination_keys = {category_id: key for key, category_id in destination_categories.ids.items()}
+
+    def plan_catalogue_item(sci):
+        title = sci.key
+        # listings carry the categories of catalogue items, details are only needed if they don't
+        source_item_categories = sci.categories if sci.categories is not None else category_ids(get_catalogue_item(config, source, sci.id))
+        if not len(source_item_categories):
+            return step("skipped", title, sci)
+        categories = [source_keys.get(category_id) for category_id in source_item_categories]
+        unresolved = unresolved_categories(destination_categories, destination, plan, source_item_categories, categories)
+        dci = destination_catalogue_items.get(title)
+        if dci is None and not plan.creates(destination, "catalogue-items", title):
+            unresolved.insert(0, f"catalogue item={title}")
+        if unresolved:
+            return step("missing", title, sci, unresolved=unresolved)
+        if dci is not None:
+            destination_item_categories = dci.categories if dci.categories is not None else category_ids(get_catalogue_item(config, destination, dci.id))
+            if set(categories) == {destination_keys.get(category_id) for category_id in destination_item_categories}:
+                return step("unchanged", title, sci)
+        plan.call(destination, "PUT", "/api/catalogue-items/edit")
+        return step("updated", title, sci, categories=categories)
+
+    steps = run_items(config, "catalogue items", source_catalogue_items, plan_catalogue_item, lambda sci: sci.key, action="planning")
+    plan.add(destination, "category catalogue items", steps)
+
+
+def run_categories(config, source, destination, plan, check):
+    """Copy categories from source to destination and update categories to catalogue items as planned, and return the names by outcome.
+
+    The categories are created first, then their children are updated and finally the categories are updated to the
+    catalogue items.
+    """
+    syncing = config.get("manifest") is not None
 
     # First run: create categories
     print("categories stage 1/3: create categories")
-    skipped = []
-    created = []
-
-    for i, sc in enumerate(source_categories):
-        sys.stdout.write(f"\rcopying categories {i+1}/{len(source_categories)}")
-        sys.stdout.flush()
-        if sc["category/title"][config["language"]] not in destination_category_names:
-            if not check:
-                post_category(config, destination, sc)
-            created.append(sc["category/title"][config["language"]])
-        else:
-            skipped.append(sc["category/title"][config["language"]])
+
+    def copy_category(s):
+        if "sync" in s:
+
+            def update(data):
+                update_category_children(config, destination, dict(category_data(destination_categories.get(s["name"])), **data))
+
+            return run_sync(config, destination, "categories", s["name"], s["sync"], update, check), s["name"]
+        if s["outcome"] == "created" and not check:
+            post_category(config, destination, s["item"].data)
+            record_created(config, destination, "categories", s["name"], s["item"], category_content(s["item"]))
+        return s["outcome"], s["name"]
+
+    with profiled(config, f"{destination}.categories-1-create"):
+        destination_categories = get_index(config, destination, "categories", iter_categories)
+        results = run_items(config, "categories", plan.steps(destination, "categories"), journaled(config, destination, "categories", copy_category), lambda s: s["name"])
+    skipped = [title for outcome, title in results if outcome == "skipped"]
+    created = [title for outcome, title in results if outcome == "created"]
 
     print(f"\nskipped categories that already exist at {destination}: {skipped}")
     print(f"created new categories at {destination}: {created}")
+    report = {"skipped": skipped, "created": created}
+    if syncing:
+        report.update(sync_report("categories", destination, results))
 
     # Second run: update category children
     print("categories stage 2/3: update category children")
-    skipped = []
-    updated = []
-
-    destination_categories = get_categories(config, destination)
-    category_id_translator = create_category_id_translator(config, source_categories, destination_categories)
-
-    for i, sc in enumerate(source_categories):
-        sys.stdout.write(f"\rupdating category children {i+1}/{len(source_categories)}")
-        sys.stdout.flush()
-        if len(sc.get("category/children", [])):
-            # Get children from source and translate to destination format
-            destination_children = sc["category/children"]
-            for dc in destination_children:
-                dc["category/id"] = category_id_translator[dc["category/id"]]
+
+    def update_category(s):
+        if s["outcome"] == "updated" and not check:
+            # the created categories are found from the match index by their match keys
+            destination_children = [{"category/id": destination_categories.id(key)} for key in s["children"]]
             # Get destination parent and send changes
-            for dc in destination_categories:
-                if category_id_translator[sc["category/id"]] == dc["category/id"]:
-                    dc["category/children"] = destination_children
-                    if not check:
-                        update_category_children(config, destination, dc)
-                    break
-            updated.append(sc["category/title"][config["language"]])
-        else:
-            skipped.append(sc["category/title"][config["language"]])
+            dc = destination_categories.get(s["name"])
+            update_category_children(config, destination, dict(category_data(dc), **{"category/children": destination_children}))
+        return s["outcome"], s["name"]
+
+    with profiled(config, f"{destination}.categories-2-children"):
+        # the index is up to date with the created categories, it is downloaded again only when the run has no inventory
+        destination_categories = get_index(config, destination, "categories", iter_categories)
+        results = run_items(config, "category children", plan.steps(destination, "category children"), journaled(config, destination, "category children", update_category), lambda s: s["name"], action="updating")
+    skipped = [title for outcome, title in results if outcome == "skipped"]
+    updated = [title for outcome, title in results if outcome == "updated"]
+    missing = [title for outcome, title in results if outcome == "missing"]
 
     print(f"\nskipped categories that don't have children at {source}: {skipped}")
     print(f"updated categories with children at {destination}: {updated}")
+    if missing:
+        print(f"skipped categories with children missing from {destination}: {missing}")
+    report["children updated"] = updated
 
     # Third run: update categories to catalogue items
     print("categories stage 3/3: update catalogue items")
-    skipped = []
-    updated = []
-
-    source_catalogue_items = get_catalogue_items(config, source)
-    destination_catalogue_items = get_catalogue_items(config, destination)
-    catalogue_item_id_translator = create_catalogue_item_id_translator(config, source_catalogue_items, destination_catalogue_items)
-
-    for i, sci in enumerate(source_catalogue_items):
-        sys.stdout.write(f"\rupdating catalogue items {i+1}/{len(source_catalogue_items)}")
-        sys.stdout.flush()
-        source_catalogue_item = get_catalogue_item(config, source, sci["id"])
-        if len(source_catalogue_item["categories"]):
-            if not check:
-                destination_catalogue_item = get_catalogue_item(config, destination, catalogue_item_id_translator[sci["id"]])
-                # Parse categories
-                categories = [{"category/id": category_id_translator[scic["category/id"]]} for scic in source_catalogue_item["categories"]]
-                # Get mandatory titles and remove disallowed keys
-                localizations = destination_catalogue_item["localizations"]
-                for _, localization in localizations.items():
-                    del localization["id"]
-                    del localization["langcode"]
-                new_catalogue_item = {
-                    "id": destination_catalogue_item["id"],
-                    "localizations": localizations,
-                    "categories": categories
-                }
-                put_catalogue_item(config, destination, new_catalogue_item)
-            updated.append(sci["localizations"][config["language"]]["title"])
-        else:
-            skipped.append(sci["localizations"][config["language"]]["title"])
+
+    def update_catalogue_item(s):
+        if s["outcome"] == "updated" and not check:
+            dci = destination_catalogue_items.get(s["name"])
+            # the catalogue item is missing if creating it failed in a run that keeps going
+            if dci is None:
+                sys.exit(f"ABORT: catalogue item {s['name']} missing from {destination}")
+            # mandatory titles, records don't have the disallowed keys
+            new_catalogue_item = {
+                "id": dci.id,
+                "localizations": dci.localizations,
+                "categories": [{"category/id": destination_categories.id(key)} for key in s["categories"]],
+            }
+            put_catalogue_item(config, destination, new_catalogue_item)
+        return s["outcome"], s["name"]
+
+    with profiled(config, f"{destination}.categories-3-catalogue-items"):
+        destination_catalogue_items = get_index(config, destination, "catalogue-items", iter_catalogue_items)
+        results = run_items(config, "catalogue items", plan.steps(destination, "category catalogue items"), journaled(config, destination, "category catalogue items", update_catalogue_item), lambda s: s["name"], action="updating")
+    skipped = [title for outcome, title in results if outcome == "skipped"]
+    unchanged = [title for outcome, title in results if outcome == "unchanged"]
+    updated = [title for outcome, title in results if outcome == "updated"]
+    missing = [title for outcome, title in results if outcome == "missing"]
 
     print(f"\nskipped catalogue items that don't have categories at {source}: {skipped}")
+    print(f"skipped catalogue items that already have the same categories at {destination}: {unchanged}")
     print(f"updated catalogue items with categories at {destination}: {updated}")
+    if missing:
+        print(f"skipped catalogue items or categories missing from {destination}: {missing}")
+    report.update({"catalogue items unchanged": unchanged, "catalogue items updated": updated, "catalogue items missing": missing})
+    return report
 
 
 def get_categories(c, env):
     """Get available categories."""
+    return list(iter_categories(c, env))
+
+
+async def get_categories_async(c, env):
+    """Get available categories, without blocking the event loop."""
     print(f"downloading categories from {env}")
+    return await get_listing_async(c, env, "get_categories", "/api/categories")
+
+
+def iter_categories(c, env):
+    """Stream available categories, parsing them one at a time."""
+    print(f"downloading categories from {env}")
+    yield from iter_listing(c, env, "get_categories", "/api/categories")
+
+
+def get_category(c, env, category_id):
+    """Get specific category."""
+    return call(c, env, _get_category(c, env, category_id))
 
-    headers = {
-        "accept": "application/json",
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
+
+async def get_category_async(c, env, category_id):
+    """Get specific category, without blocking the event loop."""
+    return await call_async(c, env, _get_category(c, env, category_id))
+
+
+def _get_category(c, env, category_id):
     try:
-        response = requests.get(c[env]["url"].rstrip("/") + "/api/categories", headers=headers)
+        response = yield "GET", f"/api/categories/{category_id}", {}
     except Exception as e:
-        sys.exit(f"ERROR: get_categories({env}), {e}")
+        sys.exit(f"ERROR: get_category({env}), {e}")
 
     if response.status_code == 200:
-        return response.json()
+        return response_json(response)
     else:
-        sys.exit(f"ABORT: get_categories({env}) responded with {str(response.status_code)}")
+        sys.exit(f"ABORT: get_category({env}) responded with {str(response.status_code)}")
+
+
+def category_content(category):
+    """Get the part of source category record that is compared when syncing, children are updated separately."""
+    return category.data
+
 
+def category_data(category):
+    """Get the data of category record to put to environment, with its id and children."""
+    return dict(category.data, **{"category/id": category.id, "category/children": [{"category/id": child} for child in category.children or ()]})
 
-def create_category_id_translator(c, source_categories, destination_categories):
-    """Create a translation book for converting source category id to destination category id."""
-    translator = {}
 
-    for sc in source_categories:
-        for dc in destination_categories:
-            if sc["category/title"][c["language"]] == dc["category/title"][c["language"]]:
-                translator[sc["category/id"]] = dc["category/id"]
-                break
+def unresolved_categories(destination_categories, destination, plan, ids, keys):
+    """List the categories with source ids and keys that don't exist at destination and aren't created by the plan.
 
-    return translator
+    Categories that aren't among the source categories have no key and are listed by their source id.
+    """
+    return [f"category id={category_id}" if key is None else f"category={key}" for category_id, key in zip(ids, keys) if key is None or (key not in destination_categories and not plan.creates(destination, "categories", key))]
+
+
+def category_ids(catalogue_item):
+    """Get the ids of the categories of catalogue item details."""
+    return [category["category/id"] for category in catalogue_item["categories"]]
 
 
 def post_category(c, env, category):
-    """Post category to environment."""
+    """Post category data without id to environment and return the id of the created category."""
+    return call(c, env, _post_category(c, env, category))
+
+
+async def post_category_async(c, env, category):
+    """Post category data without id to environment and return the id of the created category, without blocking the event loop."""
+    return await call_async(c, env, _post_category(c, env, category))
+
+
+def _post_category(c, env, category):
     # Make children empty, update them later
-    category["category/children"] = []
-    # Remove disallowed key
-    del category["category/id"]
-
-    headers = {
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
+    category = dict(category, **{"category/children": []})
+
     try:
-        response = requests.post(c[env]["url"].rstrip("/") + "/api/categories", headers=headers, json=category)
+        response = yield "POST", "/api/categories", {"json": category}
     except Exception as e:
         sys.exit(f"ERROR: post_category(), {e}")
 
-    if response.status_code == 200:
-        pass
+    if response.status_code == 200 and response_json(response).get("success"):
+        category_id = response_json(response)["category/id"]
+        add_created(c, env, "categories", dict(category, **{"category/id": category_id}))
+        return category_id
     else:
         sys.exit(f"ABORT: post_category() responded with {str(response.status_code)}, {response.text}")
 
 
 def update_category_children(c, env, category):
-    """Update category children."""
-    headers = {
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
+    """Update category, e.g. its children."""
+    return call(c, env, _update_category_children(c, env, category))
+
+
+async def update_category_children_async(c, env, category):
+    """Update category, e.g. its children, without blocking the event loop."""
+    return await call_async(c, env, _update_category_children(c, env, category))
+
+
+def _update_category_children(c, env, category):
     try:
-        response = requests.put(c[env]["url"].rstrip("/") + "/api/categories", headers=headers, json=category)
+        response = yield "PUT", "/api/categories", {"json": category}
     except Exception as e:
         sys.exit(f"ERROR: update_category_children(), {e}")
 
     if response.status_code == 200:
-        pass
+        add_updated(c, env, "categories", category)
     else:
         sys.exit(f"ABORT: update_category_children() responded with {str(response.status_code)}, {response.text}")
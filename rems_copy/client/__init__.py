@@ -0,0 +1,738 @@
+"""HTTP client operations."""
+import asyncio
+import codecs
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+import weakref
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import partial
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+try:
+    import orjson
+except ImportError:
+    # the standard library json is used if orjson isn't installed
+    orjson = None
+
+try:
+    import aiohttp
+except ImportError:
+    # the asyncio operations need aiohttp, the rest of the tool works without it
+    aiohttp = None
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 60
+STREAM_CHUNK_SIZE = 64 * 1024
+# listings are filtered to the items that are enabled and not archived
+LISTING_PARAMS = {"disabled": "false", "archived": "false"}
+
+# responses to retry, requests that are not idempotent are only retried if the response tells that they weren't processed
+RETRY_STATUSES = {429, 502, 503, 504}
+UNPROCESSED_STATUSES = {429, 503}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+_whitespace = re.compile(r"[ \t\n\r]*")
+# JSON literals, which are reported as invalid where they start when the body ends in the middle of them
+_literals = ("true", "false", "null", "NaN", "Infinity", "-Infinity")
+# the end of a number, which is reported as an unexpected character when the body ends in the middle of it
+_number_end = re.compile(r"[0-9.eE+-]+")
+
+_clients = {}
+_clients_lock = threading.Lock()
+# asyncio clients are bound to the event loop they were created in
+_async_clients = weakref.WeakKeyDictionary()
+_listeners = []
+
+
+class RateLimiter:
+    """Token bucket that lets through rate requests per second on average, and bursts of up to burst requests."""
+
+    def __init__(self, rate, burst=None):
+        """Create full bucket."""
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request may be sent.
+
+        A token is reserved before waiting, so waiting threads are let through in the order they arrived.
+        """
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Wait until a request may be sent, without blocking the event loop."""
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def _reserve(self):
+        """Reserve a token and get the seconds to wait for it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+
+class Client:
+    """Pooled HTTP client for one REMS environment, with retries and an optional rate limit."""
+
+    def __init__(
+        self,
+        env,
+        url,
+        key,
+        username,
+        pool_size=DEFAULT_POOL_SIZE,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        read_timeout=DEFAULT_READ_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        backoff=DEFAULT_BACKOFF,
+        max_backoff=DEFAULT_MAX_BACKOFF,
+        rate_limit=None,
+        burst=None,
+    ):
+        """Create session with keep-alive connection pool and prebuilt headers."""
+        self.env = env
+        self.base_url = url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limiter = RateLimiter(rate_limit, burst) if rate_limit else None
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "accept": "application/json",
+                "x-rems-api-key": key,
+                "x-rems-user-id": username,
+            }
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, path, **kwargs):
+        """Send request to path relative to the environment url.
+
+        Connection errors and transient error responses are retried with exponential backoff and jitter, or after the
+        time given by a Retry-After header. Requests that are not idempotent, like creating items, are only retried when
+        they can't have been processed. The last response is returned, or the last connection error raised.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        if "json" in kwargs:
+            # payloads are encoded with the JSON codec instead of requests
+            kwargs["data"] = dumps(kwargs.pop("json"))
+            kwargs["headers"] = {"content-type": "application/json", **kwargs.get("headers", {})}
+        idempotent = method in IDEMPOTENT_METHODS
+        stream = kwargs.get("stream", False)
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            # streamed bodies are sent again from the start when the request is retried
+            if hasattr(kwargs.get("data"), "seek"):
+                kwargs["data"].seek(0)
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, self.base_url + path, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                _notify(self.env, method, path, None, time.perf_counter() - start, _body_size(getattr(e.request, "body", None)), 0)
+                if attempt == self.retries or not (idempotent or _not_sent(e)):
+                    raise
+                wait = self._backoff(attempt)
+                reason = type(e).__name__
+            else:
+                _notify_response(response, partial(_notify, self.env, method, path, response.status_code, time.perf_counter() - start, _body_size(response.request.body)), stream)
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                if not (idempotent or response.status_code in UNPROCESSED_STATUSES):
+                    return response
+                wait = _retry_after(response)
+                if wait is None:
+                    wait = self._backoff(attempt)
+                elif wait > self.max_backoff:
+                    return response
+                reason = f"status {response.status_code}"
+                response.close()
+            print(f"\nretrying {method} {path} at {self.env} in {wait:.2f}s after {reason}")
+            time.sleep(wait)
+            attempt += 1
+
+    def _backoff(self, attempt):
+        """Get exponential backoff with full jitter."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def get(self, path, **kwargs):
+        """Send GET request."""
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        """Send POST request."""
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        """Send PUT request."""
+        return self.request("PUT", path, **kwargs)
+
+
+class AsyncClient:
+    """HTTP client for one REMS environment on asyncio, with the same retries and rate limit as Client.
+
+    Up to pool_size requests are in flight at the same time, the rest wait for a connection. Responses are read before
+    they are returned unless they are streamed.
+    """
+
+    def __init__(
+        self,
+        env,
+        url,
+        key,
+        username,
+        pool_size=DEFAULT_POOL_SIZE,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        read_timeout=DEFAULT_READ_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        backoff=DEFAULT_BACKOFF,
+        max_backoff=DEFAULT_MAX_BACKOFF,
+        rate_limit=None,
+        burst=None,
+    ):
+        """Create session with keep-alive connection pool and prebuilt headers, in the running event loop."""
+        self.env = env
+        self.base_url = url.rstrip("/")
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limiter = RateLimiter(rate_limit, burst) if rate_limit else None
+        self.session = aiohttp.ClientSession(
+            headers={
+                "accept": "application/json",
+                "x-rems-api-key": key,
+                "x-rems-user-id": username,
+            },
+            connector=aiohttp.TCPConnector(limit=pool_size),
+            # waiting for a free connection of the pool doesn't count as connecting
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout),
+        )
+
+    async def request(self, method, path, **kwargs):
+        """Send request to path relative to the environment url and return the AsyncResponse, see Client.request."""
+        stream = kwargs.pop("stream", False)
+        if "json" in kwargs:
+            kwargs["data"] = dumps(kwargs.pop("json"))
+            kwargs["headers"] = {"content-type": "application/json", **kwargs.get("headers", {})}
+        if kwargs.get("params") is not None:
+            kwargs["params"] = {k: str(v) for k, v in kwargs["params"].items()}
+        idempotent = method in IDEMPOTENT_METHODS
+        sent = _body_size(kwargs.get("data"))
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async()
+            start = time.perf_counter()
+            try:
+                response = await self.session.request(method, self.base_url + path, **kwargs)
+                seconds = time.perf_counter() - start
+                content = None if stream else await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                _notify(self.env, method, path, None, time.perf_counter() - start, sent, 0)
+                not_sent = isinstance(e, (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError))
+                if attempt == self.retries or not (idempotent or not_sent):
+                    raise
+                wait = self._backoff(attempt)
+                reason = type(e).__name__
+            else:
+                response = AsyncResponse(response, content)
+                _notify_response(response, partial(_notify, self.env, method, path, response.status_code, seconds, sent), stream)
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                if not (idempotent or response.status_code in UNPROCESSED_STATUSES):
+                    return response
+                wait = _retry_after(response)
+                if wait is None:
+                    wait = self._backoff(attempt)
+                elif wait > self.max_backoff:
+                    return response
+                reason = f"status {response.status_code}"
+                response.close()
+            print(f"\nretrying {method} {path} at {self.env} in {wait:.2f}s after {reason}")
+            await asyncio.sleep(wait)
+            attempt += 1
+
+    def _backoff(self, attempt):
+        """Get exponential backoff with full jitter."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    async def get(self, path, **kwargs):
+        """Send GET request."""
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        """Send POST request."""
+        return await self.request("POST", path, **kwargs)
+
+    async def put(self, path, **kwargs):
+        """Send PUT request."""
+        return await self.request("PUT", path, **kwargs)
+
+    async def close(self):
+        """Close the connections of the pool."""
+        await self.session.close()
+
+
+class AsyncResponse:
+    """Response of AsyncClient, with the attributes of a requests response that operations use.
+
+    content is None if the response is streamed, and its body is read in chunks with iter_content().
+    """
+
+    def __init__(self, response, content):
+        """Wrap aiohttp response with its body."""
+        self.status_code = response.status
+        self.headers = response.headers
+        self.content = content
+        self._response = response
+
+    @property
+    def text(self):
+        """Get body as text."""
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        """Decode JSON body."""
+        return json.loads(self.content)
+
+    async def iter_content(self, chunk_size=STREAM_CHUNK_SIZE):
+        """Iterate streamed body in chunks."""
+        async for chunk in self._response.content.iter_chunked(chunk_size):
+            yield chunk
+
+    def close(self):
+        """Release the connection of the response to the pool."""
+        self._response.release()
+
+
+class MultipartBody:
+    """multipart/form-data request body with one file field, read from a file in chunks while the request is sent.
+
+    requests loads the files of files= into memory, this body streams them instead. The length of the body is known,
+    so it is sent with a Content-Length header, and it can be rewound with seek() to send it again.
+    """
+
+    def __init__(self, field, filename, content_type, file, size):
+        """Create body of file with size bytes, positioned at the start of file."""
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        filename = filename.replace("\\", "\\\\").replace('"', '\\"')
+        self._head = f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\nContent-Type: {content_type}\r\n\r\n'.encode("utf-8")
+        self._tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+        self._file = file
+        self._size = size
+        self._position = 0
+        self.seek(0)
+
+    def __len__(self):
+        """Get size of body in bytes."""
+        return len(self._head) + self._size + len(self._tail)
+
+    def __iter__(self):
+        """Yield body in chunks."""
+        while True:
+            chunk = self.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def tell(self):
+        """Get position in body."""
+        return self._position
+
+    def seek(self, offset, whence=0):
+        """Move to position offset relative to the start, current position or end of body, and return the position."""
+        self._position = min(len(self), max(0, offset + (0, self._position, len(self))[whence]))
+        self._file.seek(min(self._size, max(0, self._position - len(self._head))))
+        return self._position
+
+    def read(self, size=-1):
+        """Read up to size bytes of body, or the rest of it."""
+        remaining = len(self) - self._position if size is None or size < 0 else size
+        chunks = []
+        while remaining > 0 and self._position < len(self):
+            file_start = len(self._head)
+            file_end = file_start + self._size
+            if self._position < file_start:
+                chunk = self._head[self._position:self._position + remaining]
+            elif self._position < file_end:
+                chunk = self._file.read(min(remaining, file_end - self._position))
+                if not chunk:
+                    raise ValueError(f"file ended {file_end - self._position} bytes before its size")
+            else:
+                chunk = self._tail[self._position - file_end:self._position - file_end + remaining]
+            chunks.append(chunk)
+            self._position += len(chunk)
+            remaining -= len(chunk)
+        return b"".join(chunks)
+
+
+def get_client(c, env):
+    """Get the shared client of env, creating it on first use."""
+    key = (env, c[env]["url"], c[env]["key"], c[env]["username"])
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = Client(
+                env,
+                c[env]["url"],
+                c[env]["key"],
+                c[env]["username"],
+                pool_size=c[env].get("pool_size", max(DEFAULT_POOL_SIZE, c.get("concurrency", 1))),
+                connect_timeout=c[env].get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+                read_timeout=c[env].get("read_timeout", DEFAULT_READ_TIMEOUT),
+                retries=c[env].get("retries", DEFAULT_RETRIES),
+                backoff=c[env].get("backoff", DEFAULT_BACKOFF),
+                max_backoff=c[env].get("max_backoff", DEFAULT_MAX_BACKOFF),
+                rate_limit=c[env].get("rate_limit"),
+                burst=c[env].get("burst"),
+            )
+        return _clients[key]
+
+
+def get_async_client(c, env):
+    """Get the asyncio client of env in the running event loop, creating it on first use.
+
+    The clients of an event loop are closed with close_async_clients() before the loop ends.
+    """
+    if aiohttp is None:
+        raise ImportError("asyncio operations need aiohttp, install rems-copy[async]")
+    key = (env, c[env]["url"], c[env]["key"], c[env]["username"])
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    if key not in clients:
+        clients[key] = AsyncClient(
+            env,
+            c[env]["url"],
+            c[env]["key"],
+            c[env]["username"],
+            pool_size=c[env].get("pool_size", max(DEFAULT_POOL_SIZE, c.get("concurrency", 1))),
+            connect_timeout=c[env].get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+            read_timeout=c[env].get("read_timeout", DEFAULT_READ_TIMEOUT),
+            retries=c[env].get("retries", DEFAULT_RETRIES),
+            backoff=c[env].get("backoff", DEFAULT_BACKOFF),
+            max_backoff=c[env].get("max_backoff", DEFAULT_MAX_BACKOFF),
+            rate_limit=c[env].get("rate_limit"),
+            burst=c[env].get("burst"),
+        )
+    return clients[key]
+
+
+async def close_async_clients():
+    """Close the asyncio clients of the running event loop."""
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.close()
+
+
+def call(c, env, operation):
+    """Carry out operation with the client of env and return its result.
+
+    An operation is a generator that yields one request as (method, path, keyword arguments of Client.request), is
+    sent the response or thrown the error of the request, and returns its result. An operation is written once, and
+    carried out by call() in threads and by call_async() on asyncio.
+    """
+    method, path, kwargs = next(operation)
+    try:
+        response = get_client(c, env).request(method, path, **kwargs)
+    except Exception as e:
+        return _finish(operation, operation.throw, e)
+    return _finish(operation, operation.send, response)
+
+
+async def call_async(c, env, operation):
+    """Carry out operation with the asyncio client of env and return its result, see call()."""
+    method, path, kwargs = next(operation)
+    try:
+        response = await get_async_client(c, env).request(method, path, **kwargs)
+    except Exception as e:
+        return _finish(operation, operation.throw, e)
+    return _finish(operation, operation.send, response)
+
+
+def _finish(operation, resume, value):
+    """Resume operation with the response or error of its request and get its result."""
+    try:
+        resume(value)
+    except StopIteration as e:
+        return e.value
+    operation.close()
+    raise RuntimeError("an operation makes one request")
+
+
+def iter_listing(c, env, name, path, params=None):
+    """Stream the JSON array listing at path of env and yield its items one at a time, errors are reported as name(env)."""
+    try:
+        response = get_client(c, env).get(path, params=params, stream=True)
+    except Exception as e:
+        sys.exit(f"ERROR: {name}({env}), {e}")
+
+    if response.status_code == 200:
+        with response:
+            try:
+                yield from iter_json_array(response)
+            except Exception as e:
+                sys.exit(f"ERROR: {name}({env}), {e}")
+    else:
+        sys.exit(f"ABORT: {name}({env}) responded with {response.status_code}")
+
+
+async def get_listing_async(c, env, name, path, params=None):
+    """Get the items of the JSON array listing at path of env with the asyncio client, errors are reported as name(env)."""
+    try:
+        response = await get_async_client(c, env).get(path, params=params, stream=True)
+    except Exception as e:
+        sys.exit(f"ERROR: {name}({env}), {e}")
+
+    if response.status_code == 200:
+        try:
+            return [item async for item in aiter_json_array(response)]
+        except Exception as e:
+            sys.exit(f"ERROR: {name}({env}), {e}")
+        finally:
+            response.close()
+    else:
+        response.close()
+        sys.exit(f"ABORT: {name}({env}) responded with {response.status_code}")
+
+
+def add_listener(listener):
+    """Call listener(env, method, path, status, seconds, sent, received) after every request attempt.
+
+    status is None if no response was received. seconds is the time until the response headers were received. sent and
+    received are the sizes of the request and response bodies in bytes. A successful streamed response without a
+    Content-Length header is counted when its body has been read with iter_body() or aiter_body(), and the listener is
+    called only then.
+    """
+    with _clients_lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    """Stop calling listener after requests."""
+    with _clients_lock:
+        _listeners.remove(listener)
+
+
+def _notify(env, method, path, status, seconds, sent, received):
+    for listener in list(_listeners):
+        listener(env, method, path, status, seconds, sent, received)
+
+
+def _body_size(body):
+    """Get size of request body in bytes, if it is known."""
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    if isinstance(body, bytes):
+        return len(body)
+    if hasattr(body, "__len__"):
+        return len(body)
+    return 0
+
+
+def _notify_response(response, notify, streamed):
+    """Call notify(received) with the size of the response body in bytes, without reading a streamed body.
+
+    The size of a successful streamed body without a Content-Length header is known once it has been read, so notify is
+    called by iter_body() or aiter_body() then. Other streamed bodies are not read, and are counted as empty.
+    """
+    if "Content-Length" in response.headers:
+        notify(int(response.headers["Content-Length"]))
+    elif not streamed:
+        notify(len(response.content))
+    elif response.status_code == 200:
+        response.notify_received = notify
+    else:
+        notify(0)
+
+
+def _notify_received(response, received):
+    """Call the listeners of a streamed response that has been read, see _notify_response()."""
+    notify = getattr(response, "notify_received", None)
+    if notify is not None:
+        response.notify_received = None
+        notify(received)
+
+
+def iter_body(response, chunk_size=STREAM_CHUNK_SIZE):
+    """Iterate the body of a streamed response in chunks, and count its size in the listeners once it has been read."""
+    received = 0
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            received += len(chunk)
+            yield chunk
+    finally:
+        _notify_received(response, received)
+
+
+async def aiter_body(response, chunk_size=STREAM_CHUNK_SIZE):
+    """Iterate the body of a streamed AsyncResponse in chunks, see iter_body()."""
+    received = 0
+    try:
+        async for chunk in response.iter_content(chunk_size):
+            received += len(chunk)
+            yield chunk
+    finally:
+        _notify_received(response, received)
+
+
+def _not_sent(e):
+    """Check if a connection error happened before the request was sent."""
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    return isinstance(getattr(e.args[0] if e.args else None, "reason", None), NewConnectionError)
+
+
+def _retry_after(response):
+    """Get seconds to wait from the Retry-After header of response, or None."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def dumps(data):
+    """Encode data as UTF-8 JSON, with orjson if it is installed and the standard library otherwise."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), allow_nan=False).encode("utf-8")
+
+
+def response_json(response):
+    """Decode the JSON body of response, like response.json() but with orjson if it is installed."""
+    if orjson is None:
+        return response.json()
+    return orjson.loads(response.content)
+
+
+def iter_json_array(response, chunk_size=STREAM_CHUNK_SIZE):
+    """Parse the JSON array of a streamed response and yield its elements one at a time.
+
+    Only the element being parsed and one chunk of the body are held in memory, instead of the whole body, its decoded
+    text and all of the elements at the same time. Elements are parsed with the standard library, because orjson can
+    only decode whole documents.
+    """
+    parser = _JSONArrayParser()
+    for chunk in iter_body(response, chunk_size):
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+async def aiter_json_array(response, chunk_size=STREAM_CHUNK_SIZE):
+    """Parse the JSON array of a streamed AsyncResponse and yield its elements one at a time, see iter_json_array()."""
+    parser = _JSONArrayParser()
+    async for chunk in aiter_body(response, chunk_size):
+        for item in parser.feed(chunk):
+            yield item
+    for item in parser.close():
+        yield item
+
+
+class _JSONArrayParser:
+    """Incremental parser of a JSON array that is fed the body in chunks."""
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._expect = "["
+        # an element that continues in the next chunks is parsed again once its text has doubled, so parsing takes linear time
+        self._wait = 0
+
+    def feed(self, chunk):
+        """Parse chunk and yield the elements that it completes, the elements must be consumed before the next chunk."""
+        buffer = self._buffer + self._text.decode(chunk)
+        expect = self._expect
+        decoder = self._decoder
+        position = 0
+        while True:
+            position = _whitespace.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if expect == "[":
+                if buffer[position] != "[":
+                    raise ValueError(f"expected a JSON array, found {buffer[position:position + 20]!r}")
+                position += 1
+                expect = "value or ]"
+            elif expect in (", or ]", "value or ]") and buffer[position] == "]":
+                position += 1
+                expect = "end"
+            elif expect == ", or ]":
+                if buffer[position] != ",":
+                    raise ValueError(f"expected , or ] in JSON array, found {buffer[position:position + 20]!r}")
+                position += 1
+                expect = "value"
+            elif expect == "end":
+                raise ValueError(f"unexpected data after JSON array, found {buffer[position:position + 20]!r}")
+            else:
+                if len(buffer) - position < self._wait:
+                    break
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError as e:
+                    if not _incomplete(e, buffer):
+                        raise
+                    # the element continues in the next chunk
+                    self._wait = 2 * (len(buffer) - position)
+                    break
+                if end == len(buffer) or buffer[end] in "0123456789.eE+-":
+                    # a number at the end of the buffer may continue in the next chunk
+                    break
+                position = end
+                expect = ", or ]"
+                self._wait = 0
+                yield item
+        self._buffer = buffer[position:]
+        self._expect = expect
+
+    def close(self):
+        """Yield the elements left in the buffer, and check that the whole array has been fed."""
+        self._wait = 0
+        yield from self.feed(b"")
+        if self._expect != "end":
+            raise ValueError("incomplete JSON array")
+
+
+def _incomplete(error, buffer):
+    """Check if a JSONDecodeError of buffer is caused by the buffer ending in the middle of an element, not by invalid JSON."""
+    if error.pos >= len(buffer):
+        return True
+    # strings and escapes are reported where they start
+    if error.msg.startswith("Unterminated string"):
+        return True
+    if error.msg.startswith("Invalid \\uXXXX escape") and error.pos + 5 >= len(buffer):
+        return True
+    rest = buffer[error.pos :]
+    return _number_end.fullmatch(rest) is not None or any(literal.startswith(rest) for literal in _literals)
@@ -0,0 +1,142 @@
+"""Environment diff operations."""
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+
+from ..catalogue import catalogue_item_content
+from ..categories import category_content, category_ids
+from ..engine import run_items
+from ..forms import download_form, form_content
+from ..index import KINDS, get_records, match_key
+from ..inventory import get_detail, stream_listing
+from ..licenses import license_content, strip_license
+from ..manifest import fingerprint
+from ..resources import resource_content
+from ..selection import SOURCES
+from ..workflows import workflow_content
+
+
+def diff_environments(c, source, destination):
+    """Compare the items of destination with the items of source and return the match keys by outcome of each entity type.
+
+    Items are matched by their match keys, and matching items are compared by the hashes of their contents, see
+    content_hashes(). The inventories of source and destination are downloaded at the same time. Items of source
+    that destination doesn't have are missing, items that only destination has are extra, and matching items are
+    the same or different.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        source_hashes, destination_hashes = executor.map(lambda env: get_content_hashes(c, env), [source, destination])
+    report = {}
+    for kind in KINDS:
+        source_items, destination_items = source_hashes[kind], destination_hashes[kind]
+        report[kind] = {
+            "same": sorted(key for key, digest in source_items.items() if destination_items.get(key) == digest),
+            "different": sorted(key for key, digest in source_items.items() if key in destination_items and destination_items[key] != digest),
+            "missing": sorted(key for key in source_items if key not in destination_items),
+            "extra": sorted(key for key in destination_items if key not in source_items),
+        }
+    return report
+
+
+def get_content_hashes(c, env):
+    """Get content hashes of env, computed once per run because a source is compared with every destination."""
+    inventory = c.get("inventory")
+    if inventory is None:
+        return content_hashes(c, env)
+    return inventory.get((env, "content-hashes"), lambda: content_hashes(c, env))
+
+
+def content_hashes(c, env):
+    """Get the hashes of the contents of the items of env by entity type and match key.
+
+    The contents are what copying transfers, stripped like when copying, without ids and organisations that differ
+    between environments. Dependencies are referred to by their match keys: the licenses of resources, the forms of
+    workflows, the form, resource, workflow and categories of catalogue items and the children of categories. The
+    listings of env are downloaded at the same time, and the details of forms, as many at the same time as items are
+    copied. Attachments of licenses are compared by language, not by content.
+    """
+    kinds = [kind for kind in KINDS if kind != "licenses"]
+    with ThreadPoolExecutor(max_workers=len(KINDS)) as executor:
+        licenses = executor.submit(license_hashes, c, env)
+        records = dict(zip(kinds, executor.map(lambda kind: list(get_records(c, env, kind, SOURCES[kind][0])), kinds)))
+        hashes = {"licenses": licenses.result()}
+    keys = {kind: {r.id: r.key for r in records[kind]} for kind in kinds}
+
+    def key(kind, identifier):
+        # items that aren't listed, e.g. archived forms of catalogue items, are downloaded
+        if identifier is None:
+            return None
+        if identifier not in keys[kind]:
+            keys[kind][identifier] = match_key(c, kind, get_detail(c, env, kind, identifier, SOURCES[kind][1]))
+        return keys[kind][identifier]
+
+    def form(r):
+        return r.key, fingerprint(form_content(download_form(c, env, r.id)))
+
+    def catalogue_item(r):
+        categories = r.categories if r.categories is not None else category_ids(get_detail(c, env, "catalogue-items", r.id, SOURCES["catalogue-items"][1]))
+        return fingerprint(
+            dict(
+                catalogue_item_content(r),
+                form=key("forms", r.formid),
+                resource=r.resid if r.resid is not None else key("resources", r.resource_id),
+                workflow=key("workflows", r.wfid),
+                categories=sorted(key("categories", category) for category in categories),
+            )
+        )
+
+    hashes["forms"] = dict(run_items(c, f"forms of {env}", records["forms"], form, attrgetter("key"), action="comparing"))
+    hashes["resources"] = _hashes(records["resources"], lambda r: fingerprint({"licenses": sorted(resource_content(r)["licenses"])}))
+    hashes["workflows"] = _hashes(records["workflows"], lambda r: fingerprint(workflow_content(r)))
+    hashes["catalogue-items"] = _hashes(records["catalogue-items"], catalogue_item)
+    hashes["categories"] = _hashes(records["categories"], lambda r: fingerprint(dict(category_content(r), children=sorted(key("categories", child) for child in r.children or ()))))
+    return hashes
+
+
+def license_hashes(c, env):
+    """Get the hashes of the contents of the licenses of env by match key, hashing them while streaming the listing."""
+    hashes = {}
+    for item in stream_listing(c, env, "licenses", SOURCES["licenses"][0]):
+        license = strip_license(item)
+        # attachments have different ids in every environment
+        localizations = {language: dict(localization, **{"attachment-id": True}) if localization.get("attachment-id") is not None else localization for language, localization in license["localizations"].items()}
+        hashes.setdefault(match_key(c, "licenses", item), fingerprint(license_content(dict(license, localizations=localizations))))
+    return hashes
+
+
+def _hashes(records, digest):
+    """Get digest(record) by match key, the first of the records that share a match key is compared."""
+    hashes = {}
+    for r in records:
+        if r.key not in hashes:
+            hashes[r.key] = digest(r)
+    return hashes
+
+
+def differs(report):
+    """Check if the diff report of a destination has missing, extra or different items."""
+    return any(outcomes["different"] or outcomes["missing"] or outcomes["extra"] for outcomes in report.values())
+
+
+def print_diff(source, destination, report):
+    """Print number of items by outcome of each entity type and the match keys of the items that differ."""
+    print(f"\ndiff of {destination} with {source}:")
+    for kind, outcomes in report.items():
+        print(f"  {kind:<16} " + ", ".join(f"{outcome} {len(keys)}" for outcome, keys in outcomes.items()))
+        for outcome in ("different", "missing", "extra"):
+            if outcomes[outcome]:
+                print(f"    {outcome}: {outcomes[outcome]}")
+
+
+def write_diff(path, source, reports):
+    """Write the diff reports of the destinations to path as JSON, with the number of same items instead of their keys."""
+    data = {
+        "source": source,
+        "destinations": {destination: {kind: dict(outcomes, same=len(outcomes["same"])) for kind, outcomes in report.items()} for destination, report in reports.items()},
+    }
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+    except OSError as e:
+        sys.exit(f"ERROR: write_diff({path}), {e}")
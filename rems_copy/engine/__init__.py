@@ -0,0 +1,134 @@
+"""Copy engine operations."""
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# a response is a latency spike if it is slower than LATENCY_TOLERANCE times the baseline plus LATENCY_SLACK seconds
+LATENCY_TOLERANCE = 2.0
+LATENCY_SLACK = 0.01
+# how fast the baseline latency follows responses that are slower than it
+BASELINE_DRIFT = 0.01
+DECREASE_FACTOR = 0.5
+
+
+class AdaptiveConcurrency:
+    """Additive increase, multiplicative decrease (AIMD) controller of the number of items in flight.
+
+    The limit starts at minimum and grows by one item per successful response until the first sign of congestion, and
+    after that by one item per round of limit successful responses. 429 and 5xx responses, connection errors and
+    latency spikes halve the limit, at most once per round. Feed it with client.add_listener(controller.observe).
+    """
+
+    def __init__(self, maximum, minimum=1):
+        """Create controller with limit between minimum and maximum."""
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.low = self.high = minimum
+        self.decreases = 0
+        self._limit = float(minimum)
+        self._slow_start = True
+        self._baseline = None
+        self._since_decrease = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        """Get current number of items that may be in flight."""
+        return int(self._limit)
+
+    def observe(self, env, method, path, status, seconds, sent, received):
+        """Adjust limit after a request attempt."""
+        congested = status is None or status == 429 or status >= 500
+        with self._lock:
+            if not congested:
+                if self._baseline is None or seconds < self._baseline:
+                    self._baseline = seconds
+                else:
+                    self._baseline += (seconds - self._baseline) * BASELINE_DRIFT
+                congested = seconds > self._baseline * LATENCY_TOLERANCE + LATENCY_SLACK
+            self._since_decrease += 1
+            if congested:
+                if self._since_decrease >= self._limit:
+                    self._limit = max(self.minimum, self._limit * DECREASE_FACTOR)
+                    self._slow_start = False
+                    self._since_decrease = 0
+                    self.decreases += 1
+            elif self._slow_start:
+                self._limit = min(self.maximum, self._limit + 1)
+            else:
+                self._limit = min(self.maximum, self._limit + 1 / self._limit)
+            self.low = min(self.low, self.limit)
+            self.high = max(self.high, self.limit)
+
+    def summary(self):
+        """Describe how the limit has changed."""
+        return f"concurrency {self.limit} at the end, between {self.low} and {self.high}, decreased {self.decreases} times"
+
+
+def run_items(config, label, items, work, name, action="copying"):
+    """Run work(item) for every item and return the results in item order, see iter_items()."""
+    return list(iter_items(config, label, items, work, name, action=action))
+
+
+def iter_items(config, label, items, work, name, action="copying"):
+    """Run work(item) for every item and yield the results in item order.
+
+    At most config["concurrency"] items are in flight at the same time, or as many as the AdaptiveConcurrency
+    controller in config["controller"] allows. items can be any iterable, it is consumed only as fast as the work gets
+    done, so items can be streamed. If work exits or raises for an item, the items already in flight are allowed to
+    finish, no new items are started and the run is aborted with a message naming the failed item.
+    """
+    concurrency = max(1, config.get("concurrency", 1))
+    controller = config.get("controller")
+    total = len(items) if hasattr(items, "__len__") else None
+
+    if concurrency == 1:
+        for i, item in enumerate(items):
+            _progress(action, label, i, total)
+            try:
+                result = work(item)
+            except (SystemExit, Exception) as e:
+                _abort(action, label, name(item), e)
+            yield result
+        return
+
+    failure = None
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = deque()
+        pending = enumerate(items)
+        while True:
+            limit = controller.limit if controller is not None else concurrency
+            while failure is None and len(in_flight) < limit:
+                try:
+                    i, item = next(pending)
+                except StopIteration:
+                    break
+                _progress(action, label, i, total, controller)
+                in_flight.append((item, executor.submit(work, item)))
+            if not in_flight:
+                break
+            item, future = in_flight.popleft()
+            try:
+                result = future.result()
+            except (SystemExit, Exception) as e:
+                if failure is None:
+                    failure = (item, e)
+                continue
+            if failure is None:
+                yield result
+    if failure is not None:
+        _abort(action, label, name(failure[0]), failure[1])
+
+
+def _progress(action, label, i, total, controller=None):
+    progress = f"{i+1}/{total}" if total is not None else f"{i+1}"
+    if controller is not None:
+        progress += f" (concurrency {controller.limit})"
+    sys.stdout.write(f"\r{action} {label} {progress}")
+    sys.stdout.flush()
+
+
+def _abort(action, label, item_name, e):
+    reason = e.code if isinstance(e, SystemExit) else repr(e)
+    sys.exit(f"\nABORT: {action} {label} failed at item={item_name}: {reason}")
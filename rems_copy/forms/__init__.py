@@ -1,114 +1,215 @@
 """Form operations."""
 import sys
+from functools import partial
 
-import requests
+from ..client import LISTING_PARAMS, call, call_async, get_listing_async, iter_listing, response_json
+from ..engine import run_items
+from ..index import add_created, add_updated, get_index, get_records
+from ..inventory import get_detail, get_detail_async
+from ..journal import journaled
+from ..manifest import plan_sync, record_created, run_sync, sync_report
+from ..planner import Plan, step
 
 
 def copy_forms(config, source, destination, check):
     """Copy forms from source to destination if name doesn't already exist in destination."""
-    source_forms = get_forms(config, source)
-    destination_forms = get_forms(config, destination)
-    destination_form_names = [df["form/internal-name"] for df in destination_forms]
-
-    skipped = []
-    created = []
-
-    for i, sf in enumerate(source_forms):
-        sys.stdout.write(f"\rcopying forms {i+1}/{len(source_forms)}")
-        sys.stdout.flush()
-        if sf["form/internal-name"] not in destination_form_names:
-            if not check:
-                form_data = download_form(config, source, sf["form/id"])
-                post_form(config, form_data, destination)
-            created.append(sf["form/internal-name"])
-        else:
-            skipped.append(sf["form/internal-name"])
+    plan = Plan()
+    plan_forms(config, source, destination, plan)
+    return run_forms(config, source, destination, plan, check)
+
+
+def plan_forms(config, source, destination, plan):
+    """Plan copying forms from source to destination if name doesn't already exist in destination."""
+    source_forms = get_records(config, source, "forms", iter_forms)
+    steps = plan_form_items(config, source_forms, destination, plan, lambda sf: download_form(config, source, sf.id))
+    for s in steps:
+        if s["outcome"] == "created":
+            plan.fetch(source, "forms", s["item"].id, f"/api/forms/{s['item'].id}")
+
+
+def run_forms(config, source, destination, plan, check):
+    """Copy forms from source to destination as planned and return the names by outcome."""
+    return run_form_steps(config, plan.steps(destination, "forms"), destination, check, lambda sf: download_form(config, source, sf.id))
+
+
+def copy_form_items(config, source_forms, destination, check, download):
+    """Copy source_forms to destination if name doesn't already exist in destination and return the names by outcome.
+
+    source_forms are records, see records.FormRecord, and can be streamed. download(form) returns the form data to
+    post, see download_form().
+    """
+    plan = Plan()
+    plan_form_items(config, source_forms, destination, plan, download)
+    return run_form_steps(config, plan.steps(destination, "forms"), destination, check, download)
+
+
+def plan_form_items(config, source_forms, destination, plan, download):
+    """Decide what happens to each of source_forms at destination, add the steps to plan and return them.
+
+    When syncing, forms that have changed at source since the last sync are updated to destination too.
+    """
+    destination_forms = get_index(config, destination, "forms", iter_forms)
+    syncing = config.get("manifest") is not None
+
+    def plan_form(sf):
+        name = sf.key
+        if name in destination_forms:
+            if not syncing:
+                return step("skipped", name, sf)
+            sync = plan_sync(config, destination, "forms", name, sf, lambda sf: form_content(download(sf)), True)
+            if sync["outcome"] == "changed":
+                plan.call(destination, "PUT", "/api/forms/edit")
+            return step(sync["outcome"], name, sf, sync=sync)
+        if plan.creates(destination, "forms", name):
+            return step("skipped", name, sf)
+        plan.create(destination, "forms", name)
+        plan.call(destination, "POST", "/api/forms/create")
+        return step("created", name, sf)
+
+    steps = run_items(config, "forms", source_forms, plan_form, lambda sf: sf.key, action="planning")
+    plan.add(destination, "forms", steps)
+    return steps
+
+
+def run_form_steps(config, steps, destination, check, download):
+    """Carry out the form steps of a plan at destination and return the names by outcome."""
+    destination_forms = get_index(config, destination, "forms", iter_forms)
+    syncing = config.get("manifest") is not None
+
+    def copy_form(s):
+        if "sync" in s:
+            update = partial(put_form, config, destination, destination_forms.id(s["name"]))
+            return run_sync(config, destination, "forms", s["name"], s["sync"], update, check), s["name"]
+        if s["outcome"] == "created" and not check:
+            form_data = download(s["item"])
+            content = form_content(form_data)
+            post_form(config, form_data, destination)
+            record_created(config, destination, "forms", s["name"], s["item"], content)
+        return s["outcome"], s["name"]
+
+    results = run_items(config, "forms", steps, journaled(config, destination, "forms", copy_form), lambda s: s["name"])
+    skipped = [name for outcome, name in results if outcome == "skipped"]
+    created = [name for outcome, name in results if outcome == "created"]
 
     print(f"\nskipped forms that already exist at {destination}: {skipped}")
     print(f"created new forms at {destination}: {created}")
+    report = {"skipped": skipped, "created": created}
+    if syncing:
+        report.update(sync_report("forms", destination, results))
+    return report
 
 
 def download_form(c, env, form_id):
-    """Download form data."""
-    headers = {
-        "accept": "application/json",
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
-    try:
-        response = requests.get(c[env]["url"].rstrip("/") + f"/api/forms/{form_id}", headers=headers)
-    except Exception as e:
-        sys.exit(f"ERROR: download_form({env}, {form_id}), {e}")
+    """Download form data, details are downloaded once when they are shared between destinations."""
+    return strip_form(get_detail(c, env, "forms", form_id, get_form))
 
-    if response.status_code == 200:
-        form = response.json()
-        # remove forbidden keys
-        del form["form/title"]
-        del form["form/id"]
-        del form["organization"]["organization/short-name"]
-        del form["organization"]["organization/name"]
-        del form["form/errors"]
-        del form["enabled"]
-        del form["archived"]
-        return form
-    else:
-        sys.exit(f"ABORT: download_form({env}, {form_id}) responded with {response.status_code}")
+
+async def download_form_async(c, env, form_id):
+    """Download form data, without blocking the event loop."""
+    return strip_form(await get_detail_async(c, env, "forms", form_id, get_form_async))
+
+
+def strip_form(form):
+    """Copy form without the keys that are not allowed when posting it."""
+    form = dict(form, organization=dict(form["organization"]))
+    # remove forbidden keys
+    del form["form/title"]
+    del form["form/id"]
+    del form["organization"]["organization/short-name"]
+    del form["organization"]["organization/name"]
+    del form["form/errors"]
+    del form["enabled"]
+    del form["archived"]
+    return form
+
+
+def form_content(form):
+    """Get the part of stripped form data that is compared when syncing, organisations differ between environments."""
+    return {k: v for k, v in form.items() if k != "organization"}
 
 
 def post_form(c, form, env):
-    """Post form to environment."""
+    """Post form to environment and return the id of the created form."""
+    return call(c, env, _post_form(c, form, env))
+
+
+async def post_form_async(c, form, env):
+    """Post form to environment and return the id of the created form, without blocking the event loop."""
+    return await call_async(c, env, _post_form(c, form, env))
+
+
+def _post_form(c, form, env):
     form["organization"]["organization/id"] = c[env]["organisation"]
-    headers = {
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
     try:
-        response = requests.post(c[env]["url"].rstrip("/") + "/api/forms/create", headers=headers, json=form)
+        response = yield "POST", "/api/forms/create", {"json": form}
     except Exception as e:
         sys.exit(f"ERROR: post_form(), {e}")
 
-    if response.status_code == 200:
-        pass
+    if response.status_code == 200 and response_json(response).get("success"):
+        form_id = response_json(response)["id"]
+        add_created(c, env, "forms", dict(form, **{"form/id": form_id}))
+        return form_id
     else:
         sys.exit(f"ABORT: post_form() responded with {response.status_code}, {response.text}")
 
 
-def get_forms(c, env):
-    """Get available forms."""
-    print(f"downloading forms from {env}")
-    params = {
-        "disabled": "false",
-        "archived": "false",
-    }
-    headers = {
-        "accept": "application/json",
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
+def put_form(c, env, form_id, form):
+    """Put (update) form with form_id to environment."""
+    return call(c, env, _put_form(c, env, form_id, form))
+
+
+async def put_form_async(c, env, form_id, form):
+    """Put (update) form with form_id to environment, without blocking the event loop."""
+    return await call_async(c, env, _put_form(c, env, form_id, form))
+
+
+def _put_form(c, env, form_id, form):
+    form = dict(form, **{"form/id": form_id, "organization": {"organization/id": c[env]["organisation"]}})
     try:
-        response = requests.get(c[env]["url"].rstrip("/") + "/api/forms", headers=headers, params=params)
+        response = yield "PUT", "/api/forms/edit", {"json": form}
     except Exception as e:
-        sys.exit(f"ERROR: get_forms({env}), {e}")
+        sys.exit(f"ERROR: put_form(), {e}")
 
-    if response.status_code == 200:
-        return response.json()
+    if response.status_code == 200 and response_json(response).get("success"):
+        add_updated(c, env, "forms", form)
     else:
-        sys.exit(f"ABORT: get_forms({env}) responded with {response.status_code}")
+        sys.exit(f"ABORT: put_form() responded with {response.status_code}, {response.text}")
+
+
+def get_forms(c, env):
+    """Get available forms."""
+    return list(iter_forms(c, env))
+
+
+async def get_forms_async(c, env):
+    """Get available forms, without blocking the event loop."""
+    print(f"downloading forms from {env}")
+    return await get_listing_async(c, env, "get_forms", "/api/forms", LISTING_PARAMS)
+
+
+def iter_forms(c, env):
+    """Stream available forms, parsing them one at a time."""
+    print(f"downloading forms from {env}")
+    yield from iter_listing(c, env, "get_forms", "/api/forms", LISTING_PARAMS)
 
 
 def get_form(c, env, form_id):
     """Get specific form."""
-    headers = {
-        "accept": "application/json",
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
+    return call(c, env, _get_form(c, env, form_id))
+
+
+async def get_form_async(c, env, form_id):
+    """Get specific form, without blocking the event loop."""
+    return await call_async(c, env, _get_form(c, env, form_id))
+
+
+def _get_form(c, env, form_id):
     try:
-        response = requests.get(c[env]["url"].rstrip("/") + f"/api/forms/{form_id}", headers=headers)
+        response = yield "GET", f"/api/forms/{form_id}", {}
     except Exception as e:
         sys.exit(f"ERROR: get_form({env}), {e}")
 
     if response.status_code == 200:
-        return response.json()
+        return response_json(response)
     else:
         sys.exit(f"ABORT: get_form({env}) responded with {response.status_code}")
@@ -0,0 +1,189 @@
+"""Matching index operations."""
+from ..manifest import fingerprint
+from ..records import RECORDS
+
+
+def license_key(c, item):
+    """Get match key of license."""
+    return item["localizations"][c["language"]]["title"]
+
+
+def form_key(c, item):
+    """Get match key of form."""
+    return item["form/internal-name"]
+
+
+def resource_key(c, item):
+    """Get match key of resource."""
+    return item["resid"]
+
+
+def workflow_key(c, item):
+    """Get match key of workflow."""
+    return item["title"]
+
+
+def catalogue_item_key(c, item):
+    """Get match key of catalogue item."""
+    return item["localizations"][c["language"]]["title"]
+
+
+def category_key(c, item):
+    """Get match key of category."""
+    return item["category/title"][c["language"]]
+
+
+# match key function and id field of each entity type
+KINDS = {
+    "licenses": (license_key, "id"),
+    "forms": (form_key, "form/id"),
+    "resources": (resource_key, "id"),
+    "workflows": (workflow_key, "id"),
+    "catalogue-items": (catalogue_item_key, "id"),
+    "categories": (category_key, "category/id"),
+}
+
+
+def match_key(c, kind, item):
+    """Get match key of item of kind."""
+    return KINDS[kind][0](c, item)
+
+
+def to_record(c, kind, item, listing=False):
+    """Project item of kind to its compact record, with the fingerprint of the item as listed if listing is True."""
+    return RECORDS[kind](c, item, match_key(c, kind, item), fingerprint(item) if listing else None)
+
+
+class MatchIndex:
+    """Compact records of the items of one entity type indexed by their match key.
+
+    If several items share a match key, the first one is matched and the rest are reported as duplicates.
+    """
+
+    def __init__(self, c, kind, items, env=""):
+        """Index items and report duplicate match keys."""
+        self.kind = kind
+        self.key, self.id_field = KINDS[kind]
+        self.items = {}
+        self.ids = {}
+        self.duplicates = {}
+        for item in items:
+            self.add(c, item)
+        if self.duplicates:
+            print(f"\nWARNING: {kind} at {env} have duplicate match keys, only the first item of each key is matched: {self.duplicates}")
+
+    def add(self, c, item):
+        """Add record of item to the index, unless its match key is already taken."""
+        key = self.key(c, item)
+        if key in self.items:
+            self.duplicates.setdefault(key, [self.ids[key]]).append(item[self.id_field])
+            return
+        self.items[key] = RECORDS[self.kind](c, item, key)
+        self.ids[key] = item[self.id_field]
+
+    def update(self, c, item):
+        """Update the record with the match key of item with the fields of item, or add it if there is none."""
+        key = self.key(c, item)
+        if key not in self.items:
+            self.add(c, item)
+            return
+        self.items[key].update(c, item)
+
+    def __contains__(self, key):
+        """Check if an item with key exists."""
+        return key in self.items
+
+    def __len__(self):
+        """Get number of unique keys."""
+        return len(self.items)
+
+    def get(self, key):
+        """Get record of item with key or None."""
+        return self.items.get(key)
+
+    def id(self, key):
+        """Get id of item with key or None."""
+        return self.ids.get(key)
+
+
+def get_records(c, env, kind, stream):
+    """Iterate compact records of the listing of kind from env, projecting them item by item while streaming the listing with stream(c, env).
+
+    Records carry the listing fingerprints of the items when syncing. The records are cached for the rest of the run
+    instead of the listing, so that the listing is downloaded only once and the decoded JSON is not kept in memory. The
+    first pass streams the listing and caches the records when it is complete, and when the run copies to several
+    destinations the records are downloaded by one thread while the others wait for them. A listing already cached in
+    this run, e.g. of selected items, is projected instead.
+    """
+    listing = c.get("manifest") is not None
+    inventory = c.get("inventory")
+    if inventory is None:
+        return (to_record(c, kind, item, listing) for item in stream(c, env))
+    records = inventory.peek((env, kind, "records"))
+    if records is not None:
+        return iter(records)
+    cached = inventory.peek((env, kind))
+    if cached is not None:
+        return (to_record(c, kind, item, listing) for item in cached)
+    if inventory.shared:
+        return iter(inventory.get((env, kind, "records"), lambda: [to_record(c, kind, item, listing) for item in stream(c, env)]))
+    return _caching_records(inventory, (env, kind, "records"), (to_record(c, kind, item, listing) for item in stream(c, env)))
+
+
+def _caching_records(inventory, key, records):
+    """Iterate records and cache them to inventory as key once all of them have been iterated."""
+    cached = []
+    for r in records:
+        cached.append(r)
+        yield r
+    inventory.put(key, cached)
+
+
+def get_index(c, env, kind, stream):
+    """Get match index of the listing of kind from env, built once per run while streaming the listing with stream(c, env).
+
+    Only the index is kept, the listing is not cached for it. A listing already cached in this run is indexed instead.
+    """
+    inventory = c.get("inventory")
+    if inventory is None:
+        return MatchIndex(c, kind, stream(c, env), env)
+
+    def build():
+        cached = inventory.peek((env, kind))
+        return MatchIndex(c, kind, cached if cached is not None else stream(c, env), env)
+
+    return inventory.get((env, kind, "index"), build)
+
+
+def add_created(c, env, kind, item):
+    """Add an item that was just created in env to the cached match index of kind.
+
+    The cached listing is forgotten, but the index is kept up to date, so later stages can resolve the new item without
+    downloading the listing again.
+    """
+    inventory = c.get("inventory")
+    if inventory is None:
+        return
+    inventory.invalidate((env, kind), keep=[(env, kind, "index")])
+    index = inventory.peek((env, kind, "index"))
+    if index is not None:
+        index.add(c, item)
+
+
+def add_updated(c, env, kind, item):
+    """Update the cached match index of kind with the fields of an item that was just edited in env, like add_created()."""
+    inventory = c.get("inventory")
+    if inventory is None:
+        return
+    inventory.invalidate((env, kind), keep=[(env, kind, "index")])
+    index = inventory.peek((env, kind, "index"))
+    if index is not None:
+        index.update(c, item)
+
+
+def get_key_index(c, env, kind, stream):
+    """Get match keys of the listing of kind from env by item id, built once per run from the records of the listing, see get_records()."""
+    inventory = c.get("inventory")
+    if inventory is None:
+        return {r.id: r.key for r in get_records(c, env, kind, stream)}
+    return inventory.get((env, kind, "keys"), lambda: {r.id: r.key for r in get_records(c, env, kind, stream)})
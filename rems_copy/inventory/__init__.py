@@ -0,0 +1,111 @@
+"""Inventory cache operations."""
+import threading
+
+
+class Inventory:
+    """Listings downloaded during one run and data derived from them, keyed by (environment, entity type, ...)."""
+
+    def __init__(self, shared=False):
+        """Create empty inventory, shared inventories cache item details and all listings because they are needed more than once."""
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._listings = {}
+        self._fetch_locks = {}
+
+    def get(self, key, fetch):
+        """Get listing of key, calling fetch() if it hasn't been downloaded yet.
+
+        Only one thread downloads a given listing, other threads asking for it wait for the result.
+        """
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+        with fetch_lock:
+            with self._lock:
+                if key in self._listings:
+                    return self._listings[key]
+            listing = fetch()
+            with self._lock:
+                self._listings[key] = listing
+            return listing
+
+    def peek(self, key):
+        """Get cached value of key or None, without downloading anything."""
+        with self._lock:
+            return self._listings.get(key)
+
+    def put(self, key, listing):
+        """Replace listing of key, forgetting anything derived from it."""
+        self.invalidate(key)
+        with self._lock:
+            self._listings[key] = listing
+
+    def invalidate(self, key, keep=()):
+        """Forget listing of key and anything derived from it except the keys in keep, so that it is downloaded again when it is needed next time."""
+        with self._lock:
+            for cached in [cached for cached in self._listings if cached[: len(key)] == key and cached not in keep]:
+                del self._listings[cached]
+
+
+def get_listing(c, env, kind, fetch):
+    """Get listing of kind from env, downloading it with fetch(c, env) unless it is already cached in this run.
+
+    Listings are shared between stages and must not be modified by the caller.
+    """
+    inventory = c.get("inventory")
+    if inventory is None:
+        return fetch(c, env)
+    return inventory.get((env, kind), lambda: fetch(c, env))
+
+
+def stream_listing(c, env, kind, stream):
+    """Iterate listing of kind from env, parsing it item by item from a new response with stream(c, env).
+
+    A listing already cached in this run is used instead. When the run copies to several destinations, the listing is
+    cached like with get_listing(), so that it is downloaded only once. Otherwise the listing is not kept in memory, and
+    every call downloads it again.
+    """
+    inventory = c.get("inventory")
+    if inventory is None:
+        return stream(c, env)
+    listing = inventory.peek((env, kind))
+    if listing is not None:
+        return iter(listing)
+    if inventory.shared:
+        return iter(get_listing(c, env, kind, lambda c, env: list(stream(c, env))))
+    return stream(c, env)
+
+
+def get_detail(c, env, kind, identifier, fetch):
+    """Get details of item of kind from env with fetch(c, env, identifier).
+
+    When the run copies to several destinations, details are cached so that they are downloaded only once. Details
+    that are already cached, e.g. of selected items, are used in any case. Details are shared between destinations and
+    must not be modified by the caller.
+    """
+    inventory = c.get("inventory")
+    if inventory is None:
+        return fetch(c, env, identifier)
+    detail = inventory.peek((env, kind, "detail", identifier))
+    if detail is not None:
+        return detail
+    if not inventory.shared:
+        return fetch(c, env, identifier)
+    return inventory.get((env, kind, "detail", identifier), lambda: fetch(c, env, identifier))
+
+
+async def get_detail_async(c, env, kind, identifier, fetch):
+    """Get details of item of kind from env with await fetch(c, env, identifier), cached like with get_detail().
+
+    Items are not locked while their details are downloaded, so details asked for at the same time may be downloaded
+    more than once.
+    """
+    inventory = c.get("inventory")
+    if inventory is None:
+        return await fetch(c, env, identifier)
+    detail = inventory.peek((env, kind, "detail", identifier))
+    if detail is not None:
+        return detail
+    detail = await fetch(c, env, identifier)
+    if inventory.shared:
+        inventory.put((env, kind, "detail", identifier), detail)
+    return detail
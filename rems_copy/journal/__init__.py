@@ -0,0 +1,169 @@
+"""Run journal operations."""
+import json
+import os
+import sys
+import threading
+from datetime import datetime, timezone
+
+JOURNAL_VERSION = 1
+# outcomes of plan steps that write to the destination
+OPERATIONS = {"created", "changed", "updated"}
+
+
+class Journal:
+    """Append-only JSON lines log of the runs of one command and the operations they plan and carry out.
+
+    Every run appends a "run" event with its command, a "planned" event for every operation that the plan writes to
+    a destination, a "done" or "failed" event when the operation has been carried out, a "stage" event when a stage
+    has finished at a destination and a "finished" event at the end. Events are flushed as they are written, so the
+    journal is complete up to the last operation if the run crashes or is killed. A resumed run reads the events of
+    the run it resumes, and of the runs that resumed it before, to skip the stages that have been completed.
+    """
+
+    def __init__(self, path, command, resume=False, write=True):
+        """Open journal at path for a run of command, resuming the last run of the journal if resume is True.
+
+        A journal that isn't written, e.g. in a dry run, only collects the failures of the run.
+        """
+        self.path = path
+        self.command = command
+        self._lock = threading.Lock()
+        self._completed = set()
+        self._failures = []
+        self._file = None
+        if resume:
+            self._resume()
+        if write:
+            try:
+                self._file = open(path, "a", encoding="utf-8")
+            except OSError as e:
+                sys.exit(f"ERROR: Journal({path}), {e}")
+            self._write("run", version=JOURNAL_VERSION, command=command, resume=resume)
+
+    def _resume(self):
+        """Read the completed stages of the last run of the journal, which must have been run with the same command."""
+        events = _read(self.path)
+        starts = [i for i, event in enumerate(events) if event["event"] == "run" and not event["resume"]]
+        if not starts:
+            sys.exit(f"ABORT: {self.path} has no run to resume")
+        chain = events[starts[-1]:]
+        if chain[0]["command"] != self.command:
+            sys.exit(f"ABORT: the last run in {self.path} was run with {chain[0]['command']}, it can only be resumed with the same command")
+        last = [i for i, event in enumerate(chain) if event["event"] == "run"][-1]
+        finished = [event for event in chain[last:] if event["event"] == "finished"]
+        if finished and not finished[0]["failed"] and not finished[0]["errors"]:
+            sys.exit(f"ABORT: the last run in {self.path} finished without failures, there is nothing to resume")
+
+        self._completed = {(event["destination"], event["stage"]) for event in chain if event["event"] == "stage" and not event["failed"]}
+        planned = {(event["destination"], event["stage"], event["name"]) for event in chain[last:] if event["event"] == "planned"}
+        carried_out = {(event["destination"], event["stage"], event["name"]) for event in chain[last:] if event["event"] in ("done", "failed")}
+        print(f"resuming the run started at {chain[0]['time']} from {self.path}")
+        if not finished and planned - carried_out:
+            print(f"{len(planned - carried_out)} planned operations were not carried out, they are planned again from the destination")
+
+    def completed(self, destination, stage):
+        """Check if stage was completed at destination without failures by the run that is resumed."""
+        return (destination, stage) in self._completed
+
+    def planned(self, destination, plan):
+        """Journal the operations of the plan for destination before carrying them out."""
+        for stage, steps in plan.stages(destination):
+            for s in steps:
+                if s["outcome"] in OPERATIONS:
+                    self._write("planned", destination=destination, stage=stage, name=s["name"], outcome=s["outcome"])
+
+    def done(self, destination, stage, name, outcome):
+        """Journal an operation carried out at destination."""
+        self._write("done", destination=destination, stage=stage, name=name, outcome=outcome)
+
+    def failed(self, destination, stage, name, reason):
+        """Journal an item of stage that failed at destination, and remember it for the error report."""
+        with self._lock:
+            self._failures.append((destination, stage, name, reason))
+        self._write("failed", destination=destination, stage=stage, name=name, reason=reason)
+
+    def stage(self, destination, stage, failed):
+        """Journal a stage that has finished at destination, with the number of items that failed."""
+        self._write("stage", destination=destination, stage=stage, failed=failed)
+
+    def failures(self, destination=None, stages=None):
+        """Get (destination, stage, name, reason) of the items that failed in this run, at destination and in plan stages if they are given."""
+        with self._lock:
+            return [f for f in self._failures if destination in (None, f[0]) and (stages is None or f[1] in stages)]
+
+    def finish(self, failed):
+        """Journal the end of the run, with the reasons of the destinations that failed, and close the journal."""
+        self._write("finished", failed=failed, errors=len(self.failures()))
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def print_errors(self):
+        """Print the items that failed in this run by destination and stage."""
+        failures = self.failures()
+        if not failures:
+            return
+        print(f"\nerror report, {len(failures)} items failed:")
+        for destination, stage, name, reason in failures:
+            print(f"  {destination:<12} {stage:<12} {name}: {reason}")
+
+    def _write(self, event, **fields):
+        with self._lock:
+            if self._file is None:
+                return
+            record = {"event": event, "time": datetime.now(timezone.utc).isoformat(timespec="seconds"), **fields}
+            try:
+                self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self._file.flush()
+            except OSError as e:
+                sys.exit(f"ERROR: Journal.write({self.path}), {e}")
+
+
+def _read(path):
+    """Read the events of the journal at path, ignoring a last line that was cut short by a crash."""
+    if not os.path.exists(path):
+        sys.exit(f"ABORT: {path} not found, there is no run to resume")
+    events = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().split("\n")
+    except OSError as e:
+        sys.exit(f"ERROR: Journal({path}), {e}")
+    for i, line in enumerate(lines):
+        if not line:
+            continue
+        try:
+            events.append(json.loads(line))
+        except ValueError as e:
+            if i < len(lines) - 1 and any(lines[i + 1:]):
+                sys.exit(f"ABORT: {path} is not a rems-copy journal, line {i + 1}: {e}")
+    if events and events[0].get("version") != JOURNAL_VERSION:
+        sys.exit(f"ABORT: {path} is not a version {JOURNAL_VERSION} rems-copy journal")
+    return events
+
+
+def journaled(c, destination, stage, work):
+    """Wrap work(step), which carries out a plan step of stage at destination and returns (outcome, name), to journal the operations it carries out.
+
+    If the run keeps going, an item whose work fails is journaled and reported with the outcome "failed" instead of
+    aborting the stage.
+    """
+    journal = c.get("journal")
+    if journal is None:
+        return work
+    keep_going = c.get("keep_going", False)
+
+    def run(s):
+        try:
+            result = work(s)
+        except (SystemExit, Exception) as e:
+            if not keep_going:
+                raise
+            journal.failed(destination, stage, s["name"], e.code if isinstance(e, SystemExit) else repr(e))
+            return "failed", s["name"]
+        if result[0] in OPERATIONS:
+            journal.done(destination, stage, s["name"], result[0])
+        return result
+
+    return run
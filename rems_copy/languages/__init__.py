@@ -1,22 +1,26 @@
 """Localisation checker."""
 import sys
 
-import requests
+from ..client import call, call_async, response_json
 
 
 def get_languages(c, env):
     """Get languages supported by env."""
-    headers = {
-        "accept": "application/json",
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
+    return call(c, env, _get_languages(c, env))
+
+
+async def get_languages_async(c, env):
+    """Get languages supported by env, without blocking the event loop."""
+    return await call_async(c, env, _get_languages(c, env))
+
+
+def _get_languages(c, env):
     try:
-        response = requests.get(c[env]["url"].rstrip("/") + "/api/config", headers=headers)
+        response = yield "GET", "/api/config", {}
     except Exception as e:
         sys.exit(f"ERROR: get_languages({env}), {e}")
 
     if response.status_code == 200:
-        return response.json()["languages"]
+        return response_json(response)["languages"]
     else:
         sys.exit(f"ABORT: get_languages({env}) responded with {str(response.status_code)}")
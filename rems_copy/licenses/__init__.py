@@ -1,99 +1,274 @@
 """License operations."""
+import re
 import sys
+from tempfile import SpooledTemporaryFile
 
-import requests
+from ..client import LISTING_PARAMS, MultipartBody, call, call_async, get_client, get_listing_async, iter_body, iter_listing, response_json
+from ..engine import run_items
+from ..index import add_created, get_index, get_records
+from ..inventory import get_detail, get_detail_async
+from ..journal import journaled
+from ..manifest import plan_sync, record_created, run_sync, sync_report
+from ..planner import Plan, step
+
+# attachments larger than this are spooled to a temporary file on disk instead of memory while they are copied
+ATTACHMENT_SPOOL_SIZE = 1024 * 1024
 
 
 def copy_licenses(config, source, destination, check):
     """Copy licenses from source to destination if name doesn't already exist in destination."""
-    source_licenses = get_licenses(config, source)
-    destination_licenses = get_licenses(config, destination)
-    destination_license_names = [dl["localizations"][config["language"]]["title"] for dl in destination_licenses]
-
-    skipped = []
-    created = []
-    not_supported = []
-    for i, sl in enumerate(source_licenses):
-        # attachment licenses are more complicated and are not supported as of yet
-        if sl["licensetype"] == "attachment":
-            not_supported.append(source_licenses.pop(i))
-
-    for i, sl in enumerate(source_licenses):
-        sys.stdout.write(f"\rcopying licenses {i+1}/{len(source_licenses)}")
-        sys.stdout.flush()
-        if sl["localizations"][config["language"]]["title"] not in destination_license_names:
-            if not check:
-                license_data = download_license(config, source, sl["id"])
-                post_license(config, license_data, destination)
-            created.append(sl["localizations"][config["language"]]["title"])
-        else:
-            skipped.append(sl["localizations"][config["language"]]["title"])
+    plan = Plan()
+    plan_licenses(config, source, destination, plan)
+    return run_licenses(config, source, destination, plan, check)
+
+
+def plan_licenses(config, source, destination, plan):
+    """Plan copying licenses from source to destination if name doesn't already exist in destination."""
+    source_licenses = get_records(config, source, "licenses", iter_licenses)
+    steps = plan_license_items(config, source_licenses, destination, plan, lambda sl: download_license(config, source, sl.id), True)
+    for s in steps:
+        if s["outcome"] == "created":
+            plan.fetch(source, "licenses", s["item"].id, f"/api/licenses/{s['item'].id}")
+            for attachment_id in s["item"].attachments:
+                plan.call(source, "GET", f"/api/licenses/attachments/{attachment_id}")
+                plan.call(destination, "POST", "/api/licenses/add_attachment")
+
+
+def run_licenses(config, source, destination, plan, check):
+    """Copy licenses from source to destination as planned and return the names by outcome."""
+    return run_license_steps(config, plan.steps(destination, "licenses"), destination, check, lambda sl: download_license(config, source, sl.id), lambda attachment_id: copy_attachment(config, source, destination, attachment_id))
+
+
+def copy_license_items(config, source_licenses, destination, check, download, copy_attachment=None):
+    """Copy source_licenses to destination if name doesn't already exist in destination and return the names by outcome.
+
+    source_licenses are records, see records.LicenseRecord, and can be streamed. download(license) returns the license
+    data to post, see download_license(). copy_attachment(attachment_id) copies an attachment to destination and
+    returns its id there, attachment licenses are not supported without it.
+    """
+    plan = Plan()
+    plan_license_items(config, source_licenses, destination, plan, download, copy_attachment is not None)
+    return run_license_steps(config, plan.steps(destination, "licenses"), destination, check, download, copy_attachment)
+
+
+def plan_license_items(config, source_licenses, destination, plan, download, attachments):
+    """Decide what happens to each of source_licenses at destination, add the steps to plan and return them.
+
+    Attachment licenses are only supported if their attachments can be copied. When syncing, licenses that have
+    changed at source since the last sync are reported, REMS can't edit licenses.
+    """
+    destination_licenses = get_index(config, destination, "licenses", iter_licenses)
+    syncing = config.get("manifest") is not None
+
+    def plan_license(sl):
+        title = sl.key
+        if sl.licensetype == "attachment" and not attachments:
+            return step("not supported", title, sl)
+        if title in destination_licenses:
+            if not syncing:
+                return step("skipped", title, sl)
+            sync = plan_sync(config, destination, "licenses", title, sl, lambda sl: license_content(download(sl)), False)
+            return step(sync["outcome"], title, sl, sync=sync)
+        if plan.creates(destination, "licenses", title):
+            return step("skipped", title, sl)
+        plan.create(destination, "licenses", title)
+        plan.call(destination, "POST", "/api/licenses/create")
+        return step("created", title, sl)
+
+    steps = run_items(config, "licenses", source_licenses, plan_license, lambda sl: sl.key, action="planning")
+    plan.add(destination, "licenses", steps)
+    return steps
+
+
+def run_license_steps(config, steps, destination, check, download, copy_attachment=None):
+    """Carry out the license steps of a plan at destination and return the names by outcome.
+
+    copy_attachment(attachment_id) copies an attachment to destination and returns its id there, it is needed if the
+    steps create attachment licenses.
+    """
+    syncing = config.get("manifest") is not None
+
+    def copy_license(s):
+        if "sync" in s:
+            return run_sync(config, destination, "licenses", s["name"], s["sync"], None, check), s["name"]
+        if s["outcome"] == "created" and not check:
+            license_data = download(s["item"])
+            content = license_content(license_data)
+            if attachment_ids(license_data):
+                license_data = replace_attachments(license_data, copy_attachment)
+            post_license(config, license_data, destination)
+            record_created(config, destination, "licenses", s["name"], s["item"], content)
+        return s["outcome"], s["name"]
+
+    results = run_items(config, "licenses", steps, journaled(config, destination, "licenses", copy_license), lambda s: s["name"])
+    skipped = [title for outcome, title in results if outcome == "skipped"]
+    created = [title for outcome, title in results if outcome == "created"]
+    not_supported = [title for outcome, title in results if outcome == "not supported"]
 
     print(f"\nskipped licenses that already exist at {destination}: {skipped}")
     print(f"created new licenses at {destination}: {created}")
+    report = {"skipped": skipped, "created": created}
+    if not_supported:
+        print(f"attachment licenses can't be copied to {destination} without their attachments: {not_supported}")
+        report["not supported"] = not_supported
+    if syncing:
+        report.update(sync_report("licenses", destination, results))
+    return report
 
 
 def download_license(c, env, identifier):
-    """Download license data."""
-    headers = {
-        "accept": "application/json",
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
+    """Download license data, details are downloaded once when they are shared between destinations."""
+    return strip_license(get_detail(c, env, "licenses", identifier, get_license))
+
+
+async def download_license_async(c, env, identifier):
+    """Download license data, without blocking the event loop."""
+    return strip_license(await get_detail_async(c, env, "licenses", identifier, get_license_async))
+
+
+def strip_license(license):
+    """Copy license without the keys that are not allowed when posting it."""
+    license = dict(license, organization=dict(license["organization"]))
+    # remove forbidden keys
+    del license["id"]
+    del license["organization"]["organization/short-name"]
+    del license["organization"]["organization/name"]
+    del license["enabled"]
+    del license["archived"]
+    return license
+
+
+def license_content(license):
+    """Get the part of stripped license data that is compared when syncing, organisations differ between environments.
+
+    Attachment ids differ between environments too, so the attachments of a license are compared by their ids at the
+    environment the license is copied from.
+    """
+    return {k: v for k, v in license.items() if k != "organization"}
+
+
+def attachment_ids(license):
+    """Get the ids of the attachments of license, one for each language that has an attachment."""
+    return [localization["attachment-id"] for localization in license["localizations"].values() if localization.get("attachment-id") is not None]
+
+
+def replace_attachments(license, copy_attachment):
+    """Copy license with its attachments replaced by the ids that copy_attachment(attachment_id) returns."""
+    localizations = {}
+    for language, localization in license["localizations"].items():
+        if localization.get("attachment-id") is not None:
+            localization = dict(localization, **{"attachment-id": copy_attachment(localization["attachment-id"])})
+        localizations[language] = localization
+    return dict(license, localizations=localizations)
+
+
+def copy_attachment(c, source, destination, attachment_id):
+    """Copy license attachment from source to destination and return its id at destination.
+
+    The attachment is streamed from source in chunks to a temporary file, which stays in memory only while the
+    attachment is small, and is streamed from there to destination, so a large attachment is never held in memory.
+    The file makes it possible to send the attachment again if the upload is retried.
+    """
+    with SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE) as file:
+        filename, content_type, size = download_attachment(c, source, attachment_id, file)
+        file.seek(0)
+        return post_attachment(c, destination, filename, content_type, file, size)
+
+
+def download_attachment(c, env, attachment_id, file):
+    """Download license attachment to file in chunks and return its filename, content type and size in bytes."""
     try:
-        response = requests.get(c[env]["url"].rstrip("/") + "/api/licenses/" + str(identifier), headers=headers)
+        response = get_client(c, env).get(f"/api/licenses/attachments/{attachment_id}", headers={"accept": "*/*"}, stream=True)
     except Exception as e:
-        sys.exit(f"ERROR: download_license({env}, {str(identifier)}), {e}")
+        sys.exit(f"ERROR: download_attachment({env}, {str(attachment_id)}), {e}")
 
     if response.status_code == 200:
-        form = response.json()
-        # remove forbidden keys
-        del form["id"]
-        del form["organization"]["organization/short-name"]
-        del form["organization"]["organization/name"]
-        del form["enabled"]
-        del form["archived"]
-        return form
+        with response:
+            try:
+                for chunk in iter_body(response):
+                    file.write(chunk)
+            except Exception as e:
+                sys.exit(f"ERROR: download_attachment({env}, {str(attachment_id)}), {e}")
+        match = re.search(r'filename="?([^";]+)"?', response.headers.get("Content-Disposition", ""))
+        filename = match.group(1) if match else f"attachment-{attachment_id}"
+        return filename, response.headers.get("Content-Type", "application/octet-stream"), file.tell()
+    else:
+        sys.exit(f"ABORT: download_attachment({env}, {str(attachment_id)}) responded with {str(response.status_code)}")
+
+
+def post_attachment(c, env, filename, content_type, file, size):
+    """Post license attachment of size bytes from file to environment and return the id of the created attachment."""
+    body = MultipartBody("file", filename, content_type, file, size)
+    try:
+        response = get_client(c, env).post("/api/licenses/add_attachment", data=body, headers={"content-type": body.content_type})
+    except Exception as e:
+        sys.exit(f"ERROR: post_attachment({filename}), {e}")
+
+    if response.status_code == 200 and response_json(response).get("success"):
+        return response_json(response)["id"]
     else:
-        sys.exit(f"ABORT: download_license({env}, {str(identifier)}) responded with {str(response.status_code)}")
+        sys.exit(f"ABORT: post_attachment({filename}) responded with {str(response.status_code)}, {response.text}")
 
 
 def post_license(c, license, env):
-    """Post license to environment."""
+    """Post license to environment and return the id of the created license."""
+    return call(c, env, _post_license(c, license, env))
+
+
+async def post_license_async(c, license, env):
+    """Post license to environment and return the id of the created license, without blocking the event loop."""
+    return await call_async(c, env, _post_license(c, license, env))
+
+
+def _post_license(c, license, env):
     license["organization"]["organization/id"] = c[env]["organisation"]
-    headers = {
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
     try:
-        response = requests.post(c[env]["url"].rstrip("/") + "/api/licenses/create", headers=headers, json=license)
+        response = yield "POST", "/api/licenses/create", {"json": license}
     except Exception as e:
         sys.exit(f"ERROR: post_license(), {e}")
 
-    if response.status_code == 200:
-        pass
+    if response.status_code == 200 and response_json(response).get("success"):
+        license_id = response_json(response)["id"]
+        add_created(c, env, "licenses", dict(license, id=license_id))
+        return license_id
     else:
         sys.exit(f"ABORT: post_license() responded with {str(response.status_code)}, {response.text}")
 
 
 def get_licenses(c, env):
     """Get available licenses."""
+    return list(iter_licenses(c, env))
+
+
+async def get_licenses_async(c, env):
+    """Get available licenses, without blocking the event loop."""
+    print(f"downloading licenses from {env}")
+    return await get_listing_async(c, env, "get_licenses", "/api/licenses", LISTING_PARAMS)
+
+
+def iter_licenses(c, env):
+    """Stream available licenses, parsing them one at a time."""
     print(f"downloading licenses from {env}")
-    params = {
-        "disabled": "false",
-        "archived": "false",
-    }
-    headers = {
-        "accept": "application/json",
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
+    yield from iter_listing(c, env, "get_licenses", "/api/licenses", LISTING_PARAMS)
+
+
+def get_license(c, env, identifier):
+    """Get specific license."""
+    return call(c, env, _get_license(c, env, identifier))
+
+
+async def get_license_async(c, env, identifier):
+    """Get specific license, without blocking the event loop."""
+    return await call_async(c, env, _get_license(c, env, identifier))
+
+
+def _get_license(c, env, identifier):
     try:
-        response = requests.get(c[env]["url"].rstrip("/") + "/api/licenses", headers=headers, params=params)
+        response = yield "GET", "/api/licenses/" + str(identifier), {}
     except Exception as e:
-        sys.exit(f"ERROR: get_licenses({env}), {e}")
+        sys.exit(f"ERROR: get_license({env}, {str(identifier)}), {e}")
 
     if response.status_code == 200:
-        return response.json()
+        return response_json(response)
     else:
-        sys.exit(f"ABORT: get_licenses({env}) responded with {str(response.status_code)}")
+        sys.exit(f"ABORT: get_license({env}, {str(identifier)}) responded with {str(response.status_code)}")
@@ -3,14 +3,64 @@ import os
 import sys
 import json
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-from .licenses import copy_licenses
-from .forms import copy_forms
-from .resources import copy_resources
-from .workflows import copy_workflows
-from .catalogue import copy_catalogue
-from .categories import copy_categories
+from .bundle import export_bundle, import_bundle
+from .client import add_listener, remove_listener
+from .diff import diff_environments, differs, print_diff, write_diff
+from .engine import AdaptiveConcurrency
+from .licenses import plan_licenses, run_licenses
+from .forms import plan_forms, run_forms
+from .resources import plan_resources, run_resources
+from .workflows import plan_workflows, run_workflows
+from .catalogue import plan_catalogue, run_catalogue
+from .categories import plan_categories, run_categories
 from .languages import get_languages
+from .index import KINDS
+from .inventory import Inventory
+from .journal import Journal
+from .manifest import Manifest
+from .metrics import Metrics
+from .planner import Plan
+from .profiler import Profiler, profiled
+from .scheduler import run_stages
+from .selection import select_items
+
+# copy stages with the functions to plan and run them, and the stages they depend on, in the order they are planned
+STAGES = {
+    "licenses": (plan_licenses, run_licenses, []),
+    "forms": (plan_forms, run_forms, []),
+    "resources": (plan_resources, run_resources, ["licenses"]),
+    "workflows": (plan_workflows, run_workflows, ["forms"]),
+    "catalogue": (plan_catalogue, run_catalogue, ["forms", "resources", "workflows"]),
+    "categories": (plan_categories, run_categories, ["catalogue"]),
+}
+# entity type of the items copied by each stage
+STAGE_KINDS = {
+    "licenses": "licenses",
+    "forms": "forms",
+    "resources": "resources",
+    "workflows": "workflows",
+    "catalogue": "catalogue-items",
+    "categories": "categories",
+}
+# journal of runs that keep going or are resumed, when --journal isn't given
+DEFAULT_JOURNAL = "journal.jsonl"
+# plan stages of the copy stages that carry out their items in several stages
+PLAN_STAGES = {"categories": ["categories", "category children", "category catalogue items"]}
+
+
+def prerequisites(name):
+    """Get the stages that must be copied before stage name, directly or through other stages, in copying order."""
+    names = set()
+    todo = list(STAGES[name][2]) if name in STAGES else []
+    while todo:
+        prerequisite = todo.pop()
+        if prerequisite not in names:
+            names.add(prerequisite)
+            todo += STAGES[prerequisite][2]
+    return [stage for stage in STAGES if stage in names]
 
 
 def load_config(path):
@@ -27,18 +77,193 @@ def load_config(path):
 def parse_arguments(arguments):
     """Parse command line arguments and options."""
     parser = argparse.ArgumentParser(description="This tool copies REMS items from one instance to another")
-    parser.add_argument("items", choices=["licenses", "forms", "resources", "workflows", "catalogue", "categories", "all"], help="items to move")
-    parser.add_argument("source", help="source environment where items are downloaded from")
-    parser.add_argument("destination", help="destination environment where items are uploaded to")
+    parser.add_argument("items", choices=["licenses", "forms", "resources", "workflows", "catalogue", "categories", "all", "export", "import", "diff"], help="items to move, export/import all items to/from a bundle file, or diff all items of the environments")
+    parser.add_argument("source", help="source environment where items are downloaded from, or bundle file to import")
+    parser.add_argument("destination", nargs="+", help="one or more destination environments where items are uploaded to or compared with, or bundle file to export to")
     parser.add_argument("-c", "--config", default="config.json", help="path to JSON configuration file, default='./config.json'")
     parser.add_argument("-l", "--language", default="en", help="two letter language code, which is used for matching item titles, default='en'")
-    parser.add_argument("--check", action="store_true", help="execute script as a dry run to see what would happen, without changing data in REMS")
-    if len(sys.argv) <= 1:
+    parser.add_argument("--id", type=int, action="append", help="id of an item to copy with the items it depends on instead of all items, can be given many times")
+    parser.add_argument("--match", action="append", help="name of an item to copy with the items it depends on instead of all items, can be given many times")
+    parser.add_argument("--concurrency", type=int, default=1, help="number of items copied at the same time, default=1")
+    parser.add_argument("--adaptive", action="store_true", help="adapt number of items copied at the same time to response times and errors, up to --concurrency")
+    parser.add_argument("--sync", metavar="MANIFEST", help="path to sync manifest file, items that exist in destination are updated if they have changed in source since the last sync")
+    parser.add_argument("--metrics-out", metavar="PATH", help="path to write request metrics to at the end of the run, in Prometheus text format if it ends with .prom and as JSON otherwise")
+    parser.add_argument("--profile", metavar="DIR", help="directory to write CPU and memory profiles of every stage to, stages and items are copied one at a time")
+    parser.add_argument("--check", action="store_true", help="plan the copy and print the plan and the API calls it makes, without changing data in REMS")
+    parser.add_argument("--journal", metavar="PATH", help="path to a journal that the run appends its planned and completed operations to, so that it can be resumed, default='./journal.jsonl' with --resume or --keep-going and no journal otherwise")
+    parser.add_argument("--resume", action="store_true", help="resume the last run in the journal, which must have been run with the same command, skipping the stages it completed")
+    parser.add_argument("--keep-going", action="store_true", help="report items that fail in the error report and the journal and copy the other items, instead of aborting")
+    parser.add_argument("--diff-out", metavar="PATH", help="path to write the diff report to as JSON")
+    if not (sys.argv[1:] if arguments is None else arguments):
         parser.print_help()
         sys.exit(0)
     return parser.parse_args(arguments)
 
 
+def select_stages(config, items, source, ids, keys):
+    """Select the items with ids or match keys and the items they depend on from source, and return the stages that copy them.
+
+    The selected items replace the source listings of the run, so only they are planned and copied.
+    """
+    selection = select_items(config, source, STAGE_KINDS[items], ids, keys)
+    for kind, selected in selection.items():
+        config["inventory"].put((source, kind), selected)
+        # the selected items were downloaded by id, so their details are not downloaded again
+        for item in selected:
+            config["inventory"].put((source, kind, "detail", item[KINDS[kind][1]]), item)
+    return [name for name in STAGES if selection[STAGE_KINDS[name]]]
+
+
+def remaining_stages(config, stages, destination):
+    """Get the stages that the resumed run hasn't completed at destination, or all stages if the run isn't resumed."""
+    journal = config.get("journal")
+    return [name for name in stages if journal is None or not journal.completed(destination, name)]
+
+
+def plan_items(config, stages, source, destination, plan):
+    """Plan copying the items of stages from source to destination, stage by stage so that stages can depend on items planned by earlier stages.
+
+    Stages that the resumed run completed are not planned again, their items are at destination already.
+    """
+    remaining = remaining_stages(config, stages, destination)
+    if len(remaining) < len(stages):
+        print(f"resuming {destination}, skipping stages completed earlier: {[name for name in stages if name not in remaining]}")
+    for name in remaining:
+        with profiled(config, f"{destination}.plan-{name}"):
+            STAGES[name][0](config, source, destination, plan)
+
+
+def copy_items(config, stages, source, destination, plan, check):
+    """Copy the items of stages, or of the bundle if stages is "import", from source to destination as planned and return the names by outcome of each stage."""
+    if stages == "import":
+        with profiled(config, f"{destination}.import"):
+            reports = import_bundle(config, source, destination, check)
+        for name, report in reports.items():
+            report.update(failed_items(config, destination, name))
+        return reports
+    stages = remaining_stages(config, stages, destination)
+    if len(stages) > 1:
+        runs = {name: (partial(copy_stage, config, name, source, destination, plan, check), [p for p in STAGES[name][2] if p in stages]) for name in stages}
+        # profiled stages must run one at a time
+        return run_stages(runs, destination, workers=1 if config.get("profiler") else None)
+    return {name: copy_stage(config, name, source, destination, plan, check) for name in stages}
+
+
+def copy_stage(config, name, source, destination, plan, check):
+    """Run copy stage name from source to destination as planned and return the names by outcome, and journal the stage as finished."""
+    with profiled(config, f"{destination}.{name}"):
+        report = STAGES[name][1](config, source, destination, plan, check)
+    report.update(failed_items(config, destination, name))
+    if config.get("journal") is not None:
+        config["journal"].stage(destination, name, len(report.get("failed", [])))
+    return report
+
+
+def failed_items(config, destination, name):
+    """Get the names of the items of stage name that failed at destination as a report, which is empty if none failed."""
+    journal = config.get("journal")
+    failures = journal.failures(destination, PLAN_STAGES.get(name, [name])) if journal is not None else []
+    return {"failed": [f[2] for f in failures]} if failures else {}
+
+
+def print_summary(destination, reports):
+    """Print number of items by outcome of each stage."""
+    print(f"\nsummary for {destination}:")
+    for stage, report in reports.items():
+        outcomes = ", ".join(f"{outcome} {len(names)}" for outcome, names in report.items())
+        print(f"  {stage:<12} {outcomes}")
+
+
+def copy_destinations(config, items, source, destinations, check, selectors=None):
+    """Plan copying items from source to all destinations, then copy them at the same time and print a summary for each destination.
+
+    Every destination is planned from listings before anything is copied, and the plan is printed with the API calls
+    that the run makes. A dry run returns there, except when importing a bundle, which is planned while it is imported,
+    and a real run carries out the same plan. selectors are the ids and
+    match keys of the items to copy with their dependencies, or None to copy all items. The source listings and
+    details are shared between the destinations. If planning or copying to a destination fails, copying to the other
+    destinations continues, and the run is aborted at the end.
+    """
+    plan = Plan()
+    failed = {}
+    # bundles are streamed and imported kind by kind, so they are planned while importing
+    stages = items
+    if items != "import":
+        add_listener(plan.observe)
+        try:
+            stages = list(STAGES) if items == "all" else [items]
+            if selectors is not None:
+                stages = select_stages(config, items, source, *selectors)
+            _, failed = for_destinations(config, destinations, lambda destination: plan_items(config, stages, source, destination, plan))
+        finally:
+            remove_listener(plan.observe)
+        plan.print_summary(config, [destination for destination in destinations if destination not in failed])
+        if check:
+            for destination in failed:
+                print(f"\nplan for {destination}:\n  failed: {failed[destination]}")
+            if failed:
+                sys.exit(f"ABORT: planning failed at {list(failed)}")
+            return
+        # the plan is journaled before it is carried out
+        if config.get("journal") is not None:
+            for destination in destinations:
+                if destination not in failed:
+                    config["journal"].planned(destination, plan)
+
+    reports, copy_failed = for_destinations(config, [destination for destination in destinations if destination not in failed], lambda destination: copy_items(config, stages, source, destination, plan, check))
+    failed.update(copy_failed)
+    for destination in destinations:
+        if destination in reports:
+            print_summary(destination, reports[destination])
+        else:
+            print(f"\nsummary for {destination}:\n  failed: {failed[destination]}")
+    # items synced before a failure are remembered too, a dry run doesn't change the manifest
+    if config["manifest"] is not None and not check:
+        config["manifest"].save()
+    journal = config.get("journal")
+    if journal is not None:
+        journal.print_errors()
+        journal.finish(failed)
+    if failed:
+        sys.exit(f"ABORT: copying failed at {list(failed)}")
+    if journal is not None and journal.failures():
+        sys.exit(f"ABORT: {len(journal.failures())} items failed, rerun with --resume to retry them")
+
+
+def diff_destinations(config, source, destinations, path=None):
+    """Compare all destinations with source at the same time, print the differences of each destination and write them to path if it is given.
+
+    The run is aborted at the end if a destination differs from source or comparing it fails.
+    """
+    reports, failed = for_destinations(config, destinations, lambda destination: diff_environments(config, source, destination))
+    for destination in destinations:
+        if destination in reports:
+            print_diff(source, destination, reports[destination])
+        else:
+            print(f"\ndiff of {destination} with {source}:\n  failed: {failed[destination]}")
+    if path:
+        write_diff(path, source, reports)
+    if failed:
+        sys.exit(f"ABORT: comparing failed at {list(failed)}")
+    different = [destination for destination in destinations if differs(reports[destination])]
+    if different:
+        sys.exit(f"ABORT: {different} differ from {source}")
+
+
+def for_destinations(config, destinations, work):
+    """Run work(destination) for all destinations at the same time and return the results and the failures by destination."""
+    results = {}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=1 if config.get("profiler") else max(1, len(destinations))) as executor:
+        runs = {destination: executor.submit(work, destination) for destination in destinations}
+    for destination, run in runs.items():
+        try:
+            results[destination] = run.result()
+        except (SystemExit, Exception) as e:
+            failed[destination] = e.code if isinstance(e, SystemExit) else repr(e)
+    return results, failed
+
+
 def main(arguments=None):
     """Run script."""
     a = parse_arguments(arguments)
@@ -46,36 +271,74 @@ def main(arguments=None):
 
     # Dry run check
     if a.check:
-        print("DRY RUN ENABLED\nData will be downloaded, but not uploaded")
-
-    # Verify chosen language
-    source_languages = get_languages(config, a.source)
-    destination_languages = get_languages(config, a.destination)
-    if a.language not in source_languages:
-        sys.exit(f"language={a.language} is not supported by env={a.source}")
-    if a.language not in destination_languages:
-        sys.exit(f"language={a.language} is not supported by env={a.destination}")
+        print("DRY RUN ENABLED\nData will be downloaded and the copy planned, but not uploaded")
+    if a.items == "export" and len(a.destination) > 1:
+        sys.exit("export takes only one bundle file as destination")
+    if a.profile and (a.concurrency > 1 or a.adaptive):
+        sys.exit("--profile copies items one at a time, it can't be used with --concurrency or --adaptive")
+    if a.adaptive and a.concurrency < 2:
+        sys.exit("--adaptive needs --concurrency larger than 1 as the maximum")
+    if (a.id or a.match) and a.items in ("all", "export", "import", "diff"):
+        sys.exit("--id and --match select items of one type, e.g. rems-copy catalogue demo test --id 12")
+    if a.items == "export" and a.sync:
+        sys.exit("export can't be synced, export always writes all items")
+    if a.items == "export" and (a.resume or a.keep_going):
+        sys.exit("export writes the bundle in one go, it can't be resumed or keep going")
+    if a.items == "diff" and (a.sync or a.resume or a.keep_going or a.check):
+        sys.exit("diff only reads the environments, it can't be used with --sync, --resume, --keep-going or --check")
+    if a.diff_out and a.items != "diff":
+        sys.exit("--diff-out writes the report of diff, e.g. rems-copy diff demo test --diff-out diff.json")
+
+    metrics = Metrics() if a.metrics_out else None
+    if metrics is not None:
+        add_listener(metrics.observe)
+    try:
+        run(config, a)
+    finally:
+        if metrics is not None:
+            remove_listener(metrics.observe)
+            metrics.write(a.metrics_out)
+
+
+def run(config, a):
+    """Run the command given in parsed arguments a."""
+    # the clients of the environments are created by the first request, with connection pools sized by the concurrency
+    config["concurrency"] = a.concurrency
+    # Verify chosen language, bundle files don't have languages
+    environments = {"export": [a.source], "import": a.destination}.get(a.items, [a.source] + a.destination)
+    for env in environments:
+        if a.language not in get_languages(config, env):
+            sys.exit(f"language={a.language} is not supported by env={env}")
     config["language"] = a.language
+    # source listings and details are cached when several destinations need them
+    config["inventory"] = Inventory(shared=len(a.destination) > 1)
+    config["manifest"] = Manifest(a.sync, a.source) if a.sync else None
+
+    config["controller"] = AdaptiveConcurrency(a.concurrency) if a.adaptive else None
+    if config["controller"] is not None:
+        add_listener(config["controller"].observe)
+    config["profiler"] = Profiler(a.profile) if a.profile else None
+    config["keep_going"] = a.keep_going
+    # runs are journaled only when asked to, export and diff don't change REMS, and a dry run only reads the journal of the run it resumes
+    command = {"items": a.items, "source": a.source, "destinations": a.destination, "language": a.language, "id": a.id, "match": a.match, "sync": a.sync}
+    journal = a.journal or (DEFAULT_JOURNAL if a.resume or a.keep_going else None)
+    config["journal"] = Journal(journal, command, resume=a.resume, write=not a.check) if journal is not None and a.items not in ("export", "diff") else None
 
-    if a.items == "licenses":
-        copy_licenses(config, a.source, a.destination, a.check)
-    if a.items == "forms":
-        copy_forms(config, a.source, a.destination, a.check)
-    if a.items == "resources":
-        copy_resources(config, a.source, a.destination, a.check)
-    if a.items == "workflows":
-        copy_workflows(config, a.source, a.destination, a.check)
-    if a.items == "catalogue":
-        copy_catalogue(config, a.source, a.destination, a.check)
-    if a.items == "categories":
-        copy_categories(config, a.source, a.destination, a.check)
-    if a.items == "all":
-        copy_licenses(config, a.source, a.destination, a.check)
-        copy_forms(config, a.source, a.destination, a.check)
-        copy_resources(config, a.source, a.destination, a.check)
-        copy_workflows(config, a.source, a.destination, a.check)
-        copy_catalogue(config, a.source, a.destination, a.check)
-        copy_categories(config, a.source, a.destination, a.check)
+    try:
+        if a.items == "export":
+            with profiled(config, "export"):
+                export_bundle(config, a.source, a.destination[0])
+        elif a.items == "diff":
+            diff_destinations(config, a.source, a.destination, a.diff_out)
+        else:
+            selectors = (a.id or [], a.match or []) if a.id or a.match else None
+            copy_destinations(config, a.items, a.source, a.destination, a.check, selectors)
+    finally:
+        if config["controller"] is not None:
+            remove_listener(config["controller"].observe)
+            print(f"\nadaptive {config['controller'].summary()}")
+        if config["profiler"] is not None:
+            config["profiler"].close()
 
 
 if __name__ == "__main__":
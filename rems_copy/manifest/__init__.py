@@ -0,0 +1,121 @@
+"""Sync manifest operations."""
+import hashlib
+import json
+import os
+import sys
+import threading
+
+MANIFEST_VERSION = 1
+
+
+def fingerprint(data):
+    """Get SHA-256 hash of the canonical JSON of data."""
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class Manifest:
+    """Fingerprints of the items synced from one source to each destination, keyed by (destination, entity type, match key).
+
+    Every item has a listing fingerprint, which is the hash of the item as listed at the source, and a content
+    fingerprint, which is the hash of the data that was copied to the destination, or None if it is not known yet.
+    """
+
+    def __init__(self, path, source):
+        """Load manifest from path, or start an empty one if the file doesn't exist."""
+        self.path = path
+        self.source = source
+        self._lock = threading.Lock()
+        self._pairs = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    data = json.loads(f.read())
+            except (OSError, ValueError) as e:
+                sys.exit(f"ERROR: Manifest({path}), {e}")
+            if data.get("version") != MANIFEST_VERSION:
+                sys.exit(f"ABORT: {path} is not a version {MANIFEST_VERSION} rems-copy manifest")
+            self._pairs = data["pairs"]
+
+    def get(self, destination, kind, key):
+        """Get fingerprints of item of kind with match key, or None if it hasn't been synced to destination."""
+        with self._lock:
+            return self._pairs.get(self._pair(destination), {}).get(kind, {}).get(key)
+
+    def record(self, destination, kind, key, listing, content):
+        """Remember fingerprints of item of kind with match key synced to destination."""
+        with self._lock:
+            items = self._pairs.setdefault(self._pair(destination), {}).setdefault(kind, {})
+            items[key] = {"listing": listing, "content": content}
+
+    def save(self):
+        """Write manifest to its path, replacing the old file only once the new one has been written."""
+        with self._lock:
+            data = {"version": MANIFEST_VERSION, "pairs": self._pairs}
+            try:
+                with open(self.path + ".tmp", "w") as f:
+                    f.write(json.dumps(data, sort_keys=True, indent=1))
+                os.replace(self.path + ".tmp", self.path)
+            except OSError as e:
+                sys.exit(f"ERROR: Manifest.save({self.path}), {e}")
+
+    def _pair(self, destination):
+        return f"{self.source} -> {destination}"
+
+
+def plan_sync(c, destination, kind, key, item, content, editable):
+    """Decide whether item of kind, which already exists at destination, has changed since the last sync and return a sync step.
+
+    item is the record of the source item, which carries its listing fingerprint. content(item) returns the data of
+    the source item that is compared and copied, it is only called when the listing fingerprint of item has changed.
+    editable is False if REMS can't edit items of kind. Items that existed at destination before the first sync are
+    taken as they are. The outcome of the step is "unchanged", "changed" or "not propagated", "data" is the data to
+    write and "record" the fingerprints to remember, or None. Items that are not propagated are not remembered, so
+    they are reported again by every sync until they are resolved.
+    """
+    listing = item.listing
+    synced = c["manifest"].get(destination, kind, key)
+    if synced is None:
+        return {"outcome": "unchanged", "data": None, "record": (listing, None)}
+    if synced["listing"] == listing:
+        return {"outcome": "unchanged", "data": None, "record": None}
+
+    data = content(item)
+    digest = fingerprint(data)
+    if synced["content"] == digest:
+        return {"outcome": "unchanged", "data": None, "record": (listing, digest)}
+    if not editable:
+        # the fingerprints of the last sync are kept, so the item is reported until the change reaches destination or is undone
+        return {"outcome": "not propagated", "data": None, "record": None}
+    return {"outcome": "changed", "data": data, "record": (listing, digest)}
+
+
+def run_sync(c, destination, kind, key, step, update, check):
+    """Carry out sync step of item of kind with match key, writing changed data to destination with update(data), and return its outcome."""
+    if not check:
+        if step["outcome"] == "changed":
+            update(step["data"])
+        if step["record"] is not None:
+            c["manifest"].record(destination, kind, key, *step["record"])
+    return step["outcome"]
+
+
+def record_created(c, destination, kind, key, item, data=None):
+    """Remember an item of kind that was just created at destination from data, when syncing, item is the record of the source item."""
+    manifest = c.get("manifest")
+    if manifest is not None:
+        manifest.record(destination, kind, key, item.listing, None if data is None else fingerprint(data))
+
+
+def sync_report(label, destination, results):
+    """Print and return the names of synced items by outcome, from (outcome, name, ...) results."""
+    report = {
+        "unchanged": [result[1] for result in results if result[0] == "unchanged"],
+        "changed": [result[1] for result in results if result[0] == "changed"],
+        "not propagated": [result[1] for result in results if result[0] == "not propagated"],
+    }
+    print(f"{label} unchanged since last sync to {destination}: {len(report['unchanged'])}")
+    print(f"updated {label} that have changed at source: {report['changed']}")
+    if report["not propagated"]:
+        print(f"WARNING: {label} changed at source, but REMS can't edit them at {destination}: {report['not propagated']}")
+    return report
@@ -0,0 +1,122 @@
+"""Request metrics operations."""
+import json
+import re
+import sys
+import threading
+from collections import Counter
+
+# upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def endpoint(path):
+    """Get endpoint of path, with item ids replaced by {id}."""
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+
+class Metrics:
+    """Count, latency histogram, bytes sent and received and status codes of requests by (environment, method, endpoint).
+
+    Feed it with client.add_listener(metrics.observe).
+    """
+
+    def __init__(self):
+        """Create empty metrics."""
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def observe(self, env, method, path, status, seconds, sent, received):
+        """Record a request attempt."""
+        key = (env, method, endpoint(path))
+        with self._lock:
+            metrics = self._endpoints.get(key)
+            if metrics is None:
+                metrics = self._endpoints[key] = {"count": 0, "seconds": 0.0, "buckets": [0] * len(BUCKETS), "sent": 0, "received": 0, "statuses": Counter()}
+            metrics["count"] += 1
+            metrics["seconds"] += seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    metrics["buckets"][i] += 1
+                    break
+            metrics["sent"] += sent
+            metrics["received"] += received
+            metrics["statuses"][str(status) if status is not None else "error"] += 1
+
+    def to_json(self):
+        """Get metrics as JSON, with cumulative bucket counts keyed by their upper bound."""
+        with self._lock:
+            endpoints = []
+            for (env, method, path), metrics in sorted(self._endpoints.items()):
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(BUCKETS, metrics["buckets"]):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                buckets["+Inf"] = metrics["count"]
+                endpoints.append(
+                    {
+                        "env": env,
+                        "method": method,
+                        "endpoint": path,
+                        "count": metrics["count"],
+                        "seconds": round(metrics["seconds"], 6),
+                        "buckets": buckets,
+                        "bytes_sent": metrics["sent"],
+                        "bytes_received": metrics["received"],
+                        "statuses": dict(sorted(metrics["statuses"].items())),
+                    }
+                )
+        return json.dumps({"endpoints": endpoints}, indent=1)
+
+    def to_prometheus(self):
+        """Get metrics in the Prometheus text exposition format."""
+        with self._lock:
+            items = sorted(self._endpoints.items())
+            lines = [
+                "# HELP rems_copy_requests_total Requests sent to REMS by response status.",
+                "# TYPE rems_copy_requests_total counter",
+            ]
+            for key, metrics in items:
+                for status, count in sorted(metrics["statuses"].items()):
+                    lines.append(f"rems_copy_requests_total{{{_labels(key, status=status)}}} {count}")
+
+            lines += [
+                "# HELP rems_copy_request_duration_seconds Time until the response headers were received.",
+                "# TYPE rems_copy_request_duration_seconds histogram",
+            ]
+            for key, metrics in items:
+                cumulative = 0
+                for bound, count in zip(BUCKETS, metrics["buckets"]):
+                    cumulative += count
+                    lines.append(f"rems_copy_request_duration_seconds_bucket{{{_labels(key, le=str(bound))}}} {cumulative}")
+                lines.append(f"rems_copy_request_duration_seconds_bucket{{{_labels(key, le='+Inf')}}} {metrics['count']}")
+                lines.append(f"rems_copy_request_duration_seconds_sum{{{_labels(key)}}} {metrics['seconds']:.6f}")
+                lines.append(f"rems_copy_request_duration_seconds_count{{{_labels(key)}}} {metrics['count']}")
+
+            for name, field, description in (
+                ("rems_copy_sent_bytes_total", "sent", "Bytes of request bodies sent to REMS."),
+                ("rems_copy_received_bytes_total", "received", "Bytes of response bodies received from REMS."),
+            ):
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+                for key, metrics in items:
+                    lines.append(f"{name}{{{_labels(key)}}} {metrics[field]}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write metrics to path, in the Prometheus text format if path ends with .prom and as JSON otherwise."""
+        data = self.to_prometheus() if path.endswith(".prom") else self.to_json()
+        try:
+            with open(path, "w") as f:
+                f.write(data)
+        except OSError as e:
+            sys.exit(f"ERROR: Metrics.write({path}), {e}")
+
+
+def _labels(key, **extra):
+    env, method, path = key
+    labels = {"env": env, "method": method, "endpoint": path, **extra}
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
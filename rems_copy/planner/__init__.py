@@ -0,0 +1,101 @@
+"""Copy plan operations."""
+import threading
+from collections import Counter
+
+from ..metrics import endpoint
+
+
+class Plan:
+    """Steps of copying the source items of each stage to each destination, decided from listings before anything is copied.
+
+    A step is a dict with the outcome of one source item, its name, the item and whatever carrying it out needs, e.g.
+    the match keys of its dependencies or "unresolved" references that can't be found at the destination. Items that
+    the plan creates are remembered by match key, so that the steps of later stages can depend on them. The plan also
+    counts the API calls that are made while planning, and the calls that carrying the plan out will make.
+    """
+
+    def __init__(self):
+        """Create empty plan."""
+        self._lock = threading.Lock()
+        self._steps = {}
+        self._created = {}
+        self._planning = Counter()
+        self._calls = Counter()
+        self._details = []
+
+    def add(self, destination, stage, steps):
+        """Add the steps of stage for destination."""
+        with self._lock:
+            self._steps[(destination, stage)] = steps
+
+    def steps(self, destination, stage):
+        """Get the steps of stage for destination."""
+        with self._lock:
+            return self._steps.get((destination, stage), [])
+
+    def stages(self, destination):
+        """Get (stage, steps) of the stages planned for destination."""
+        with self._lock:
+            return [(stage, steps) for (env, stage), steps in self._steps.items() if env == destination]
+
+    def create(self, destination, kind, key):
+        """Remember that the plan creates the item of kind with match key at destination."""
+        with self._lock:
+            self._created.setdefault((destination, kind), set()).add(key)
+
+    def creates(self, destination, kind, key):
+        """Check if the plan creates the item of kind with match key at destination."""
+        with self._lock:
+            return key in self._created.get((destination, kind), ())
+
+    def call(self, env, method, path):
+        """Count an API call that carrying out the plan makes."""
+        with self._lock:
+            self._calls[(env, method, endpoint(path))] += 1
+
+    def fetch(self, env, kind, identifier, path):
+        """Count a detail download that carrying out the plan makes, unless the detail is cached by then."""
+        with self._lock:
+            self._details.append((env, kind, identifier, endpoint(path)))
+
+    def observe(self, env, method, path, status, seconds, sent, received):
+        """Count an API call made while planning, feed it with client.add_listener(plan.observe)."""
+        with self._lock:
+            self._planning[(env, method, endpoint(path))] += 1
+
+    def calls(self, c):
+        """Get number of API calls made while planning and planned by (environment, method, endpoint)."""
+        inventory = c.get("inventory")
+        with self._lock:
+            planned = Counter(self._calls)
+            details = self._details
+            if inventory is not None:
+                details = [detail for detail in details if inventory.peek((detail[0], detail[1], "detail", detail[2])) is None]
+                if inventory.shared:
+                    details = set(details)
+            for env, _, _, path in details:
+                planned[(env, "GET", path)] += 1
+            return {key: (self._planning[key], planned[key]) for key in sorted(set(self._planning) | set(planned))}
+
+    def print_summary(self, c, destinations):
+        """Print number of steps by outcome of each stage, unresolved references and API calls."""
+        with self._lock:
+            steps = dict(self._steps)
+        for destination in destinations:
+            print(f"\nplan for {destination}:")
+            for (env, stage), stage_steps in steps.items():
+                if env != destination:
+                    continue
+                outcomes = Counter(s["outcome"] for s in stage_steps)
+                print(f"  {stage:<24} " + ", ".join(f"{outcome} {count}" for outcome, count in outcomes.items()))
+                for s in stage_steps:
+                    if s.get("unresolved"):
+                        print(f"    {s['name']} refers to {', '.join(s['unresolved'])} missing from {destination}")
+        print("\nAPI calls (made while planning, planned):")
+        for (env, method, path), (planning, planned) in self.calls(c).items():
+            print(f"  {env:<12} {method:<5} {path:<40} {planning:>6} {planned:>6}")
+
+
+def step(outcome, name, item, **details):
+    """Create a plan step of item with outcome and name."""
+    return dict(details, outcome=outcome, name=name, item=item)
@@ -0,0 +1,112 @@
+"""Profiling operations."""
+import cProfile
+import os
+import pstats
+import re
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+TOP_ALLOCATIONS = 20
+
+
+class Profiler:
+    """CPU and memory profiles of named sections of a run, written to a directory.
+
+    Every section gets a pstats file of cProfile and a report of its peak traced memory and top allocations. cProfile
+    only sees the thread that starts it, so profiled sections must run one at a time in one thread. Sections can be
+    nested, a nested section is profiled on its own and is also included in the section around it.
+    """
+
+    def __init__(self, directory):
+        """Create directory and start tracing memory allocations."""
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            sys.exit(f"ERROR: Profiler({directory}), {e}")
+        self.directory = directory
+        self.sections = []
+        self._stack = []
+        tracemalloc.start()
+
+    @contextmanager
+    def section(self, name):
+        """Profile the code run inside the with block as section name."""
+        outer = self._stack[-1] if self._stack else None
+        if outer is not None:
+            outer.profile.disable()
+            outer.peak = max(outer.peak, tracemalloc.get_traced_memory()[1])
+            paused = time.perf_counter()
+
+        section = _Section(name)
+        tracemalloc.reset_peak()
+        self._stack.append(section)
+        section.profile.enable()
+        try:
+            yield
+        finally:
+            section.profile.disable()
+            self._stack.pop()
+            section.peak = max(section.peak, tracemalloc.get_traced_memory()[1])
+            # the snapshots of nested sections are not part of the wall time of the section
+            wall = time.perf_counter() - section.started - section.overhead
+            self._write(section, wall, _snapshot())
+            if outer is not None:
+                outer.children += [section.profile] + section.children
+                outer.peak = max(outer.peak, section.peak)
+                outer.overhead += time.perf_counter() - paused - wall
+                tracemalloc.reset_peak()
+                outer.profile.enable()
+
+    def close(self):
+        """Stop tracing memory allocations and print a summary of the profiled sections."""
+        tracemalloc.stop()
+        print(f"\nprofiles written to {self.directory}:")
+        for name, wall, profiled, peak in self.sections:
+            print(f"  {name:<40} wall {wall:.2f}s, profiled {profiled:.2f}s, peak memory {peak / 1e6:.1f}MB")
+
+    def _write(self, section, wall, snapshot):
+        path = os.path.join(self.directory, re.sub(r"[^\w.-]", "_", section.name))
+        stats = pstats.Stats(section.profile)
+        for child in section.children:
+            stats.add(child)
+        try:
+            stats.dump_stats(path + ".pstats")
+            with open(path + ".memory.txt", "w") as f:
+                f.write(f"section {section.name}\n")
+                f.write(f"wall time {wall:.3f}s\n")
+                f.write(f"peak traced memory {section.peak / 1e6:.1f}MB, {(section.peak - section.start_memory) / 1e6:.1f}MB above the start of the section\n\n")
+                f.write(f"top {TOP_ALLOCATIONS} allocations held at the end of the section compared to its start:\n")
+                for stat in snapshot.compare_to(section.snapshot, "lineno")[:TOP_ALLOCATIONS]:
+                    f.write(f"{stat}\n")
+        except OSError as e:
+            sys.exit(f"ERROR: Profiler.section({section.name}), {e}")
+        self.sections.append((section.name, wall, stats.total_tt, section.peak))
+
+
+class _Section:
+    """State of a profiled section."""
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.children = []
+        self.snapshot = _snapshot()
+        self.start_memory = tracemalloc.get_traced_memory()[0]
+        self.peak = 0
+        self.overhead = 0.0
+        self.started = time.perf_counter()
+
+
+def _snapshot():
+    """Take snapshot of traced memory without the allocations of tracemalloc itself."""
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+def profiled(c, name):
+    """Profile the with block as section name if the run is profiled."""
+    profiler = c.get("profiler")
+    if profiler is None:
+        return nullcontext()
+    return profiler.section(name)
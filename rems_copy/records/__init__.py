@@ -0,0 +1,130 @@
+"""Compact record operations."""
+
+
+def _value(c, value):
+    return value
+
+
+def _attachments(c, localizations):
+    return tuple(localization["attachment-id"] for localization in localizations.values() if localization.get("attachment-id") is not None)
+
+
+def _license_titles(c, licenses):
+    return tuple(rl["localizations"][c["language"]]["title"] for rl in licenses)
+
+
+def _workflow_type(c, workflow):
+    return workflow["type"]
+
+
+def _workflow_forms(c, workflow):
+    return tuple(wf["form/internal-name"] for wf in workflow["forms"])
+
+
+def _localizations(c, localizations):
+    return {lang: {k: v for k, v in localization.items() if k not in ("id", "langcode")} for lang, localization in localizations.items()}
+
+
+def _category_ids(c, categories):
+    return tuple(category["category/id"] for category in categories)
+
+
+class Record:
+    """Compact record of a listed item, with only the fields that matching, planning and building payloads need.
+
+    Records keep their fields in slots, and drop the rest of the decoded JSON, e.g. license texts, form fields,
+    organisations and the details of dependencies. FIELDS lists the slots with the JSON field they are projected from
+    and the function convert(c, value) that projects it. key is the match key of the item, and listing the fingerprint
+    of the item as listed when syncing, or None. Full details are downloaded only when an item is created from them.
+    """
+
+    __slots__ = ("id", "key", "listing")
+    FIELDS = ()
+
+    def __init__(self, c, item, key, listing=None):
+        """Project item with match key."""
+        self.key = key
+        self.listing = listing
+        for slot, _, _ in self.FIELDS:
+            setattr(self, slot, None)
+        self.update(c, item)
+
+    def update(self, c, item):
+        """Update the slots whose fields are in item, e.g. after the item was edited."""
+        for slot, field, convert in self.FIELDS:
+            if field in item:
+                setattr(self, slot, convert(c, item[field]))
+
+    def __repr__(self):
+        """Show kind and match key of record."""
+        return f"{type(self).__name__}({self.key!r})"
+
+
+class LicenseRecord(Record):
+    """License with its type and the ids of its attachments."""
+
+    __slots__ = ("licensetype", "attachments")
+    FIELDS = (("id", "id", _value), ("licensetype", "licensetype", _value), ("attachments", "localizations", _attachments))
+
+
+class FormRecord(Record):
+    """Form, which is created from its details."""
+
+    __slots__ = ()
+    FIELDS = (("id", "form/id", _value),)
+
+
+class ResourceRecord(Record):
+    """Resource with the titles of its licenses."""
+
+    __slots__ = ("licenses",)
+    FIELDS = (("id", "id", _value), ("licenses", "licenses", _license_titles))
+
+
+class WorkflowRecord(Record):
+    """Workflow with its type and the internal names of its forms."""
+
+    __slots__ = ("type", "forms")
+    FIELDS = (("id", "id", _value), ("type", "workflow", _workflow_type), ("forms", "workflow", _workflow_forms))
+
+
+class CatalogueItemRecord(Record):
+    """Catalogue item with its localizations, the ids of its dependencies and of its categories.
+
+    categories is None if the listing doesn't carry the categories of the item.
+    """
+
+    __slots__ = ("localizations", "formid", "resource_id", "resid", "wfid", "categories")
+    FIELDS = (
+        ("id", "id", _value),
+        ("localizations", "localizations", _localizations),
+        ("formid", "formid", _value),
+        ("resource_id", "resource-id", _value),
+        ("resid", "resid", _value),
+        ("wfid", "wfid", _value),
+        ("categories", "categories", _category_ids),
+    )
+
+
+class CategoryRecord(Record):
+    """Category with its data without id and children, and the ids of its children."""
+
+    __slots__ = ("data", "children")
+    FIELDS = (("id", "category/id", _value), ("children", "category/children", _category_ids))
+
+    def update(self, c, item):
+        """Update the slots whose fields are in item, and the data with the other fields of item."""
+        super().update(c, item)
+        data = {k: v for k, v in item.items() if k not in ("category/id", "category/children")}
+        self.data = dict(getattr(self, "data", None) or {}, **data)
+
+
+# record class of each entity type
+RECORDS = {
+    "licenses": LicenseRecord,
+    "forms": FormRecord,
+    "resources": ResourceRecord,
+    "workflows": WorkflowRecord,
+    "catalogue-items": CatalogueItemRecord,
+    "categories": CategoryRecord,
+}
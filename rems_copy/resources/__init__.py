@@ -1,109 +1,183 @@
 """Resource operations."""
 import sys
 
-import requests
-
-from ..licenses import get_licenses
+from ..client import LISTING_PARAMS, call, call_async, get_listing_async, iter_listing, response_json
+from ..engine import run_items
+from ..index import add_created, get_index, get_records
+from ..journal import journaled
+from ..licenses import iter_licenses
+from ..manifest import plan_sync, record_created, run_sync, sync_report
+from ..planner import Plan, step
 
 
 def copy_resources(config, source, destination, check):
     """Copy resources from source to destination if name doesn't already exist in destination."""
-    source_resources = get_resources(config, source)
-    destination_resources = get_resources(config, destination)
-    destination_resource_names = [dr["resid"] for dr in destination_resources]
-    destination_licenses = get_licenses(config, destination)
-    destination_licenses_dict = {}
-    for dl in destination_licenses:
-        destination_licenses_dict[dl["localizations"][config["language"]]["title"]] = dl["id"]
-
-    skipped = []
-    created = []
-
-    for i, sr in enumerate(source_resources):
-        sys.stdout.write(f"\rcopying resources {i+1}/{len(source_resources)}")
-        sys.stdout.flush()
-        if sr["resid"] not in destination_resource_names:
-            if not check:
-                resource_data = create_resource_data(
-                    config=config,
-                    resource=sr["resid"],
-                    organisation=config[source]["organisation"],
-                    resource_licenses=sr["licenses"],
-                    destination_licenses=destination_licenses_dict,
-                )
-                post_resource(config, resource_data, destination)
-            created.append(sr["resid"])
-        else:
-            skipped.append(sr["resid"])
+    plan = Plan()
+    plan_resources(config, source, destination, plan)
+    return run_resources(config, source, destination, plan, check)
+
+
+def plan_resources(config, source, destination, plan):
+    """Plan copying resources from source to destination if name doesn't already exist in destination."""
+    source_resources = get_records(config, source, "resources", iter_resources)
+    plan_resource_items(config, source_resources, destination, plan)
+
+
+def run_resources(config, source, destination, plan, check):
+    """Copy resources from source to destination as planned and return the names by outcome."""
+    return run_resource_steps(config, plan.steps(destination, "resources"), destination, check)
+
+
+def copy_resource_items(config, source_resources, destination, check):
+    """Copy source_resources to destination if name doesn't already exist in destination and return the names by outcome.
+
+    source_resources are records, see records.ResourceRecord, and can be streamed.
+    """
+    plan = Plan()
+    plan_resource_items(config, source_resources, destination, plan)
+    return run_resource_steps(config, plan.steps(destination, "resources"), destination, check)
+
+
+def plan_resource_items(config, source_resources, destination, plan):
+    """Decide what happens to each of source_resources at destination, add the steps to plan and return them.
+
+    Resources whose licenses neither exist at destination nor are created by the plan are missing. When syncing,
+    resources that have changed at source since the last sync are reported, REMS can't edit resources.
+    """
+    destination_resources = get_index(config, destination, "resources", iter_resources)
+    destination_licenses = get_index(config, destination, "licenses", iter_licenses)
+    syncing = config.get("manifest") is not None
+
+    def plan_resource(sr):
+        if sr.key in destination_resources:
+            if not syncing:
+                return step("skipped", sr.key, sr)
+            sync = plan_sync(config, destination, "resources", sr.key, sr, resource_content, False)
+            return step(sync["outcome"], sr.key, sr, sync=sync)
+        if plan.creates(destination, "resources", sr.key):
+            return step("skipped", sr.key, sr)
+        unresolved = [f"license={title}" for title in sr.licenses if title not in destination_licenses and not plan.creates(destination, "licenses", title)]
+        if unresolved:
+            return step("missing", sr.key, sr, unresolved=unresolved)
+        plan.create(destination, "resources", sr.key)
+        plan.call(destination, "POST", "/api/resources/create")
+        return step("created", sr.key, sr)
+
+    steps = run_items(config, "resources", source_resources, plan_resource, lambda sr: sr.key, action="planning")
+    plan.add(destination, "resources", steps)
+    return steps
+
+
+def run_resource_steps(config, steps, destination, check):
+    """Carry out the resource steps of a plan at destination and return the names by outcome."""
+    destination_licenses = get_index(config, destination, "licenses", iter_licenses)
+    syncing = config.get("manifest") is not None
+
+    def copy_resource(s):
+        sr = s["item"]
+        if "sync" in s:
+            return run_sync(config, destination, "resources", s["name"], s["sync"], None, check), s["name"]
+        if s["outcome"] == "created" and not check:
+            resource_data = create_resource_data(
+                resource=sr.key,
+                organisation=config[destination]["organisation"],
+                resource_licenses=sr.licenses,
+                destination_licenses=destination_licenses.ids,
+            )
+            post_resource(config, resource_data, destination)
+            record_created(config, destination, "resources", sr.key, sr, resource_content(sr))
+        return s["outcome"], s["name"]
+
+    results = run_items(config, "resources", steps, journaled(config, destination, "resources", copy_resource), lambda s: s["name"])
+    skipped = [resid for outcome, resid in results if outcome == "skipped"]
+    created = [resid for outcome, resid in results if outcome == "created"]
+    missing = [resid for outcome, resid in results if outcome == "missing"]
 
     print(f"\nskipped resources that already exist at {destination}: {skipped}")
     print(f"created new resources at {destination}: {created}")
+    if missing:
+        print(f"skipped resources with licenses missing from {destination}: {missing}")
+    report = {"skipped": skipped, "created": created, "missing": missing}
+    if syncing:
+        report.update(sync_report("resources", destination, results))
+    return report
 
 
-def create_resource_data(config={}, resource="", organisation="", resource_licenses=[], destination_licenses={}):
-    """Create resource payload."""
+def create_resource_data(resource="", organisation="", resource_licenses=[], destination_licenses={}):
+    """Create resource payload, resource_licenses are the titles of the licenses of the resource."""
     payload = {
         "resid": resource,
         "organization": {"organization/id": organisation},
-        "licenses": [destination_licenses[rl["localizations"][config["language"]]["title"]] for rl in resource_licenses],
+        "licenses": [destination_licenses[title] for title in resource_licenses],
     }
     return payload
 
 
+def resource_content(resource):
+    """Get the part of source resource record that is compared when syncing."""
+    return {"licenses": list(resource.licenses)}
+
+
 def post_resource(c, resource, env):
-    """Post resource to environment."""
+    """Post resource to environment and return the id of the created resource."""
+    return call(c, env, _post_resource(c, resource, env))
+
+
+async def post_resource_async(c, resource, env):
+    """Post resource to environment and return the id of the created resource, without blocking the event loop."""
+    return await call_async(c, env, _post_resource(c, resource, env))
+
+
+def _post_resource(c, resource, env):
     resource["organization"]["organization/id"] = c[env]["organisation"]
-    headers = {
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
     try:
-        response = requests.post(c[env]["url"].rstrip("/") + "/api/resources/create", headers=headers, json=resource)
+        response = yield "POST", "/api/resources/create", {"json": resource}
     except Exception as e:
         sys.exit(f"ERROR: post_resource(), {e}")
 
-    if response.status_code == 200:
-        pass
+    if response.status_code == 200 and response_json(response).get("success"):
+        resource_id = response_json(response)["id"]
+        # the payload has the ids of the licenses instead of the licenses
+        add_created(c, env, "resources", {"id": resource_id, "resid": resource["resid"]})
+        return resource_id
     else:
         sys.exit(f"ABORT: post_resource() responded with {str(response.status_code)}, {response.text}")
 
 
 def get_resources(c, env):
     """Get available resources."""
+    return list(iter_resources(c, env))
+
+
+async def get_resources_async(c, env):
+    """Get available resources, without blocking the event loop."""
     print(f"downloading resources from {env}")
-    params = {
-        "disabled": "false",
-        "archived": "false",
-    }
-    headers = {
-        "accept": "application/json",
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
-    try:
-        response = requests.get(c[env]["url"].rstrip("/") + "/api/resources", headers=headers, params=params)
-    except Exception as e:
-        sys.exit(f"ERROR: get_resources({env}), {e}")
+    return await get_listing_async(c, env, "get_resources", "/api/resources", LISTING_PARAMS)
 
-    if response.status_code == 200:
-        return response.json()
-    else:
-        sys.exit(f"ABORT: get_resources({env}) responded with {str(response.status_code)}")
+
+def iter_resources(c, env):
+    """Stream available resources, parsing them one at a time."""
+    print(f"downloading resources from {env}")
+    yield from iter_listing(c, env, "get_resources", "/api/resources", LISTING_PARAMS)
 
 
 def get_resource(c, env, resource_id):
     """Get specific resources."""
-    headers = {
-        "accept": "application/json",
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
+    return call(c, env, _get_resource(c, env, resource_id))
+
+
+async def get_resource_async(c, env, resource_id):
+    """Get specific resources, without blocking the event loop."""
+    return await call_async(c, env, _get_resource(c, env, resource_id))
+
+
+def _get_resource(c, env, resource_id):
     try:
-        response = requests.get(c[env]["url"].rstrip("/") + f"/api/resources/{resource_id}", headers=headers)
+        response = yield "GET", f"/api/resources/{resource_id}", {}
     except Exception as e:
         sys.exit(f"ERROR: get_resource({env}), {e}")
 
     if response.status_code == 200:
-        return response.json()
+        return response_json(response)
     else:
         sys.exit(f"ABORT: get_resource({env}) responded with {str(response.status_code)}")
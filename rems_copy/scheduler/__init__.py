@@ -0,0 +1,57 @@
+"""Stage scheduler operations."""
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def run_stages(stages, title="", workers=None):
+    """Run stages as soon as their prerequisites have finished and return the return values of the stages.
+
+    stages maps a stage name to a tuple of (function, prerequisite stage names). Stages that don't
+    depend on each other run at the same time, at most workers stages at once. If a stage fails, the running stages are allowed to
+    finish, no new stages are started and the failure is raised after the timing summary.
+    """
+    results = {}
+    timings = {}
+    finished = set()
+    failure = None
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers or len(stages)) as executor:
+        running = {}
+        waiting = dict(stages)
+        while True:
+            if failure is None:
+                for name, (function, prerequisites) in list(waiting.items()):
+                    if set(prerequisites) <= finished:
+                        del waiting[name]
+                        timings[name] = [time.perf_counter() - start, None]
+                        running[executor.submit(function)] = name
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                timings[name][1] = time.perf_counter() - start
+                try:
+                    results[name] = future.result()
+                    finished.add(name)
+                except (SystemExit, Exception) as e:
+                    if failure is None:
+                        failure = e
+
+    print_timings(timings, time.perf_counter() - start, title)
+    if failure is not None:
+        raise failure
+    if waiting:
+        sys.exit(f"ABORT: run_stages() could not start stages with unmet prerequisites: {list(waiting)}")
+    return results
+
+
+def print_timings(timings, total, title=""):
+    """Print when each stage started and how long it took."""
+    print(f"\nstage timings{' for ' + title if title else ''}:")
+    for name, (started, ended) in sorted(timings.items(), key=lambda t: t[1][0]):
+        took = f"{ended - started:.1f}s" if ended is not None else "unfinished"
+        print(f"  {name:<12} started at {started:.1f}s, took {took}")
+    print(f"  {'total':<12} {total:.1f}s")
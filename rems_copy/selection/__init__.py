@@ -0,0 +1,94 @@
+"""Selective copy operations."""
+import sys
+
+from ..catalogue import get_catalogue_item, iter_catalogue_items
+from ..categories import get_category, iter_categories
+from ..engine import run_items
+from ..forms import get_form, iter_forms
+from ..index import KINDS, match_key
+from ..inventory import get_detail, stream_listing
+from ..licenses import get_license, iter_licenses
+from ..resources import get_resource, iter_resources
+from ..workflows import get_workflow, iter_workflows
+
+# functions to stream the listing and get the details of each entity type
+SOURCES = {
+    "licenses": (iter_licenses, get_license),
+    "forms": (iter_forms, get_form),
+    "resources": (iter_resources, get_resource),
+    "workflows": (iter_workflows, get_workflow),
+    "catalogue-items": (iter_catalogue_items, get_catalogue_item),
+    "categories": (iter_categories, get_category),
+}
+
+
+def select_items(c, env, kind, ids=(), keys=()):
+    """Get the items of kind with ids or match keys from env together with everything they depend on, by entity type.
+
+    Catalogue items pull in their form, resource, workflow and categories, resources their licenses, workflows their
+    forms, and categories their children. The selected categories and the categories in them also pull in the
+    catalogue items in them. Items are downloaded by id, listings are only downloaded to find items by match key and
+    the catalogue items of categories.
+    """
+    selected = {name: {} for name in KINDS}
+    pending = [(kind, identifier, None) for identifier in ids]
+    if keys:
+        found = {}
+        for item in stream_listing(c, env, kind, SOURCES[kind][0]):
+            key = match_key(c, kind, item)
+            if key in keys:
+                found.setdefault(key, item)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            sys.exit(f"ABORT: select_items({env}) found no {kind} matching {missing}")
+        pending += [(kind, item[KINDS[kind][1]], item) for item in found.values()]
+
+    catalogue_items = None
+    # categories that pull in the catalogue items in them, and those whose catalogue items have been pulled in
+    whole = {identifier for item_kind, identifier, item in pending} if kind == "categories" else set()
+    expanded = set()
+
+    def dependencies(item_kind, identifier, item):
+        nonlocal catalogue_items
+        if item_kind == "resources":
+            return [("licenses", rl["id"], None) for rl in item["licenses"]]
+        if item_kind == "workflows":
+            return [("forms", wf["form/id"], None) for wf in item["workflow"]["forms"]]
+        if item_kind == "catalogue-items":
+            fields = [(kind, item[field], None) for kind, field in (("forms", "formid"), ("resources", "resource-id"), ("workflows", "wfid")) if item[field] is not None]
+            return fields + [("categories", cic["category/id"], None) for cic in item.get("categories", [])]
+        if item_kind == "categories":
+            children = [("categories", child["category/id"], None) for child in item.get("category/children", [])]
+            if identifier not in whole:
+                return children
+            expanded.add(identifier)
+            whole.update(child_id for _, child_id, _ in children)
+            if catalogue_items is None:
+                catalogue_items = list(stream_listing(c, env, "catalogue-items", iter_catalogue_items))
+            return children + [("catalogue-items", ci["id"], ci) for ci in catalogue_items if identifier in {cic["category/id"] for cic in ci.get("categories", [])}]
+        return []
+
+    def download(entry):
+        (item_kind, identifier), item = entry
+        return item if item is not None else get_detail(c, env, item_kind, identifier, SOURCES[item_kind][1])
+
+    while pending:
+        # dependencies are downloaded a level at a time, as many at the same time as items are copied
+        level = {}
+        for item_kind, identifier, item in pending:
+            if identifier not in selected[item_kind]:
+                level.setdefault((item_kind, identifier), item)
+        items = run_items(c, "dependencies", list(level.items()), download, lambda entry: f"{entry[0][0]} {entry[0][1]}", action="selecting")
+        pending = []
+        for (item_kind, identifier), item in zip(level, items):
+            selected[item_kind][identifier] = item
+            pending += dependencies(item_kind, identifier, item)
+        # categories selected for a catalogue item before they were found in a selected category
+        late = [identifier for identifier in whole - expanded if identifier in selected["categories"]]
+        while late:
+            for identifier in late:
+                pending += dependencies("categories", identifier, selected["categories"][identifier])
+            late = [identifier for identifier in whole - expanded if identifier in selected["categories"]]
+
+    print(f"\nselected from {env}: " + ", ".join(f"{len(items)} {kind}" for kind, items in selected.items() if items))
+    return {kind: list(items.values()) for kind, items in selected.items()}
@@ -1,113 +1,188 @@
 """workflow operations."""
 import sys
 
-import requests
-
-from ..forms import get_forms
+from ..client import LISTING_PARAMS, call, call_async, get_listing_async, iter_listing, response_json
+from ..engine import run_items
+from ..forms import iter_forms
+from ..index import add_created, get_index, get_records
+from ..journal import journaled
+from ..manifest import plan_sync, record_created, run_sync, sync_report
+from ..planner import Plan, step
 
 
 def copy_workflows(config, source, destination, check):
     """Copy workflows from source to destination if name doesn't already exist in destination."""
-    source_workflows = get_workflows(config, source)
-    destination_workflows = get_workflows(config, destination)
-    destination_workflow_names = [dw["title"] for dw in destination_workflows]
-    destination_forms = get_forms(config, destination)
-    destination_forms_dict = {}
-    for df in destination_forms:
-        destination_forms_dict[df["form/title"]] = df["form/id"]
-
-    skipped = []
-    created = []
-
-    for i, sw in enumerate(source_workflows):
-        sys.stdout.write(f"\rcopying workflows {i+1}/{len(source_workflows)}")
-        sys.stdout.flush()
-        if sw["title"] not in destination_workflow_names:
-            if not check:
-                workflow_data = create_workflow_data(
-                    title=sw["title"],
-                    organisation=config[source]["organisation"],
-                    workflow_type=sw["workflow"]["type"],
-                    workflow_forms=sw["workflow"]["forms"],
-                    destination_forms=destination_forms_dict,
-                )
-                post_workflow(config, workflow_data, destination)
-            created.append(sw["title"])
-        else:
-            skipped.append(sw["title"])
+    plan = Plan()
+    plan_workflows(config, source, destination, plan)
+    return run_workflows(config, source, destination, plan, check)
+
+
+def plan_workflows(config, source, destination, plan):
+    """Plan copying workflows from source to destination if name doesn't already exist in destination."""
+    source_workflows = get_records(config, source, "workflows", iter_workflows)
+    plan_workflow_items(config, source_workflows, destination, plan)
+
+
+def run_workflows(config, source, destination, plan, check):
+    """Copy workflows from source to destination as planned and return the names by outcome."""
+    return run_workflow_steps(config, plan.steps(destination, "workflows"), destination, check)
+
+
+def copy_workflow_items(config, source_workflows, destination, check):
+    """Copy source_workflows to destination if name doesn't already exist in destination and return the names by outcome.
+
+    source_workflows are records, see records.WorkflowRecord, and can be streamed.
+    """
+    plan = Plan()
+    plan_workflow_items(config, source_workflows, destination, plan)
+    return run_workflow_steps(config, plan.steps(destination, "workflows"), destination, check)
+
+
+def plan_workflow_items(config, source_workflows, destination, plan):
+    """Decide what happens to each of source_workflows at destination, add the steps to plan and return them.
+
+    Workflows whose forms neither exist at destination nor are created by the plan are missing. When syncing,
+    workflows that have changed at source since the last sync are reported, REMS can't edit the type and forms of
+    workflows.
+    """
+    destination_workflows = get_index(config, destination, "workflows", iter_workflows)
+    destination_forms = get_index(config, destination, "forms", iter_forms)
+    syncing = config.get("manifest") is not None
+
+    def plan_workflow(sw):
+        if sw.key in destination_workflows:
+            if not syncing:
+                return step("skipped", sw.key, sw)
+            sync = plan_sync(config, destination, "workflows", sw.key, sw, workflow_content, False)
+            return step(sync["outcome"], sw.key, sw, sync=sync)
+        if plan.creates(destination, "workflows", sw.key):
+            return step("skipped", sw.key, sw)
+        unresolved = [f"form={name}" for name in sw.forms if name not in destination_forms and not plan.creates(destination, "forms", name)]
+        if unresolved:
+            return step("missing", sw.key, sw, unresolved=unresolved)
+        plan.create(destination, "workflows", sw.key)
+        plan.call(destination, "POST", "/api/workflows/create")
+        return step("created", sw.key, sw)
+
+    steps = run_items(config, "workflows", source_workflows, plan_workflow, lambda sw: sw.key, action="planning")
+    plan.add(destination, "workflows", steps)
+    return steps
+
+
+def run_workflow_steps(config, steps, destination, check):
+    """Carry out the workflow steps of a plan at destination and return the names by outcome."""
+    destination_forms = get_index(config, destination, "forms", iter_forms)
+    syncing = config.get("manifest") is not None
+
+    def copy_workflow(s):
+        sw = s["item"]
+        if "sync" in s:
+            return run_sync(config, destination, "workflows", s["name"], s["sync"], None, check), s["name"]
+        if s["outcome"] == "created" and not check:
+            workflow_data = create_workflow_data(
+                title=sw.key,
+                organisation=config[destination]["organisation"],
+                workflow_type=sw.type,
+                workflow_forms=sw.forms,
+                destination_forms=destination_forms.ids,
+            )
+            post_workflow(config, workflow_data, destination)
+            record_created(config, destination, "workflows", sw.key, sw, workflow_content(sw))
+        return s["outcome"], s["name"]
+
+    results = run_items(config, "workflows", steps, journaled(config, destination, "workflows", copy_workflow), lambda s: s["name"])
+    skipped = [title for outcome, title in results if outcome == "skipped"]
+    created = [title for outcome, title in results if outcome == "created"]
+    missing = [title for outcome, title in results if outcome == "missing"]
 
     print(f"\nskipped workflows that already exist at {destination}: {skipped}")
     print(f"created new workflows at {destination}: {created}")
+    if missing:
+        print(f"skipped workflows with forms missing from {destination}: {missing}")
+    report = {"skipped": skipped, "created": created, "missing": missing}
+    if syncing:
+        report.update(sync_report("workflows", destination, results))
+    return report
 
 
 def create_workflow_data(title="", organisation="", workflow_type="", workflow_forms=[], destination_forms={}):
-    """Create workflow payload."""
+    """Create workflow payload, workflow_forms are the internal names of the forms of the workflow."""
     payload = {
         "organization": {
             "organization/id": organisation,
         },
         "title": title,
-        "forms": [{"form/id": destination_forms[wf["form/internal-name"]]} for wf in workflow_forms],
+        "forms": [{"form/id": destination_forms[name]} for name in workflow_forms],
         "type": workflow_type,
         "handlers": [],
     }
     return payload
 
 
+def workflow_content(workflow):
+    """Get the part of source workflow record that is compared when syncing."""
+    return {"type": workflow.type, "forms": list(workflow.forms)}
+
+
 def post_workflow(c, workflow, env):
-    """Post workflow to environment."""
+    """Post workflow to environment and return the id of the created workflow."""
+    return call(c, env, _post_workflow(c, workflow, env))
+
+
+async def post_workflow_async(c, workflow, env):
+    """Post workflow to environment and return the id of the created workflow, without blocking the event loop."""
+    return await call_async(c, env, _post_workflow(c, workflow, env))
+
+
+def _post_workflow(c, workflow, env):
     workflow["organization"]["organization/id"] = c[env]["organisation"]
-    headers = {
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
     try:
-        response = requests.post(c[env]["url"].rstrip("/") + "/api/workflows/create", headers=headers, json=workflow)
+        response = yield "POST", "/api/workflows/create", {"json": workflow}
     except Exception as e:
         sys.exit(f"ERROR: post_workflow(), {e}")
 
-    if response.status_code == 200:
-        pass
+    if response.status_code == 200 and response_json(response).get("success"):
+        workflow_id = response_json(response)["id"]
+        add_created(c, env, "workflows", dict(workflow, id=workflow_id))
+        return workflow_id
     else:
         sys.exit(f"ABORT: post_workflow() responded with {str(response.status_code)}, {response.text}")
 
 
 def get_workflows(c, env):
     """Get available workflows."""
+    return list(iter_workflows(c, env))
+
+
+async def get_workflows_async(c, env):
+    """Get available workflows, without blocking the event loop."""
     print(f"downloading workflows from {env}")
-    params = {
-        "disabled": "false",
-        "archived": "false",
-    }
-    headers = {
-        "accept": "application/json",
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
-    try:
-        response = requests.get(c[env]["url"].rstrip("/") + "/api/workflows", headers=headers, params=params)
-    except Exception as e:
-        sys.exit(f"ERROR: get_workflows({env}), {e}")
+    return await get_listing_async(c, env, "get_workflows", "/api/workflows", LISTING_PARAMS)
 
-    if response.status_code == 200:
-        return response.json()
-    else:
-        sys.exit(f"ABORT: get_workflows({env}) responded with {str(response.status_code)}")
+
+def iter_workflows(c, env):
+    """Stream available workflows, parsing them one at a time."""
+    print(f"downloading workflows from {env}")
+    yield from iter_listing(c, env, "get_workflows", "/api/workflows", LISTING_PARAMS)
 
 
 def get_workflow(c, env, workflow_id):
     """Get specific workflow."""
-    headers = {
-        "accept": "application/json",
-        "x-rems-api-key": c[env]["key"],
-        "x-rems-user-id": c[env]["username"],
-    }
+    return call(c, env, _get_workflow(c, env, workflow_id))
+
+
+async def get_workflow_async(c, env, workflow_id):
+    """Get specific workflow, without blocking the event loop."""
+    return await call_async(c, env, _get_workflow(c, env, workflow_id))
+
+
+def _get_workflow(c, env, workflow_id):
     try:
-        response = requests.get(c[env]["url"].rstrip("/") + f"/api/workflows/{workflow_id}", headers=headers)
+        response = yield "GET", f"/api/workflows/{workflow_id}", {}
     except Exception as e:
         sys.exit(f"ERROR: get_workflow({env}), {e}")
 
     if response.status_code == 200:
-        return response.json()
+        return response_json(response)
     else:
         sys.exit(f"ABORT: get_workflow({env}) responded with {str(response.status_code)}")
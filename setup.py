@@ -23,10 +23,28 @@ setup(
         "rems_copy/catalogue",
         "rems_copy/languages",
         "rems_copy/categories",
+        "rems_copy/client",
+        "rems_copy/engine",
+        "rems_copy/scheduler",
+        "rems_copy/inventory",
+        "rems_copy/journal",
+        "rems_copy/index",
+        "rems_copy/records",
+        "rems_copy/manifest",
+        "rems_copy/metrics",
+        "rems_copy/planner",
+        "rems_copy/selection",
+        "rems_copy/profiler",
+        "rems_copy/bundle",
+        "rems_copy/diff",
     ],
     install_requires=[
         "requests",
     ],
+    extras_require={
+        "fast": ["orjson"],
+        "async": ["aiohttp>=3.10"],
+    },
     entry_points={
         "console_scripts": [
             "rems-copy=rems_copy.main:main",